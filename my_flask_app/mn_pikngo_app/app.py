@@ -5,6 +5,20 @@ from flask_wtf.csrf import CSRFProtect
 from flask_ckeditor import CKEditor
 from models import db, User
 from blueprint import blueprint
+from autocomplete import init_autocomplete
+from commands import register_commands
+from files import init_media_cache
+from fragments import init_fragment_cache
+from fuzzy import init_fuzzy
+from images import init_images
+from invalidation import init_invalidation
+from jobs import init_jobs
+from mail import init_mail
+from newsletter import init_newsletter
+from pagecache import init_page_cache
+from search import init_search_cache
+from storage import UploadRequest
+from surrogate import init_surrogate
 from dotenv import load_dotenv
 
 
@@ -12,17 +26,128 @@ from dotenv import load_dotenv
 load_dotenv()
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Configaration
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI', 'sqlite:///your_database.db')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your_default_secret_key')
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'media/uploads')
 app.config['CKEDITOR_SERVE_LOCAL'] = True
+# Larger request bodies are refused with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+app.config['UPLOAD_SPOOL_BYTES'] = int(os.getenv('UPLOAD_SPOOL_BYTES', 64 * 1024))  # per file, then spilled to UPLOAD_FOLDER/.tmp
+# /media and /menu: '' streams through the worker (sendfile when the server supports it),
+# 'x-accel' hands off to nginx, 'x-sendfile' to Apache/lighttpd
+app.config['MEDIA_OFFLOAD'] = os.getenv('MEDIA_OFFLOAD', '')
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_OFFLOAD'] == 'x-sendfile'
+# Directories mapped to nginx `internal` locations aliasing them, for X-Accel-Redirect
+app.config['MEDIA_ACCEL_LOCATIONS'] = {
+    app.config['UPLOAD_FOLDER']: os.getenv('MEDIA_ACCEL_UPLOADS', '/protected/uploads/'),
+    app.static_folder: os.getenv('MEDIA_ACCEL_STATIC', '/protected/static/'),
+}
+app.config['MEDIA_MAX_AGE'] = int(os.getenv('MEDIA_MAX_AGE', 86400))  # seconds; revalidated by ETag after that
+app.config['MEDIA_CACHE_BYTES'] = int(os.getenv('MEDIA_CACHE_BYTES', 32 * 1024 * 1024))  # small files kept in memory; 0 disables
+app.config['MEDIA_CACHE_MAX_FILE'] = int(os.getenv('MEDIA_CACHE_MAX_FILE', 256 * 1024))
+app.config['MEDIA_CACHE_TTL'] = float(os.getenv('MEDIA_CACHE_TTL', 5))  # seconds before re-checking a file on disk
+# Sizes /media/<file>?w=&h=&fit= may be asked for: (width, height, 'contain' or 'cover'),
+# twice the CSS size for high-density screens
+app.config['IMAGE_PRESETS'] = {
+    'thumb': (200, 200, 'contain'),
+    'inline': (400, 400, 'contain'),
+    'card': (720, 720, 'contain'),
+}
+app.config['IMAGE_PREGENERATE'] = ['thumb', 'inline', 'card']  # made as soon as a file is uploaded
+app.config['IMAGE_VARIANT_FOLDER'] = os.getenv('IMAGE_VARIANT_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], '.variants'))
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))  # resize threads per worker process
+# Encodings sent to browsers that accept them, when smaller than the JPEG/PNG; those Pillow cannot write are skipped
+app.config['IMAGE_FORMATS'] = [fmt for fmt in os.getenv('IMAGE_FORMATS', 'avif,webp').split(',') if fmt]
+app.config['IMAGE_ENCODE_WORKERS'] = int(os.getenv('IMAGE_ENCODE_WORKERS', 1))  # encoder processes per worker process
+app.config['APP_RELEASE'] = os.getenv('APP_RELEASE')  # part of every ETag; defaults to the newest template mtime
+app.config['POSTS_PER_PAGE'] = int(os.getenv('POSTS_PER_PAGE', 12))
+app.config['ADMIN_PER_PAGE'] = int(os.getenv('ADMIN_PER_PAGE', 24))
+app.config['SEARCH_PER_PAGE'] = int(os.getenv('SEARCH_PER_PAGE', 10))
+app.config['SEARCH_MAX_PAGES'] = int(os.getenv('SEARCH_MAX_PAGES', 50))
+# 'database' uses SQLite FTS5 / MySQL FULLTEXT; 'bm25' uses the in-process index (needs numpy)
+app.config['SEARCH_BACKEND'] = os.getenv('SEARCH_BACKEND', 'database')
+app.config['SEARCH_INDEX_PATH'] = os.getenv('SEARCH_INDEX_PATH', os.path.join(app.instance_path, 'search-index'))
+app.config['AUTOCOMPLETE_LIMIT'] = 20
+app.config['AUTOCOMPLETE_MAX_AGE'] = int(os.getenv('AUTOCOMPLETE_MAX_AGE', 300))  # seconds
+# Cache backend for every namespace ('memory' per worker, 'sqlite' shared on the host, 'redis'),
+# overridable per namespace with e.g. CACHE_BACKENDS="pages=sqlite,search=memory"
+app.config['CACHE_BACKEND'] = os.getenv('CACHE_BACKEND', 'memory')
+app.config['CACHE_BACKENDS'] = dict(
+    item.split('=', 1) for item in os.getenv('CACHE_BACKENDS', '').split(',') if '=' in item
+)
+app.config['CACHE_PATH'] = os.getenv('CACHE_PATH', os.path.join(app.instance_path, 'cache.sqlite3'))
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/1')
+app.config['SEARCH_CACHE_BYTES'] = int(os.getenv('SEARCH_CACHE_BYTES', 4 * 1024 * 1024))  # 0 disables
+app.config['FUZZY_MIN_HITS'] = int(os.getenv('FUZZY_MIN_HITS', 3))
+app.config['FUZZY_MAX_AGE'] = int(os.getenv('FUZZY_MAX_AGE', 600))  # seconds
+app.config['PAGE_CACHE_BYTES'] = int(os.getenv('PAGE_CACHE_BYTES', 16 * 1024 * 1024))  # 0 disables
+app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 60))  # seconds
+app.config['PAGE_CACHE_STALE'] = int(os.getenv('PAGE_CACHE_STALE', 300))  # served while refreshing in the background
+app.config['PAGE_CACHE_GRACE'] = int(os.getenv('PAGE_CACHE_GRACE', 3600))  # served while the database is failing
+app.config['FRAGMENT_CACHE_BYTES'] = int(os.getenv('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024))  # rendered post cards and bodies; 0 disables
+# Tells the other workers about post writes: 'sqlite' (a change log on this host), 'redis' (pub/sub) or '' off
+app.config['INVALIDATION_BUS'] = os.getenv('INVALIDATION_BUS', 'sqlite')
+app.config['INVALIDATION_LOG_PATH'] = os.getenv('INVALIDATION_LOG_PATH', os.path.join(app.instance_path, 'invalidation.sqlite3'))
+app.config['INVALIDATION_REDIS_URL'] = os.getenv('INVALIDATION_REDIS_URL', 'redis://localhost:6379/0')
+app.config['INVALIDATION_POLL_INTERVAL'] = float(os.getenv('INVALIDATION_POLL_INTERVAL', 0))  # seconds between polls
+# Edge cache (Varnish with xkey) in front of the app: pages are tagged with surrogate keys and
+# each post write sends one batched PURGE per node, e.g. SURROGATE_CACHE_NODES=http://127.0.0.1:6081/
+app.config['SURROGATE_CACHE_NODES'] = [node for node in os.getenv('SURROGATE_CACHE_NODES', '').split(',') if node]
+app.config['SURROGATE_KEY_HEADER'] = os.getenv('SURROGATE_KEY_HEADER', 'xkey')
+app.config['SURROGATE_PURGE_METHOD'] = os.getenv('SURROGATE_PURGE_METHOD', 'PURGE')
+app.config['SURROGATE_PURGE_HEADER'] = os.getenv('SURROGATE_PURGE_HEADER', 'xkey-purge')
+app.config['SURROGATE_MAX_AGE'] = int(os.getenv('SURROGATE_MAX_AGE', 0))  # seconds the edge may keep anonymous pages
+# Background jobs (`flask run-jobs`): 'database', 'redis' or '' to run them inline in the request
+app.config['JOBS_BACKEND'] = os.getenv('JOBS_BACKEND', 'database')
+app.config['JOBS_REDIS_URL'] = os.getenv('JOBS_REDIS_URL', 'redis://localhost:6379/2')
+app.config['JOBS_EAGER'] = os.getenv('JOBS_EAGER', '') == '1'  # run queued jobs inline anyway, e.g. in development
+app.config['JOBS_THREADS'] = int(os.getenv('JOBS_THREADS', 4))  # 'io' jobs at once per worker
+app.config['JOBS_PROCESSES'] = int(os.getenv('JOBS_PROCESSES', os.cpu_count() or 1))  # 'cpu' jobs at once per worker
+app.config['JOBS_LEASE'] = int(os.getenv('JOBS_LEASE', 600))  # seconds before a running job is presumed lost
+app.config['JOBS_RETRY_BACKOFF'] = int(os.getenv('JOBS_RETRY_BACKOFF', 30))  # seconds, doubled per attempt
+app.config['CONTACT_EMAIL'] = os.getenv('CONTACT_EMAIL', 'info@pikngo.example')
+app.config['PASSWORD_RESET_MAX_AGE'] = int(os.getenv('PASSWORD_RESET_MAX_AGE', 3600))  # seconds a reset link works
+# Outgoing email is queued in the outbox table and sent by `flask send-mail`; with no MAIL_SERVER it is logged
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', '')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 25))
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', '') == '1'  # STARTTLS
+app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', 'no-reply@pikngo.example')
+app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 50))  # messages claimed at a time
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv('MAIL_MAX_ATTEMPTS', 8))
+app.config['MAIL_RETRY_BACKOFF'] = int(os.getenv('MAIL_RETRY_BACKOFF', 30))  # seconds, doubled per attempt
+app.config['MAIL_LEASE'] = int(os.getenv('MAIL_LEASE', 300))  # seconds before a message being sent is presumed lost
+app.config['MAIL_BREAKER_THRESHOLD'] = int(os.getenv('MAIL_BREAKER_THRESHOLD', 5))  # failures in a row that pause sending
+app.config['MAIL_BREAKER_RESET'] = int(os.getenv('MAIL_BREAKER_RESET', 60))  # seconds paused before trying again
+# New posts are emailed to subscribers by the send_newsletter job, over MAIL_SERVER
+app.config['NEWSLETTER_CONNECTIONS'] = int(os.getenv('NEWSLETTER_CONNECTIONS', 4))  # SMTP connections sending at once
+app.config['NEWSLETTER_RATE'] = float(os.getenv('NEWSLETTER_RATE', 200))  # messages a second across them; 0 for no limit
+app.config['NEWSLETTER_BATCH_SIZE'] = int(os.getenv('NEWSLETTER_BATCH_SIZE', 100))  # subscribers per query and checkpoint
+app.config['NEWSLETTER_CONFIRM_MAX_AGE'] = int(os.getenv('NEWSLETTER_CONFIRM_MAX_AGE', 3 * 86400))  # seconds a confirmation link works
+app.config['NEWSLETTER_CONFIRM_INTERVAL'] = int(os.getenv('NEWSLETTER_CONFIRM_INTERVAL', 3600))  # least seconds between confirmation emails to one address
+app.config['NEWSLETTER_JOB_SECONDS'] = int(os.getenv('NEWSLETTER_JOB_SECONDS', 120))  # then the rest is queued as a new job
 
 # Initialize extensions
 ckeditor = CKEditor(app)
 csrf = CSRFProtect(app)
 db.init_app(app)
+register_commands(app)
+init_autocomplete(app)
+init_fuzzy(app)
+init_search_cache(app)
+init_page_cache(app)
+init_fragment_cache(app)
+init_media_cache(app)
+init_images(app)
+init_invalidation(app)
+init_surrogate(app)
+init_jobs(app)
+init_mail(app)
+init_newsletter(app)
 
 # Configure login manager
 login_manager = LoginManager()
@@ -0,0 +1,154 @@
+# autocomplete.py
+
+import threading
+import time
+from bisect import bisect_left, insort
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Content
+from signals import content_changed
+
+
+def _normalize(text):
+    return ' '.join(text.lower().split())
+
+
+class TitleIndex:
+    """Sorted array of normalized title suffixes for prefix lookups with bisect.
+
+    Every word start of a title is a key, so "butter" finds "Peanut butter".
+    Lookups are a binary search plus a short forward scan.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []   # sorted (key, title, id)
+        self._by_id = {}  # id -> the keys added for it
+        self._replay = None  # changes made since begin_rebuild(), as (id, title or None)
+        self.rebuild_lock = threading.Lock()  # held while a rebuild runs
+        self.built_at = 0.0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _entries(self, content_id, title):
+        words = _normalize(title).split(' ')
+        return [(' '.join(words[i:]), title, content_id) for i in range(len(words)) if words[i]]
+
+    def begin_rebuild(self):
+        """Remember changes from now on, to apply over the rows rebuild() is about to be given."""
+        with self._lock:
+            self._replay = []
+
+    def rebuild(self, rows):
+        """Replace the index with (id, title) rows."""
+        keys, by_id = [], {}
+        for content_id, title in rows:
+            entries = self._entries(content_id, title)
+            keys.extend(entries)
+            by_id[content_id] = entries
+        keys.sort()
+        with self._lock:
+            self._keys, self._by_id = keys, by_id
+            # The rows may have been read before these changes were made
+            for content_id, title in self._replay or ():
+                self._remove_locked(content_id)
+                if title is not None:
+                    self._add_locked(content_id, title)
+            self._replay = None
+            self.built_at = time.monotonic()
+
+    def add(self, content_id, title):
+        with self._lock:
+            self._remove_locked(content_id)
+            self._add_locked(content_id, title)
+            if self._replay is not None:
+                self._replay.append((content_id, title))
+
+    def remove(self, content_id):
+        with self._lock:
+            self._remove_locked(content_id)
+            if self._replay is not None:
+                self._replay.append((content_id, None))
+
+    def _add_locked(self, content_id, title):
+        entries = self._entries(content_id, title)
+        for entry in entries:
+            insort(self._keys, entry)
+        self._by_id[content_id] = entries
+
+    def _remove_locked(self, content_id):
+        for entry in self._by_id.pop(content_id, ()):
+            i = bisect_left(self._keys, entry)
+            if i < len(self._keys) and self._keys[i] == entry:
+                del self._keys[i]
+
+    def suggest(self, prefix, limit=8):
+        """Return up to `limit` (id, title) pairs whose title has a word starting with `prefix`."""
+        prefix = _normalize(prefix)
+        if not prefix:
+            return []
+        results, seen = [], set()
+        with self._lock:
+            keys = self._keys
+            i = bisect_left(keys, (prefix,))
+            while i < len(keys) and len(results) < limit:
+                key, title, content_id = keys[i]
+                if not key.startswith(prefix):
+                    break
+                if content_id not in seen:
+                    seen.add(content_id)
+                    results.append((content_id, title))
+                i += 1
+        return results
+
+
+def _rebuild(app, index):
+    with app.app_context():
+        index.begin_rebuild()
+        index.rebuild(db.session.query(Content.id, Content.title).all())
+
+
+def _rebuild_in_background(app, index):
+    # The caller holds index.rebuild_lock; released when the thread is done
+    def run():
+        try:
+            _rebuild(app, index)
+        except SQLAlchemyError as error:
+            # Keep serving the old index; the next lookup tries again
+            app.logger.warning('Rebuilding the title index failed: %s', error)
+        finally:
+            index.rebuild_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_title_index(app):
+    """Return the app's title index, rebuilding it from the database when it is older than AUTOCOMPLETE_MAX_AGE.
+
+    Writes in this worker update the index immediately; the periodic rebuild
+    picks up writes made by other workers. Only the first lookup waits for
+    a build: later rebuilds run on one background thread while lookups keep
+    using the current index.
+    """
+    index = app.extensions['autocomplete']
+    if not index.built_at:
+        with index.rebuild_lock:
+            if not index.built_at:
+                _rebuild(app, index)
+    elif time.monotonic() - index.built_at > app.config['AUTOCOMPLETE_MAX_AGE'] and index.rebuild_lock.acquire(blocking=False):
+        _rebuild_in_background(app, index)
+    return index
+
+
+def _apply_changes(app, changes, **extra):
+    index = app.extensions['autocomplete']
+    for change in changes:
+        if change.op == 'delete':
+            index.remove(change.id)
+        else:
+            index.add(change.id, change.title)
+
+
+def init_autocomplete(app):
+    app.extensions['autocomplete'] = TitleIndex()
+    content_changed.connect(_apply_changes, sender=app, weak=False)
@@ -0,0 +1,273 @@
+# bm25.py
+
+import fcntl
+import json
+import os
+import shutil
+import time
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+
+# Terms are stored as fixed-width byte strings so the vocabulary can be
+# binary-searched straight from the memory-mapped file
+TERM_BYTES = 32
+SEGMENT_FILES = ('terms', 'offsets', 'postings', 'freqs', 'doc_ids', 'doc_lens')
+
+
+def _term_key(term):
+    return term.encode('utf-8')[:TERM_BYTES]
+
+
+@contextmanager
+def _log_lock(path, exclusive=False):
+    # Appends share it; a rebuild holds it alone while it switches segments,
+    # so no entry lands in a log after that log has been carried over
+    with open(os.path.join(path, 'LOCK'), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+class Bm25Index:
+    """BM25 inverted index persisted as memory-mapped NumPy arrays.
+
+    The bulk of the index is an immutable segment written by `build`. Every
+    worker maps the same files read-only, so the pages are shared and loading
+    costs a few `open` calls. Later upserts and deletes are appended to the
+    segment's `delta.log` and replayed by every worker before it searches, so
+    all workers see each change without re-reading the database. A rebuild
+    carries over what was logged while it read its documents.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._segment = None
+        self._current_stat = None
+
+    # -- building --------------------------------------------------------
+
+    @classmethod
+    def build(cls, path, documents, since=None, **kwargs):
+        """Write a new segment from (doc_id, terms) pairs and make it current.
+
+        Pass `since`, the log_position() taken before the documents were read,
+        to copy the updates logged after it into the new segment.
+        """
+        postings = {}
+        doc_ids, doc_lens = [], []
+        for slot, (doc_id, terms) in enumerate(sorted(documents, key=lambda doc: doc[0])):
+            doc_ids.append(doc_id)
+            doc_lens.append(len(terms))
+            for term, freq in Counter(_term_key(term) for term in terms).items():
+                postings.setdefault(term, []).append((slot, freq))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[term]) for term in terms], out=offsets[1:])
+        flat = [entry for term in terms for entry in postings[term]]
+        arrays = {
+            'terms': np.array(terms, dtype=f'S{TERM_BYTES}'),
+            'offsets': offsets,
+            'postings': np.array([slot for slot, _ in flat], dtype=np.int32),
+            'freqs': np.array([freq for _, freq in flat], dtype=np.float32),
+            'doc_ids': np.array(doc_ids, dtype=np.int64),
+            'doc_lens': np.array(doc_lens, dtype=np.float32),
+        }
+
+        os.makedirs(path, exist_ok=True)
+        name = f"segment-{time.time_ns()}"
+        staging = os.path.join(path, name + '.tmp')
+        os.makedirs(staging)
+        for key, array in arrays.items():
+            np.save(os.path.join(staging, key + '.npy'), array)
+        open(os.path.join(staging, 'delta.log'), 'a').close()
+        os.replace(staging, os.path.join(path, name))
+
+        # Switch CURRENT atomically, then drop segments nobody can open any more
+        pointer = os.path.join(path, 'CURRENT')
+        with _log_lock(path, exclusive=True):
+            previous = cls._current_name(path)
+            with open(pointer + '.tmp', 'w') as handle:
+                handle.write(name)
+            os.replace(pointer + '.tmp', pointer)
+            if since is not None and previous is not None:
+                # Replaying an update the documents already had changes nothing
+                start = since[1] if since[0] == previous else 0
+                with open(os.path.join(path, previous, 'delta.log'), 'rb') as handle:
+                    handle.seek(start)
+                    tail = handle.read()
+                with open(os.path.join(path, name, 'delta.log'), 'ab') as handle:
+                    handle.write(tail)
+        for entry in os.listdir(path):
+            if entry.startswith('segment-') and entry != name:
+                shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+        return cls(path, **kwargs)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'CURRENT'))
+
+    @staticmethod
+    def _current_name(path):
+        try:
+            with open(os.path.join(path, 'CURRENT')) as handle:
+                return handle.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def log_position(self):
+        """Return (segment, bytes logged so far) for build(since=...), or None without an index."""
+        if not self.exists():
+            return None
+        with _log_lock(self.path):
+            name = self._current_name(self.path)
+            if name is None:
+                return None
+            return name, os.path.getsize(os.path.join(self.path, name, 'delta.log'))
+
+    # -- incremental updates ---------------------------------------------
+
+    def upsert(self, doc_id, terms):
+        self._append({'op': 'upsert', 'id': doc_id, 'tf': Counter(terms), 'len': len(terms)})
+
+    def delete(self, doc_id):
+        self._append({'op': 'delete', 'id': doc_id})
+
+    def _append(self, entry):
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        with _log_lock(self.path):
+            segment = self._refresh()
+            # One O_APPEND write per entry keeps lines from concurrent workers whole
+            fd = os.open(segment['log'], os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    # -- loading ---------------------------------------------------------
+
+    def _refresh(self, retry=True):
+        """Map the current segment if it changed and replay new delta entries."""
+        try:
+            return self._load()
+        except FileNotFoundError:
+            # A rebuild swapped segments between reading CURRENT and opening it
+            if not retry:
+                raise
+            self._segment = None
+            return self._refresh(retry=False)
+
+    def _load(self):
+        pointer = os.path.join(self.path, 'CURRENT')
+        stat = os.stat(pointer)
+        current = (stat.st_ino, stat.st_mtime_ns)
+        if self._segment is None or current != self._current_stat:
+            with open(pointer) as handle:
+                directory = os.path.join(self.path, handle.read().strip())
+            arrays = {
+                key: np.load(os.path.join(directory, key + '.npy'), mmap_mode='r')
+                for key in SEGMENT_FILES
+            }
+            self._segment = dict(
+                arrays,
+                log=os.path.join(directory, 'delta.log'),
+                log_offset=0,
+                stale=np.zeros(len(arrays['doc_ids']), dtype=bool),
+                total_len=float(arrays['doc_lens'].sum()),
+                live=len(arrays['doc_ids']),
+                delta={},
+            )
+            self._current_stat = current
+        self._replay(self._segment)
+        return self._segment
+
+    def _replay(self, segment):
+        size = os.path.getsize(segment['log'])
+        if size <= segment['log_offset']:
+            return
+        with open(segment['log'], 'rb') as handle:
+            handle.seek(segment['log_offset'])
+            data = handle.read(size - segment['log_offset'])
+        # Only consume complete lines; a partial one is finished by its writer
+        data = data[:data.rfind(b'\n') + 1]
+        segment['log_offset'] += len(data)
+        for line in data.splitlines():
+            entry = json.loads(line)
+            self._retire(segment, entry['id'])
+            if entry['op'] == 'upsert':
+                tf = {_term_key(term): freq for term, freq in entry['tf'].items()}
+                segment['delta'][entry['id']] = (tf, entry['len'])
+                segment['total_len'] += entry['len']
+                segment['live'] += 1
+
+    def _retire(self, segment, doc_id):
+        """Forget the indexed version of `doc_id`, wherever it currently lives."""
+        previous = segment['delta'].pop(doc_id, None)
+        if previous is not None:
+            segment['total_len'] -= previous[1]
+            segment['live'] -= 1
+            return
+        doc_ids = segment['doc_ids']
+        slot = int(np.searchsorted(doc_ids, doc_id))
+        if slot < len(doc_ids) and doc_ids[slot] == doc_id and not segment['stale'][slot]:
+            segment['stale'][slot] = True
+            segment['total_len'] -= float(segment['doc_lens'][slot])
+            segment['live'] -= 1
+
+    # -- querying --------------------------------------------------------
+
+    def search(self, terms, offset=0, limit=10):
+        """Return (total matches, [(doc_id, score), ...]) for one page, best first."""
+        segment = self._refresh()
+        if not segment['live']:
+            return 0, []
+        n_docs = segment['live']
+        avgdl = segment['total_len'] / n_docs
+        k1, b = self.k1, self.b
+
+        slot_parts, score_parts = [], []
+        delta_scores = Counter()
+        for term in set(_term_key(term) for term in terms):
+            slots, freqs = self._postings(segment, term)
+            if len(slots):
+                live = ~segment['stale'][slots]
+                slots, freqs = slots[live], freqs[live]
+            delta_hits = [(doc_id, tf[term], length) for doc_id, (tf, length) in segment['delta'].items() if term in tf]
+            df = len(slots) + len(delta_hits)
+            if not df:
+                continue
+            idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+            if len(slots):
+                norm = k1 * (1 - b + b * segment['doc_lens'][slots] / avgdl)
+                slot_parts.append(slots)
+                score_parts.append(idf * freqs * (k1 + 1) / (freqs + norm))
+            for doc_id, freq, length in delta_hits:
+                delta_scores[doc_id] += idf * freq * (k1 + 1) / (freq + k1 * (1 - b + b * length / avgdl))
+
+        # Sum per document over only the postings touched by the query
+        if slot_parts:
+            matched, inverse = np.unique(np.concatenate(slot_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        else:
+            matched, scores = np.empty(0, dtype=np.int32), np.empty(0)
+        total = len(matched) + len(delta_scores)
+        wanted = offset + limit
+        if len(matched) > wanted:
+            # Only the best `wanted` base documents can appear on this page
+            best = np.argpartition(-scores, wanted - 1)[:wanted]
+            matched, scores = matched[best], scores[best]
+        doc_ids = segment['doc_ids'][matched]
+        ranked = list(zip(doc_ids.tolist(), scores.tolist()))
+        ranked.extend((doc_id, float(score)) for doc_id, score in delta_scores.items())
+        ranked.sort(key=lambda hit: (-hit[1], -hit[0]))
+        return total, ranked[offset:wanted]
+
+    @staticmethod
+    def _postings(segment, term):
+        terms = segment['terms']
+        i = int(np.searchsorted(terms, term))
+        if i == len(terms) or terms[i] != term:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        start, end = segment['offsets'][i], segment['offsets'][i + 1]
+        return segment['postings'][start:end], segment['freqs'][start:end]
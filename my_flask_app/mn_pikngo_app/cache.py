@@ -0,0 +1,330 @@
+# cache.py
+#
+# Interchangeable cache backends with one interface:
+#
+#     get(key, default=None)
+#     set(key, value, size=None, ttl=None) -> bool
+#     delete(key), clear(), stats()
+#
+# Each instance serves one namespace ("search", "pages", ...) and counts
+# its own hits, misses and evictions. Pick the backend per namespace with
+# CACHE_BACKEND / CACHE_BACKENDS; see make_cache.
+
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+# Bytes charged per memory cache entry on top of its key and value: the
+# entry tuple and its OrderedDict slot, rounded up
+ENTRY_OVERHEAD = 200
+
+
+def stored_form(key, value):
+    """Return (what LRUCache keeps, whether it is pickled, bytes it takes).
+
+    Strings and bytes are kept as they are; anything else is pickled, since
+    a live object can take several times its pickled size. The bytes are
+    what the kept objects actually occupy, so the cap holds.
+    """
+    if isinstance(value, (bytes, str)):
+        kept, pickled = value, False
+    else:
+        kept, pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL), True
+    return kept, pickled, sys.getsizeof(key) + sys.getsizeof(kept) + ENTRY_OVERHEAD
+
+
+def _expiry(ttl):
+    return time.time() + ttl if ttl else None
+
+
+class LRUCache:
+    """Thread-safe LRU cache holding at most `max_bytes` bytes.
+
+    Values set without a `size` are kept in their stored_form() and charged
+    what it occupies; unpickling a hit is cheap next to what it saves.
+    Callers passing `size` (for values that are mostly one bytes object)
+    vouch for it themselves.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, max_bytes, namespace='default'):
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expires, pickled)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[2] is not None and entry[2] <= time.time():
+                self._discard_locked(key)
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value, pickled = entry[0], entry[3]
+        return pickle.loads(value) if pickled else value
+
+    def set(self, key, value, size=None, ttl=None):
+        if size is None:
+            value, pickled, size = stored_form(key, value)
+        else:
+            pickled = False
+        with self._lock:
+            self._discard_locked(key)
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size, _expiry(ttl), pickled)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._discard_locked(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'namespace': self.namespace,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SqliteCache:
+    """Cache in a SQLite file, shared by every worker on the host.
+
+    Namespaces share the file but each keeps under its own `max_bytes`,
+    dropping its oldest writes first; reads do not reorder entries, so a
+    hit costs one primary-key SELECT. Each namespace's total size is kept
+    in a row of its own, updated in the transaction that changes it, so a
+    write never sums the entries. Counters are per process.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path, max_bytes, namespace='default'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, '
+            'written INTEGER NOT NULL, expires REAL, PRIMARY KEY (namespace, key))'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_entries_written ON entries (namespace, written)')
+        connection.execute('CREATE TABLE IF NOT EXISTS totals (namespace TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        # Summed once, for entries written before the total was kept
+        connection.execute(
+            'INSERT OR IGNORE INTO totals (namespace, size) '
+            'SELECT ?, COALESCE(SUM(size), 0) FROM entries WHERE namespace = ?',
+            (self.namespace, self.namespace),
+        )
+
+    def _connection(self):
+        # Connections must not cross a fork, so they are per process and thread
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM entries WHERE namespace = ?', (self.namespace,)
+        ).fetchone()[0]
+
+    @property
+    def size(self):
+        return self._connection().execute(
+            'SELECT size FROM totals WHERE namespace = ?', (self.namespace,)
+        ).fetchone()[0]
+
+    def _remove(self, connection, key):
+        # Inside a write transaction; returns the bytes freed
+        row = connection.execute(
+            'SELECT size FROM entries WHERE namespace = ? AND key = ?', (self.namespace, key)
+        ).fetchone()
+        if row is None:
+            return 0
+        connection.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (self.namespace, key))
+        return row[0]
+
+    def get(self, key, default=None):
+        row = self._connection().execute(
+            'SELECT value, expires FROM entries WHERE namespace = ? AND key = ?', (self.namespace, repr(key))
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, size=None, ttl=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(data) if size is None else size
+        if size > self.max_bytes:
+            self.delete(key)
+            return False
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            total = self.size - self._remove(connection, repr(key)) + size
+            connection.execute(
+                'INSERT INTO entries (namespace, key, value, size, written, expires) VALUES (?, ?, ?, ?, ?, ?)',
+                (self.namespace, repr(key), data, size, time.time_ns(), _expiry(ttl)),
+            )
+            while total > self.max_bytes:
+                oldest_key = connection.execute(
+                    'SELECT key FROM entries WHERE namespace = ? ORDER BY written LIMIT 1', (self.namespace,)
+                ).fetchone()[0]
+                total -= self._remove(connection, oldest_key)
+                self.evictions += 1
+            connection.execute('UPDATE totals SET size = ? WHERE namespace = ?', (total, self.namespace))
+        return True
+
+    def delete(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            freed = self._remove(connection, repr(key))
+            if freed:
+                connection.execute(
+                    'UPDATE totals SET size = size - ? WHERE namespace = ?', (freed, self.namespace)
+                )
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM entries WHERE namespace = ?', (self.namespace,))
+            connection.execute('UPDATE totals SET size = 0 WHERE namespace = ?', (self.namespace,))
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'namespace': self.namespace,
+            'entries': len(self),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class RedisCache:
+    """Cache in Redis, shared by every worker that can reach the server; needs the `redis` package.
+
+    Memory is bounded by the server (set maxmemory and an allkeys-lru
+    policy), which does not count evictions per namespace; stats() reports
+    the server-wide count from INFO as `server_evictions`.
+    """
+
+    backend = 'redis'
+
+    def __init__(self, url, namespace='default', prefix='pikngo'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.prefix = f'{prefix}:{namespace}:'
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return self.prefix + repr(key)
+
+    def get(self, key, default=None):
+        data = self.client.get(self._key(key))
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value, size=None, ttl=None):
+        self.client.set(self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=ttl or None)
+        return True
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*', count=500))
+        for start in range(0, len(keys), 500):
+            self.client.delete(*keys[start:start + 500])
+
+    def stats(self):
+        info = self.client.info('stats')
+        return {
+            'backend': self.backend,
+            'namespace': self.namespace,
+            'hits': self.hits,
+            'misses': self.misses,
+            'server_evictions': info.get('evicted_keys', 0),  # every namespace and client
+        }
+
+
+def make_cache(config, namespace, max_bytes):
+    """Create the cache for `namespace`, or None when `max_bytes` is 0.
+
+    CACHE_BACKENDS maps namespaces to a backend and CACHE_BACKEND is the
+    default: 'memory' (per worker), 'sqlite' (a file at CACHE_PATH shared
+    by the workers on one host) or 'redis' (CACHE_REDIS_URL).
+    """
+    if not max_bytes:
+        return None
+    kind = config.get('CACHE_BACKENDS', {}).get(namespace) or config.get('CACHE_BACKEND', 'memory')
+    if kind == 'memory':
+        return LRUCache(max_bytes, namespace)
+    if kind == 'sqlite':
+        return SqliteCache(config['CACHE_PATH'], max_bytes, namespace)
+    if kind == 'redis':
+        return RedisCache(config['CACHE_REDIS_URL'], namespace)
+    raise ValueError(f"Unknown cache backend {kind!r} for {namespace!r}")
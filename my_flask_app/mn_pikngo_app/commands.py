@@ -0,0 +1,169 @@
+# commands.py
+
+import os
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from images import encode_images
+from imageinfo import describe
+from jobs import Worker, enqueue
+from mail import Sender
+from newsletter import send_newsletter
+from models import db, Content, Newsletter, StoredFile
+from search import rebuild_index
+from storage import prune, relative_path
+from summary import summarize
+
+
+@click.command('backfill-summaries')
+@click.option('--batch-size', default=500, show_default=True, help='Rows updated per commit.')
+@click.option('--all', 'refresh_all', is_flag=True, help='Recompute rows that already have a summary.')
+@with_appcontext
+def backfill_summaries(batch_size, refresh_all):
+    """Fill excerpt, word count and reading time for existing posts."""
+    last_id, updated = 0, 0
+    while True:
+        query = Content.query.filter(Content.id > last_id)
+        if not refresh_all:
+            query = query.filter(Content.word_count.is_(None))
+        batch = query.order_by(Content.id).limit(batch_size).all()
+        if not batch:
+            break
+        for content in batch:
+            content.excerpt, content.word_count, content.reading_time = summarize(content.body)
+        last_id = batch[-1].id
+        updated += len(batch)
+        db.session.commit()
+        # Drop the committed rows (and their bodies) before the next batch
+        db.session.expunge_all()
+    click.echo(f"Updated {updated} post(s).")
+
+
+@click.command('backfill-image-info')
+@click.option('--batch-size', default=100, show_default=True, help='Rows updated per commit.')
+@with_appcontext
+def backfill_image_info(batch_size):
+    """Record the dimensions and placeholder of images uploaded before they were measured."""
+    folder = current_app.config['UPLOAD_FOLDER']
+    last_name, measured = '', 0
+    while True:
+        batch = (
+            StoredFile.query.filter(StoredFile.width.is_(None), StoredFile.name > last_name)
+            .order_by(StoredFile.name).limit(batch_size).all()
+        )
+        if not batch:
+            break
+        for stored in batch:
+            info = describe(os.path.join(folder, relative_path(stored.name)))
+            if info is not None:
+                stored.width, stored.height, stored.placeholder = info
+                measured += 1
+        last_name = batch[-1].name
+        db.session.commit()
+
+    last_id, updated = 0, 0
+    while True:
+        batch = (
+            Content.query.filter(Content.id > last_id, Content.image_filename.isnot(None), Content.image_width.is_(None))
+            .order_by(Content.id).limit(batch_size).all()
+        )
+        if not batch:
+            break
+        for content in batch:
+            if db.session.get(StoredFile, content.image_filename) is not None:
+                # Assigning copies the stored file's measurements; see Content._update_image_info
+                content.image_filename = content.image_filename
+                continue
+            # Saved under its original name, before uploads were recorded
+            path = os.path.join(folder, content.image_filename)
+            info = describe(path) if os.path.isfile(path) else None
+            if info is not None:
+                content.image_width, content.image_height, content.image_placeholder = info
+                content.image_size = os.path.getsize(path)
+        last_id = batch[-1].id
+        updated += len(batch)
+        db.session.commit()
+        db.session.expunge_all()
+    click.echo(f"Measured {measured} file(s); updated {updated} post(s).")
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index():
+    """Create the full-text index if needed and re-index every post."""
+    click.echo(f"Indexed {rebuild_index()} post(s).")
+
+
+@click.command('prune-uploads')
+@click.option('--min-age', default=86400, show_default=True, help='Seconds since a file was last uploaded.')
+@with_appcontext
+def prune_uploads(min_age):
+    """Delete uploaded files that no post refers to any more."""
+    click.echo(f"Removed {prune(min_age)} file(s).")
+
+
+@click.command('encode-images')
+@with_appcontext
+def encode_images_command():
+    """Encode static and uploaded images as AVIF/WebP; run at deploy time."""
+    if 'image_encoder' not in current_app.extensions:
+        raise click.ClickException('No IMAGE_FORMATS encoder: is Pillow installed?')
+    click.echo(f"Encoded {encode_images(current_app._get_current_object())} image(s).")
+
+
+@click.command('run-jobs')
+@click.option('--threads', type=int, help='Concurrent I/O-bound jobs [default: JOBS_THREADS].')
+@click.option('--processes', type=int, help='Concurrent CPU-bound jobs [default: JOBS_PROCESSES].')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+@with_appcontext
+def run_jobs(threads, processes, burst):
+    """Run queued background jobs until stopped."""
+    queue = current_app.extensions.get('job_queue')
+    if queue is None:
+        raise click.ClickException('JOBS_BACKEND is empty: jobs run inline and there is nothing to queue.')
+    config = current_app.config
+    worker = Worker(
+        current_app._get_current_object(),
+        queue,
+        threads=threads or config['JOBS_THREADS'],
+        processes=processes or config['JOBS_PROCESSES'],
+        backoff=config['JOBS_RETRY_BACKOFF'],
+    )
+    click.echo(f"Worker {worker.id} on the {queue.backend} queue.")
+    worker.run(burst=burst)
+    click.echo(f"Ran {worker.completed} job(s), {worker.failed} failed.")
+
+
+@click.command('send-mail')
+@click.option('--burst', is_flag=True, help='Exit once no message is due.')
+@with_appcontext
+def send_mail(burst):
+    """Deliver queued email from the outbox until stopped."""
+    outbox = current_app.extensions['mail_outbox']
+    sender = Sender(outbox)
+    click.echo(f"Sender {sender.id} delivering to {outbox.server or 'the log'}.")
+    sender.run(burst=burst)
+    click.echo(f"Done: {sender.stats()}")
+
+
+@click.command('resume-newsletters')
+@with_appcontext
+def resume_newsletters():
+    """Queue again every newsletter that has not reached all its subscribers."""
+    unfinished = db.session.execute(
+        db.select(Newsletter.id).where(Newsletter.status != 'done').order_by(Newsletter.id)
+    ).scalars().all()
+    for newsletter_id in unfinished:
+        enqueue(send_newsletter, newsletter_id)
+    click.echo(f"Queued {len(unfinished)} newsletter(s).")
+
+
+def register_commands(app):
+    app.cli.add_command(backfill_summaries)
+    app.cli.add_command(backfill_image_info)
+    app.cli.add_command(rebuild_search_index)
+    app.cli.add_command(prune_uploads)
+    app.cli.add_command(encode_images_command)
+    app.cli.add_command(run_jobs)
+    app.cli.add_command(send_mail)
+    app.cli.add_command(resume_newsletters)
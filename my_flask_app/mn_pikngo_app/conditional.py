@@ -0,0 +1,70 @@
+# conditional.py
+
+import hashlib
+import os
+from datetime import timezone
+from flask import current_app, request, session
+from flask_login import current_user
+
+
+def release_tag(app):
+    """Identify the deployed templates, so a deploy changes every ETag.
+
+    APP_RELEASE wins when set; otherwise the newest template mtime is used,
+    which is the same in every worker.
+    """
+    if app.config.get('APP_RELEASE'):
+        return app.config['APP_RELEASE']
+    newest = 0
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        for name in files:
+            newest = max(newest, os.stat(os.path.join(root, name)).st_mtime_ns)
+    return str(newest)
+
+
+def make_etag(*parts):
+    """Build a strong ETag from what the page depends on, including who is viewing it."""
+    app = current_app._get_current_object()
+    if 'release_tag' not in app.extensions:
+        app.extensions['release_tag'] = release_tag(app)
+    viewer = current_user.get_id() if current_user.is_authenticated else 'anonymous'
+    key = '|'.join(str(part) for part in (app.extensions['release_tag'], viewer) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _as_utc(moment):
+    if moment is not None and moment.tzinfo is None:
+        # SQLite hands back naive datetimes; everything is stored in UTC
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def not_modified(etag, last_modified=None):
+    """Return True if the client's copy is current (If-None-Match, else If-Modified-Since)."""
+    if '_flashes' in session:
+        # A pending flash message would change the page
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    last_modified = _as_utc(last_modified)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def add_validators(response, etag, last_modified=None):
+    """Attach ETag/Last-Modified and make caches revalidate before reuse."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _as_utc(last_modified)
+    response.vary.add('Cookie')
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    """An empty 304 carrying the same validators as the full response."""
+    response = current_app.response_class(status=304)
+    return add_validators(response, etag, last_modified)
@@ -1,7 +1,27 @@
 
+from sqlalchemy import inspect, text
 from app import app
 from models import db
+from search import get_backend
 
 with app.app_context():
     db.create_all()
+    # create_all skips tables that already exist, so add any columns and
+    # indexes introduced since the database was first created
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                with db.engine.begin() as connection:
+                    connection.execute(text(ddl))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as connection:
+        get_backend(connection).create(connection)
     print("Database created successfully!", "Proceed on.")
\ No newline at end of file
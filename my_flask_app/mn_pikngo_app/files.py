@@ -0,0 +1,158 @@
+# files.py
+
+import mimetypes
+import os
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import quote
+from flask import abort, current_app, request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from cache import LRUCache
+
+HotFile = namedtuple('HotFile', ['path', 'data', 'etag', 'mimetype', 'mtime', 'size', 'checked_at'])
+
+
+def resolve(directory, filename):
+    """Return the absolute path of `filename` inside `directory`, or 404."""
+    path = safe_join(os.path.join(current_app.root_path, directory), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return path
+
+
+def file_etag(path, mtime, size):
+    # The validator send_file uses, so either path revalidates the other's ETag
+    return f"{mtime}-{size}-{zlib.adler32(path.encode()) & 0xFFFFFFFF}"
+
+
+class HotFileCache:
+    """Small files held in memory, up to `max_bytes` in total.
+
+    An entry is trusted for `ttl` seconds; after that one stat checks its
+    mtime and size, and the file is read again only if they changed.
+    Files over `max_file_size` are never held.
+    """
+
+    def __init__(self, max_bytes, max_file_size, ttl):
+        self.files = LRUCache(max_bytes, 'media')
+        self.max_file_size = max_file_size
+        self.ttl = ttl
+        self.bypassed = 0
+
+    def lookup(self, directory, filename):
+        """Return the HotFile for `filename`, None if it is too big to hold, or 404."""
+        key = (directory, filename)
+        entry = self.files.get(key)
+        now = time.monotonic()
+        if entry is not None and now - entry.checked_at < self.ttl:
+            return entry
+        try:
+            path = os.path.abspath(resolve(directory, filename))
+        except NotFound:
+            self.files.delete(key)
+            raise
+        stat = os.stat(path)
+        if stat.st_size > self.max_file_size:
+            self.files.delete(key)
+            self.bypassed += 1
+            return None
+        if entry is not None and (entry.path, entry.mtime, entry.size) == (path, stat.st_mtime, stat.st_size):
+            entry = entry._replace(checked_at=now)
+        else:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                data = f.read()
+            entry = HotFile(
+                path,
+                data,
+                file_etag(path, stat.st_mtime, len(data)),
+                mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                stat.st_mtime,
+                len(data),
+                now,
+            )
+        self.files.set(key, entry, size=len(entry.data) + len(path) + 200)
+        return entry
+
+    def stats(self):
+        return dict(self.files.stats(), bypassed=self.bypassed)
+
+
+def _send_hot(entry, as_attachment, max_age):
+    response = current_app.response_class(entry.data, mimetype=entry.mimetype)
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(entry.path))
+    response.last_modified = int(entry.mtime)
+    response.set_etag(entry.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.expires = int(time.time() + max_age)
+    response.accept_ranges = 'bytes'
+    return response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+
+
+def _mark_immutable(response, immutable):
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+def _accel_uri(path):
+    # Map the file onto the nginx `internal` location that aliases its directory
+    for directory, location in current_app.config.get('MEDIA_ACCEL_LOCATIONS', {}).items():
+        directory = os.path.join(os.path.abspath(os.path.join(current_app.root_path, directory)), '')
+        if path.startswith(directory):
+            return location.rstrip('/') + '/' + quote(path[len(directory):])
+    return None
+
+
+def serve_file(directory, filename, as_attachment=False, max_age=None, immutable=False):
+    """Send a file from `directory`, letting the front server stream it when it can.
+
+    MEDIA_OFFLOAD picks how: 'x-accel' answers with an X-Accel-Redirect to
+    the nginx location in MEDIA_ACCEL_LOCATIONS, 'x-sendfile' with an
+    X-Sendfile path (Apache, lighttpd; Flask's USE_X_SENDFILE). Otherwise
+    small files come from the hot-file cache and the rest go through
+    wsgi.file_wrapper (sendfile under gunicorn), both with Range and ETag
+    support.
+    """
+    if max_age is None:
+        max_age = current_app.config.get('MEDIA_MAX_AGE', 0)
+    mode = current_app.config.get('MEDIA_OFFLOAD')
+    hot = current_app.extensions.get('media_cache')
+    if hot is not None and not mode:
+        entry = hot.lookup(directory, filename)
+        if entry is not None:
+            return _mark_immutable(_send_hot(entry, as_attachment, max_age), immutable)
+
+    path = os.path.abspath(resolve(directory, filename))
+
+    uri = _accel_uri(path) if mode == 'x-accel' else None
+    if uri is not None:
+        # nginx adds Content-Length, Range, ETag and Last-Modified itself
+        response = current_app.response_class()
+        response.headers['X-Accel-Redirect'] = uri
+        response.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(path))
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return _mark_immutable(response, immutable)
+
+    # With USE_X_SENDFILE on ('x-sendfile'), Flask sends the header instead of the bytes
+    response = send_file(path, as_attachment=as_attachment, conditional=True, etag=True, max_age=max_age)
+    response.accept_ranges = 'bytes'
+    return _mark_immutable(response, immutable)
+
+
+def init_media_cache(app):
+    """Keep small media files in memory: MEDIA_CACHE_BYTES in total (0 disables),
+    none bigger than MEDIA_CACHE_MAX_FILE, re-checked every MEDIA_CACHE_TTL seconds."""
+    if app.config.get('MEDIA_CACHE_BYTES'):
+        app.extensions['media_cache'] = HotFileCache(
+            app.config['MEDIA_CACHE_BYTES'],
+            app.config['MEDIA_CACHE_MAX_FILE'],
+            app.config['MEDIA_CACHE_TTL'],
+        )
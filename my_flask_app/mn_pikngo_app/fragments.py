@@ -0,0 +1,56 @@
+# fragments.py
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from cache import make_cache
+from conditional import release_tag
+
+
+class FragmentCacheExtension(Extension):
+    """`{% cache "card", post.id, post.last_modified %}...{% endcache %}`
+
+    Caches the rendered block under its template, line and the given key
+    parts. Put whatever the markup depends on (usually id and updated_at)
+    in the key; stale entries are never read again and age out.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None, fragment_cache_prefix='')
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        location = nodes.Const(f'{parser.name}:{lineno}')
+        call = self.call_method('_cache', [location, nodes.List(parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, location, parts, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        key = '|'.join([self.environment.fragment_cache_prefix, location] + [str(part) for part in parts])
+        html = cache.get(key)
+        if html is None:
+            html = str(caller())
+            cache.set(key, html)
+        # Rendered by our own template, so already escaped
+        return Markup(html)
+
+
+def init_fragment_cache(app):
+    """Register `{% cache %}` and its store, up to FRAGMENT_CACHE_BYTES (0 renders every time)."""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    cache = make_cache(app.config, 'fragments', app.config.get('FRAGMENT_CACHE_BYTES'))
+    if cache is None:
+        return
+    app.jinja_env.fragment_cache = cache
+    # A deploy changes the templates, and with them every key
+    app.jinja_env.fragment_cache_prefix = release_tag(app)
+    app.extensions['fragment_cache'] = cache
@@ -0,0 +1,227 @@
+# fuzzy.py
+
+import threading
+import time
+from collections import Counter
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Content
+from search import query_terms
+from signals import content_changed
+from summary import plain_text
+
+MIN_TERM_LENGTH = 3
+CANDIDATES = 25
+
+
+def trigrams(term):
+    """Trigrams of `term` padded like pg_trgm, so word starts weigh more."""
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance (adjacent swaps cost 1), or limit + 1 once it exceeds `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def max_distance(term):
+    if len(term) <= 4:
+        return 1
+    return 2 if len(term) <= 8 else 3
+
+
+class TrigramIndex:
+    """Trigram postings over the vocabulary of post titles and bodies.
+
+    Misspelled query terms are matched to vocabulary terms that share the
+    most trigrams, then re-ranked by edit distance and document frequency.
+    Each post's terms are remembered, so an edited or deleted post gives
+    back its document frequencies; terms no post uses any more stay in the
+    postings until the next rebuild but are never suggested.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._terms = []        # term id -> term
+        self._term_ids = {}     # term -> term id
+        self._df = []           # term id -> number of posts containing it
+        self._grams = {}        # trigram -> [term id, ...]
+        self._docs = {}         # post id -> its term ids
+        self.pending_ids = set()  # posts changed since the last lookup; see note()
+        self._pending_lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()  # held while a rebuild runs
+        self.built_at = 0.0
+
+    def __contains__(self, term):
+        term_id = self._term_ids.get(term)
+        return term_id is not None and self._df[term_id] > 0
+
+    def rebuild(self, documents):
+        """Replace the vocabulary with `documents`, (post id, term list) pairs."""
+        fresh = TrigramIndex()
+        for content_id, terms in documents:
+            fresh._add_locked(content_id, terms)
+        with self._lock:
+            self._terms, self._term_ids = fresh._terms, fresh._term_ids
+            self._df, self._grams, self._docs = fresh._df, fresh._grams, fresh._docs
+            self.built_at = time.monotonic()
+
+    def note(self, ids):
+        """Mark posts as changed; safe from any thread, e.g. an after_commit hook."""
+        with self._pending_lock:
+            self.pending_ids.update(ids)
+
+    def take_pending(self):
+        """Return the posts noted since the last call and start a new set."""
+        with self._pending_lock:
+            ids, self.pending_ids = self.pending_ids, set()
+        return ids
+
+    def add(self, content_id, terms):
+        """Add one post's terms, replacing any it was added with before."""
+        with self._lock:
+            self._remove_locked(content_id)
+            self._add_locked(content_id, terms)
+
+    def remove(self, content_id):
+        with self._lock:
+            self._remove_locked(content_id)
+
+    def _add_locked(self, content_id, terms):
+        term_ids = []
+        for term in set(terms):
+            if len(term) < MIN_TERM_LENGTH or term.isdigit():
+                continue
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                term_id = self._term_ids[term] = len(self._terms)
+                self._terms.append(term)
+                self._df.append(0)
+                for gram in trigrams(term):
+                    self._grams.setdefault(gram, []).append(term_id)
+            self._df[term_id] += 1
+            term_ids.append(term_id)
+        self._docs[content_id] = tuple(term_ids)
+
+    def _remove_locked(self, content_id):
+        for term_id in self._docs.pop(content_id, ()):
+            self._df[term_id] -= 1
+
+    def correct(self, term):
+        """Return the closest known term to `term`, or None if nothing is close enough."""
+        if term in self or len(term) < MIN_TERM_LENGTH:
+            return None
+        limit = max_distance(term)
+        with self._lock:
+            shared = Counter()
+            for gram in trigrams(term):
+                shared.update(term_id for term_id in self._grams.get(gram, ()) if self._df[term_id])
+            candidates = [
+                (self._terms[term_id], self._df[term_id])
+                for term_id, _ in shared.most_common(CANDIDATES)
+            ]
+        best = None
+        for candidate, df in candidates:
+            distance = edit_distance(term, candidate, limit)
+            if distance <= limit and (best is None or (distance, -df) < best[0]):
+                best = ((distance, -df), candidate)
+        return best[1] if best else None
+
+    def correct_query(self, query):
+        """Return `query` with unknown terms replaced by close ones, or None if nothing changed."""
+        terms = query_terms(query)
+        corrected = [self.correct(term) or term for term in terms]
+        return ' '.join(corrected) if corrected != terms else None
+
+
+def _post_terms(title, body):
+    return query_terms(title) + query_terms(plain_text(body))
+
+
+def _documents(batch_size):
+    # Keyset pages read in full, so no read stays open while terms are
+    # extracted (on SQLite that would hold off every writer)
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(Content.id, Content.title, Content.body)
+            .filter(Content.id > last_id)
+            .order_by(Content.id)
+            .limit(batch_size)
+            .all()
+        )
+        for content_id, title, body in rows:
+            yield content_id, _post_terms(title, body)
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+def _rebuild(app, index, batch_size):
+    with app.app_context():
+        # Changes committed from here on are folded in after the swap
+        index.take_pending()
+        index.rebuild(_documents(batch_size))
+
+
+def _rebuild_in_background(app, index, batch_size):
+    # The caller holds index.rebuild_lock; released when the thread is done
+    def run():
+        try:
+            _rebuild(app, index, batch_size)
+        except SQLAlchemyError as error:
+            # Keep serving the old index; the next lookup tries again
+            app.logger.warning('Rebuilding the trigram index failed: %s', error)
+        finally:
+            index.rebuild_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_trigram_index(app, batch_size=500):
+    """Return the app's trigram index with the posts changed since the last lookup folded in.
+
+    Only the first lookup waits for a build. Once the index is older than
+    FUZZY_MAX_AGE, one background thread rebuilds it (picking up anything
+    the change signals missed) while lookups keep using the current one.
+    """
+    index = app.extensions['fuzzy']
+    if not index.built_at:
+        with index.rebuild_lock:
+            if not index.built_at:
+                _rebuild(app, index, batch_size)
+    elif time.monotonic() - index.built_at > app.config['FUZZY_MAX_AGE'] and index.rebuild_lock.acquire(blocking=False):
+        _rebuild_in_background(app, index, batch_size)
+    # Not during a rebuild: what it read may predate these changes, so they
+    # wait and are applied on top of the new index
+    if index.pending_ids and not index.rebuild_lock.locked():
+        ids = index.take_pending()
+        rows = db.session.query(Content.id, Content.title, Content.body).filter(Content.id.in_(ids)).all()
+        for content_id, title, body in rows:
+            index.add(content_id, _post_terms(title, body))
+        for content_id in ids - {row.id for row in rows}:  # deleted
+            index.remove(content_id)
+    return index
+
+
+def _note_changes(app, changes, **extra):
+    # Bodies cannot be read inside after_commit; load them on the next lookup
+    app.extensions['fuzzy'].note(change.id for change in changes)
+
+
+def init_fuzzy(app):
+    app.extensions['fuzzy'] = TrigramIndex()
+    content_changed.connect(_note_changes, sender=app, weak=False)
@@ -0,0 +1,37 @@
+# imageinfo.py
+
+import base64
+import io
+from collections import namedtuple
+
+PLACEHOLDER_SIZE = 16  # pixels on the long side
+
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'placeholder'])
+
+
+def describe(fp):
+    """Return the ImageInfo of an image path or file object, or None when
+    Pillow is not installed or cannot read it.
+
+    The size is as displayed, after any EXIF rotation. The placeholder is a
+    data: URI of the image shrunk to PLACEHOLDER_SIZE pixels, about a
+    hundred bytes, to inline under the real image while it loads.
+    """
+    try:
+        from PIL import Image, ImageOps, features
+    except ImportError:
+        return None
+    try:
+        with Image.open(fp) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):  # rotated a quarter turn
+                width, height = height, width
+            image.draft('RGB', (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            small = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    fmt, mimetype = ('WEBP', 'image/webp') if features.check('webp') else ('PNG', 'image/png')
+    buffer = io.BytesIO()
+    small.save(buffer, fmt, quality=40)
+    return ImageInfo(width, height, f'data:{mimetype};base64,' + base64.b64encode(buffer.getvalue()).decode())
@@ -0,0 +1,431 @@
+# images.py
+
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from flask import abort, current_app, request, url_for
+from files import resolve, serve_file
+from jobs import enqueue, task
+from signals import upload_pruned, upload_stored
+from storage import STORED_NAME, relative_path
+
+# Pillow's format names, and the save options used for each
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'GIF': {},
+    'WEBP': {'quality': 80, 'method': 4},
+}
+
+# Encodings offered to browsers that name them in Accept, and their options
+MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+ENCODE_OPTIONS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 6},
+}
+# GIFs may be animated and are left alone
+NEGOTIABLE = ('.jpg', '.jpeg', '.png')
+
+# Uploads and their derivatives start with the content hash of the upload
+HASHED = re.compile(r'^[0-9a-f]{64}(-|$)')
+
+
+def parse_variant(args, presets):
+    """Return (width, height, fit) from ?w=&h=&fit=, None without them, or 400 unless it is a preset."""
+    if 'w' not in args and 'h' not in args:
+        return None
+    try:
+        variant = (int(args.get('w', 0)), int(args.get('h', 0)), args.get('fit', 'contain'))
+    except ValueError:
+        abort(400)
+    if variant not in presets.values():
+        abort(400)
+    return variant
+
+
+def source_key(folder, filename):
+    """Hash naming a source's derivatives: the content hash of stored uploads,
+    otherwise one of the name, size and mtime so a replaced file gets new ones."""
+    match = STORED_NAME.match(filename)
+    if match is not None:
+        return match.group(1)
+    stat = os.stat(os.path.join(folder, filename))
+    return hashlib.sha256(f'{filename}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+
+def variant_path(key, variant, ext):
+    """Path of a derivative, relative to the variant folder."""
+    width, height, fit = variant
+    return os.path.join(key[:2], f'{key}-{width}x{height}-{fit}{ext}')
+
+
+def resize(source, target, variant):
+    """Write `source` scaled to `variant` to `target`, atomically. Needs Pillow.
+
+    'contain' fits the image inside the box, 'cover' fills it and crops
+    the overflow; neither enlarges a smaller image.
+    """
+    from PIL import Image, ImageOps
+
+    width, height, fit = variant
+    with Image.open(source) as image:
+        fmt = image.format
+        if fmt == 'JPEG':
+            # Let the decoder scale down by a power of two first
+            image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+        if fit == 'cover' and image.width > width and image.height > height:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, fmt, **SAVE_OPTIONS.get(fmt, {}))
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def encoded_name(source, fmt):
+    """Path of `source` encoded as `fmt`, relative to the variant folder.
+
+    Files named by content hash keep their name; others are keyed by
+    path, size and mtime so a replaced file is encoded again.
+    """
+    base = os.path.splitext(os.path.basename(source))[0]
+    if HASHED.match(base) is None:
+        stat = os.stat(source)
+        base = hashlib.sha256(f'{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    return os.path.join(base[:2], f'{base}.{fmt}')
+
+
+def encode(source, target, fmt):
+    """Write `source` as `fmt` to `target` if that is smaller; otherwise leave
+    `target` empty to record that it is not. Needs Pillow."""
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        # The encoding drops EXIF, so apply its rotation to the pixels
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, fmt.upper(), **ENCODE_OPTIONS[fmt])
+                if f.tell() >= os.path.getsize(source):
+                    f.truncate(0)
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+class Resizer:
+    """Makes derivatives on a pool of `workers` threads and keeps them under `folder`.
+
+    Derivatives are looked up on disk first. Requests for one that is being
+    made wait for that resize instead of starting another; like the page
+    cache, this holds per worker process.
+    """
+
+    def __init__(self, folder, workers=2, wait=30):
+        self.folder = folder
+        self.workers = workers
+        self.wait = wait
+        self._lock = threading.Lock()
+        self._flights = {}  # target path -> Future
+        self._pool = None
+        self._pid = None
+        self.resized = 0
+        self.joined = 0
+        self.failed = 0
+
+    def _executor(self):
+        # Threads do not survive a fork; make a pool per worker on first use
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='resize')
+        return self._pool
+
+    def submit(self, source, target, variant):
+        """Start making `target` unless it is already being made; returns the Future."""
+        with self._lock:
+            future = self._flights.get(target)
+            if future is not None:
+                self.joined += 1
+                return future
+            if os.path.exists(target):
+                # Finished between the caller's check and taking the lock
+                future = Future()
+                future.set_result(None)
+                return future
+            future = self._flights[target] = self._executor().submit(self._run, source, target, variant)
+            return future
+
+    def _run(self, source, target, variant):
+        try:
+            resize(source, target, variant)
+            self.resized += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            # The file is in place before the flight ends, so late arrivals find it
+            with self._lock:
+                self._flights.pop(target, None)
+
+    def paths(self, source_folder, filename, variant):
+        """Return (source, target, target relative to `folder`) for a derivative."""
+        ext = os.path.splitext(filename)[1].lower()
+        path = variant_path(source_key(source_folder, filename), variant, ext)
+        return os.path.join(source_folder, relative_path(filename)), os.path.join(self.folder, path), path
+
+    def derivative(self, source_folder, filename, variant):
+        """Return the derivative's path relative to `folder`, making it if needed.
+        Raises if the source cannot be resized or it takes longer than `wait`."""
+        source, target, path = self.paths(source_folder, filename, variant)
+        if not os.path.exists(target):
+            self.submit(source, target, variant).result(self.wait)
+        return path
+
+    def remove(self, filename):
+        """Delete every derivative of a stored upload."""
+        key = STORED_NAME.match(filename).group(1)
+        directory = os.path.join(self.folder, key[:2])
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if HASHED.match(name[:65]) and name.startswith(key):
+                    os.unlink(os.path.join(directory, name))
+
+    def stats(self):
+        return {
+            'resized': self.resized,
+            'joined': self.joined,
+            'failed': self.failed,
+            'in_flight': len(self._flights),
+        }
+
+
+class Encoder:
+    """Keeps AVIF/WebP encodings of images under `folder`, made by a pool of `workers` processes.
+
+    Encodings are made in the background: the first request for a missing
+    one queues it and gets the original. Like the Resizer, each encoding
+    is queued once per worker process at a time.
+    """
+
+    def __init__(self, folder, formats, workers=1):
+        self.folder = folder
+        self.formats = formats
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._flights = {}  # target path -> Future
+        self._pool = None
+        self._pid = None
+        self.encoded = 0
+        self.failed = 0
+
+    def _executor(self):
+        # Spawned, not forked: forking a threaded web worker can deadlock the child
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def submit(self, source, fmt):
+        """Queue encoding `source` as `fmt` unless it is done or queued; returns the Future or None."""
+        target = os.path.join(self.folder, encoded_name(source, fmt))
+        with self._lock:
+            if target in self._flights or os.path.exists(target):
+                return self._flights.get(target)
+            future = self._flights[target] = self._executor().submit(encode, source, target, fmt)
+        future.add_done_callback(lambda done: self._finish(target, done))
+        return future
+
+    def _finish(self, target, future):
+        with self._lock:
+            self._flights.pop(target, None)
+            if future.exception() is None:
+                self.encoded += 1
+            else:
+                self.failed += 1
+
+    def encode_all(self, source):
+        """Queue every format for `source`; returns the Futures of those queued."""
+        futures = [self.submit(source, fmt) for fmt in self.formats]
+        return [future for future in futures if future is not None]
+
+    def choose(self, source, accepted):
+        """Return the smallest encoding of `source` among the `accepted` mimetypes, or None.
+        Missing encodings are queued."""
+        best, best_size = None, None
+        for fmt in self.formats:
+            if MIMETYPES[fmt] not in accepted:
+                continue
+            target = os.path.join(self.folder, encoded_name(source, fmt))
+            try:
+                size = os.path.getsize(target)
+            except FileNotFoundError:
+                self.submit(source, fmt)
+                continue
+            # Empty: not smaller than the original
+            if size and (best_size is None or size < best_size):
+                best, best_size = target, size
+        return best
+
+    def stats(self):
+        return {
+            'formats': self.formats,
+            'encoded': self.encoded,
+            'failed': self.failed,
+            'in_flight': len(self._flights),
+        }
+
+
+def serve_image(directory, filename, **kwargs):
+    """serve_file() for images, sending a smaller AVIF or WebP encoding to browsers that accept it."""
+    encoder = current_app.extensions.get('image_encoder')
+    if encoder is None or os.path.splitext(filename)[1].lower() not in NEGOTIABLE:
+        return serve_file(directory, filename, **kwargs)
+    # Exact types only: */* and image/* do not promise AVIF support
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+    encoded = encoder.choose(resolve(directory, filename), accepted)
+    if encoded is None:
+        response = serve_file(directory, filename, **kwargs)
+    else:
+        response = serve_file(encoder.folder, os.path.relpath(encoded, encoder.folder), **kwargs)
+    response.vary.add('Accept')
+    return response
+
+
+def image_url(filename, preset):
+    """URL of `filename` scaled to an IMAGE_PRESETS entry, for templates."""
+    width, height, fit = current_app.config['IMAGE_PRESETS'][preset]
+    return url_for('mn_pikngo_app.media', filename=filename, w=width, h=height, fit=fit)
+
+
+def _encode_when_resized(encoder, target):
+    def callback(future):
+        if future.exception() is None:
+            encoder.encode_all(target)
+    return callback
+
+
+@task(pool='cpu', retries=2)
+def make_variants(source, sizes, encode_folder=None, formats=()):
+    """Make the [(target, variant), ...] resized copies of `source`, then encode it
+    and them as each of `formats` into `encode_folder`."""
+    paths = [source]
+    for target, variant in sizes:
+        if not os.path.exists(target):
+            resize(source, target, variant)
+        paths.append(target)
+    for path in paths:
+        if os.path.splitext(path)[1].lower() not in NEGOTIABLE:
+            continue
+        for fmt in formats:
+            target = os.path.join(encode_folder, encoded_name(path, fmt))
+            if not os.path.exists(target):
+                encode(path, target, fmt)
+
+
+def _pregenerate(app, name, **extra):
+    resizer = app.extensions['image_resizer']
+    encoder = app.extensions.get('image_encoder')
+    if 'job_queue' in app.extensions:
+        sizes = []
+        for preset in app.config.get('IMAGE_PREGENERATE', ()):
+            variant = app.config['IMAGE_PRESETS'][preset]
+            source, target, _ = resizer.paths(app.config['UPLOAD_FOLDER'], name, variant)
+            sizes.append((target, variant))
+        source = os.path.join(app.config['UPLOAD_FOLDER'], relative_path(name))
+        if encoder is None:
+            enqueue(make_variants, source, sizes)
+        else:
+            enqueue(make_variants, source, sizes, encoder.folder, encoder.formats)
+        return
+    # No job queue: use this worker's pools; a request for one of them joins its resize
+    for preset in app.config.get('IMAGE_PREGENERATE', ()):
+        variant = app.config['IMAGE_PRESETS'][preset]
+        source, target, _ = resizer.paths(app.config['UPLOAD_FOLDER'], name, variant)
+        if not os.path.exists(target):
+            future = resizer.submit(source, target, variant)
+            if encoder is not None:
+                future.add_done_callback(_encode_when_resized(encoder, target))
+        elif encoder is not None:
+            encoder.encode_all(target)
+    if encoder is not None and os.path.splitext(name)[1] in NEGOTIABLE:
+        encoder.encode_all(os.path.join(app.config['UPLOAD_FOLDER'], relative_path(name)))
+
+
+def encode_images(app):
+    """Encode the static images, the uploads and their derivatives in every
+    IMAGE_FORMATS format that is missing, and wait; returns how many were made."""
+    encoder = app.extensions['image_encoder']
+    skip = {os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], '.tmp')), os.path.abspath(encoder.folder)}
+    sources = []
+    for folder in (app.static_folder, app.config['UPLOAD_FOLDER'], encoder.folder):
+        for root, dirs, files in os.walk(folder):
+            # The variant folder is walked on its own, wherever it is
+            dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip]
+            for name in files:
+                if os.path.splitext(name)[1].lower() in NEGOTIABLE:
+                    sources.append(os.path.join(root, name))
+    futures = [future for source in sources for future in encoder.encode_all(source)]
+    for future in futures:
+        future.exception()
+    return sum(1 for future in futures if future.exception() is None)
+
+
+def _negotiate_static(app):
+    send_static = app.view_functions['static']
+
+    def static(filename):
+        if os.path.splitext(filename)[1].lower() in NEGOTIABLE:
+            return serve_image(app.static_folder, filename)
+        return send_static(filename=filename)
+
+    app.view_functions['static'] = static
+
+
+def _remove_derivatives(app, name, **extra):
+    app.extensions['image_resizer'].remove(name)
+
+
+def init_images(app):
+    """Serve IMAGE_PRESETS sizes of uploads, made on IMAGE_WORKERS threads and kept in
+    IMAGE_VARIANT_FOLDER; IMAGE_PREGENERATE presets are made as soon as a file is uploaded.
+    Uploads, their sizes and static JPEG/PNG files are also sent as the
+    smallest IMAGE_FORMATS encoding the browser accepts. Without Pillow,
+    images are served as they are."""
+    app.add_template_global(image_url)
+    try:
+        from PIL import features
+    except ImportError:
+        app.logger.info('Pillow is not installed; images are served as they are')
+        return
+    app.extensions['image_resizer'] = Resizer(
+        app.config['IMAGE_VARIANT_FOLDER'],
+        workers=app.config.get('IMAGE_WORKERS', 2),
+    )
+    formats = [fmt for fmt in app.config.get('IMAGE_FORMATS', ()) if features.check(fmt)]
+    if formats:
+        app.extensions['image_encoder'] = Encoder(
+            app.config['IMAGE_VARIANT_FOLDER'],
+            formats,
+            workers=app.config.get('IMAGE_ENCODE_WORKERS', 1),
+        )
+        _negotiate_static(app)
+    upload_stored.connect(_pregenerate, sender=app, weak=False)
+    upload_pruned.connect(_remove_derivatives, sender=app, weak=False)
@@ -0,0 +1,179 @@
+# invalidation.py
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from signals import ContentChange, content_changed
+
+# How long published events are kept in the SQLite log
+LOG_RETENTION = 3600
+
+
+def _worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class SqliteBus:
+    """Change log in a SQLite file on the host.
+
+    Each worker remembers the last sequence number it has seen; a poll is
+    one indexed SELECT for rows above it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, op TEXT NOT NULL, '
+            'content_id INTEGER, title TEXT, created REAL NOT NULL)'
+        )
+        # Start from now: anything older is already reflected in the database
+        self.last_seq = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM events').fetchone()[0]
+
+    def _connection(self):
+        # Connections must not cross a fork, so they are per process and thread
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def publish(self, origin, changes):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(
+                'INSERT INTO events (origin, op, content_id, title, created) VALUES (?, ?, ?, ?, ?)',
+                [(origin, change.op, change.id, change.title, now) for change in changes],
+            )
+            connection.execute('DELETE FROM events WHERE created < ?', (now - LOG_RETENTION,))
+
+    def poll(self):
+        """Return [(origin, ContentChange), ...] published since the last poll."""
+        rows = self._connection().execute(
+            'SELECT seq, origin, op, content_id, title FROM events WHERE seq > ? ORDER BY seq',
+            (self.last_seq,),
+        ).fetchall()
+        if rows:
+            self.last_seq = rows[-1][0]
+        return [(origin, ContentChange(op, content_id, title)) for _, origin, op, content_id, title in rows]
+
+
+class RedisBus:
+    """Redis pub/sub channel; needs the `redis` package."""
+
+    def __init__(self, url, channel='content-changes'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._pubsub = None
+        self._pid = None
+
+    def publish(self, origin, changes):
+        message = {'origin': origin, 'changes': [list(change) for change in changes]}
+        self.client.publish(self.channel, json.dumps(message))
+
+    def poll(self):
+        if self._pid != os.getpid():
+            # Subscribe after the fork, once per worker
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(self.channel)
+            self._pid = os.getpid()
+        events = []
+        while True:
+            message = self._pubsub.get_message(timeout=0)
+            if message is None:
+                return events
+            data = json.loads(message['data'])
+            events.extend((data['origin'], ContentChange(*change)) for change in data['changes'])
+
+
+class InvalidationBus:
+    """Relays content_changed between workers.
+
+    Local commits are published; before each request the worker polls for
+    other workers' events and re-sends them as content_changed with
+    remote=True, so in-process indexes and caches apply them too.
+    """
+
+    def __init__(self, app, transport, poll_interval=0):
+        self.app = app
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._polled_at = 0.0
+        self._origin = None
+        self._pid = None
+        self.published = 0
+        self.received = 0
+
+    @property
+    def origin(self):
+        if self._pid != os.getpid():
+            self._origin, self._pid = _worker_id(), os.getpid()
+        return self._origin
+
+    def publish(self, changes):
+        try:
+            self.transport.publish(self.origin, changes)
+        except Exception as error:
+            # The write is already committed; other workers catch up on their next rebuild
+            self.app.logger.warning('Could not publish content changes: %s', error)
+            return
+        self.published += len(changes)
+
+    def poll(self):
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._polled_at = now
+            origin = self.origin
+            changes = [change for event_origin, change in self.transport.poll() if event_origin != origin]
+        except Exception as error:
+            self.app.logger.warning('Could not poll content changes: %s', error)
+            return
+        finally:
+            self._lock.release()
+        if changes:
+            self.received += len(changes)
+            content_changed.send(self.app, changes=changes, remote=True)
+
+    def stats(self):
+        return {'published': self.published, 'received': self.received}
+
+
+def _publish(app, changes, remote=False, **extra):
+    if not remote:
+        app.extensions['invalidation'].publish(changes)
+
+
+def init_invalidation(app):
+    """Share content changes between workers: INVALIDATION_BUS is 'sqlite', 'redis' or '' for none."""
+    kind = app.config.get('INVALIDATION_BUS')
+    if kind == 'sqlite':
+        transport = SqliteBus(app.config['INVALIDATION_LOG_PATH'])
+    elif kind == 'redis':
+        transport = RedisBus(app.config['INVALIDATION_REDIS_URL'])
+    elif kind:
+        raise ValueError(f"Unknown INVALIDATION_BUS {kind!r}")
+    else:
+        return
+    bus = app.extensions['invalidation'] = InvalidationBus(
+        app, transport, app.config.get('INVALIDATION_POLL_INTERVAL', 0)
+    )
+    content_changed.connect(_publish, sender=app, weak=False)
+    app.before_request(bus.poll)
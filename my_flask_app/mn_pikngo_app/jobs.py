@@ -0,0 +1,388 @@
+# jobs.py
+#
+# Durable background jobs. Functions decorated with @task are queued with
+# enqueue() and run by `flask run-jobs`:
+#
+#     @task(pool='io', retries=3)
+#     def ping(url): ...
+#
+#     enqueue(ping, 'https://example.com/')
+#
+# 'io' tasks run on a thread pool inside an app context; 'cpu' tasks run
+# on a process pool and get nothing but their (JSON) arguments.
+
+import json
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from models import db, Job
+
+Task = namedtuple('Task', ['name', 'function', 'pool', 'retries', 'priority'])
+
+# A claimed job, as handed to the worker
+ClaimedJob = namedtuple('ClaimedJob', ['id', 'name', 'args', 'kwargs', 'attempts', 'max_attempts', 'created_at'])
+
+TASKS = {}  # name -> Task
+POOLS = ('io', 'cpu')
+
+
+def task(pool='io', retries=3, priority=0):
+    """Register a function as a background task.
+
+    A failed job is retried up to `retries` times with exponential
+    backoff. Jobs with a higher `priority` are claimed first.
+    """
+    if pool not in POOLS:
+        raise ValueError(f"Unknown job pool {pool!r}")
+
+    def decorator(function):
+        registered = Task(f'{function.__module__}.{function.__qualname__}', function, pool, retries, priority)
+        TASKS[registered.name] = registered
+        function.task = registered
+        return function
+    return decorator
+
+
+def enqueue(function, *args, **kwargs):
+    """Queue a @task function call and return the job id.
+
+    The job is written in its own transaction, so it is queued even if the
+    caller's session is rolled back. With no JOBS_BACKEND, or JOBS_EAGER
+    set, the function runs before enqueue returns and the id is None.
+    """
+    if runs_inline():
+        function(*args, **kwargs)
+        return None
+    return current_app.extensions['job_queue'].push(function.task, args, kwargs)
+
+
+def runs_inline():
+    """Return whether enqueue() runs calls before returning instead of queueing them."""
+    return current_app.extensions.get('job_queue') is None or bool(current_app.config.get('JOBS_EAGER'))
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class DatabaseQueue:
+    """Jobs in the `job` table of the app's database.
+
+    A worker claims the best due job with an UPDATE conditioned on it
+    still being queued, so two workers never run the same attempt.
+    Jobs left running past `lease` seconds (a worker died) are queued
+    again.
+    """
+
+    backend = 'database'
+
+    def __init__(self, lease=600):
+        self.lease = lease
+
+    def push(self, task, args, kwargs, delay=0):
+        jobs = Job.__table__
+        with db.engine.begin() as connection:
+            result = connection.execute(jobs.insert().values(
+                name=task.name,
+                payload=json.dumps([list(args), kwargs]),
+                pool=task.pool,
+                priority=task.priority,
+                status='queued',
+                attempts=0,
+                max_attempts=task.retries + 1,
+                run_at=_now() + timedelta(seconds=delay),
+                created_at=_now(),
+            ))
+        return result.inserted_primary_key[0]
+
+    def claim(self, worker, pool):
+        """Mark the best due job in `pool` as running by `worker` and return it, or None."""
+        jobs = Job.__table__
+        now = _now()
+        with db.engine.begin() as connection:
+            candidates = connection.execute(
+                db.select(jobs.c.id)
+                .where(jobs.c.status == 'queued', jobs.c.pool == pool, jobs.c.run_at <= now)
+                .order_by(jobs.c.priority.desc(), jobs.c.run_at, jobs.c.id)
+                .limit(5)
+            ).scalars().all()
+        for job_id in candidates:
+            with db.engine.begin() as connection:
+                claimed = connection.execute(
+                    jobs.update()
+                    .where(jobs.c.id == job_id, jobs.c.status == 'queued')
+                    .values(status='running', worker=worker, started_at=now, attempts=jobs.c.attempts + 1)
+                ).rowcount
+                if claimed:
+                    row = connection.execute(db.select(jobs).where(jobs.c.id == job_id)).one()
+                    args, kwargs = json.loads(row.payload)
+                    return ClaimedJob(row.id, row.name, args, kwargs, row.attempts, row.max_attempts, row.created_at)
+            # Another worker took it first; try the next
+        return None
+
+    def _set(self, job_id, **values):
+        jobs = Job.__table__
+        with db.engine.begin() as connection:
+            connection.execute(jobs.update().where(jobs.c.id == job_id).values(**values))
+
+    def finish(self, job, duration):
+        self._set(job.id, status='done', finished_at=_now(), duration=duration, last_error=None)
+
+    def retry(self, job, duration, error, delay):
+        self._set(job.id, status='queued', run_at=_now() + timedelta(seconds=delay), duration=duration, last_error=error)
+
+    def fail(self, job, duration, error):
+        self._set(job.id, status='failed', finished_at=_now(), duration=duration, last_error=error)
+
+    def requeue_stalled(self):
+        jobs = Job.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(
+                jobs.update()
+                .where(jobs.c.status == 'running', jobs.c.started_at < _now() - timedelta(seconds=self.lease))
+                .values(status='queued')
+            ).rowcount
+
+    def stats(self):
+        jobs = Job.__table__
+        counts = dict(db.session.execute(
+            db.select(jobs.c.status, db.func.count()).group_by(jobs.c.status)
+        ).all())
+        timing = db.session.execute(
+            db.select(db.func.avg(jobs.c.duration), db.func.max(jobs.c.duration)).where(jobs.c.status == 'done')
+        ).one()
+        return {'backend': self.backend, **counts, 'avg_seconds': timing[0], 'max_seconds': timing[1]}
+
+
+class RedisQueue:
+    """Jobs in Redis; needs the `redis` package.
+
+    Each pool has a sorted set of ready job ids scored by priority then
+    arrival, popped atomically by workers. Delayed retries wait in a
+    sorted set scored by due time; running jobs in one scored by start
+    time, for the lease.
+    """
+
+    backend = 'redis'
+
+    def __init__(self, url, prefix='pikngo:jobs', lease=600):
+        import redis
+
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.lease = lease
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def _ready(self, job_id, pool, priority):
+        # Higher priority first, then first in; ids grow, so they order arrivals
+        self.client.zadd(self._key('ready', pool), {job_id: -priority * 2 ** 40 + int(job_id)})
+
+    def push(self, task, args, kwargs, delay=0):
+        job_id = str(self.client.incr(self._key('ids')))
+        self.client.hset(self._key('job', job_id), mapping={
+            'name': task.name,
+            'payload': json.dumps([list(args), kwargs]),
+            'pool': task.pool,
+            'priority': task.priority,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': task.retries + 1,
+            'created_at': time.time(),
+        })
+        if delay:
+            self.client.zadd(self._key('delayed'), {job_id: time.time() + delay})
+        else:
+            self._ready(job_id, task.pool, task.priority)
+        return int(job_id)
+
+    def _promote_due(self):
+        for job_id in self.client.zrangebyscore(self._key('delayed'), '-inf', time.time()):
+            # Only the worker whose ZREM succeeds moves it
+            if self.client.zrem(self._key('delayed'), job_id):
+                job = self.client.hmget(self._key('job', job_id), 'pool', 'priority')
+                self._ready(job_id, job[0], int(job[1]))
+
+    def claim(self, worker, pool):
+        self._promote_due()
+        popped = self.client.zpopmin(self._key('ready', pool))
+        if not popped:
+            return None
+        job_id = popped[0][0]
+        key = self._key('job', job_id)
+        self.client.hset(key, mapping={'status': 'running', 'worker': worker, 'started_at': time.time()})
+        attempts = self.client.hincrby(key, 'attempts', 1)
+        self.client.zadd(self._key('running'), {job_id: time.time()})
+        job = self.client.hgetall(key)
+        args, kwargs = json.loads(job['payload'])
+        created_at = datetime.fromtimestamp(float(job['created_at']), timezone.utc).replace(tzinfo=None)
+        return ClaimedJob(int(job_id), job['name'], args, kwargs, attempts, int(job['max_attempts']), created_at)
+
+    def _end(self, job, **values):
+        job_id = str(job.id)
+        self.client.zrem(self._key('running'), job_id)
+        self.client.hset(self._key('job', job_id), mapping={name: value for name, value in values.items() if value is not None})
+
+    def finish(self, job, duration):
+        self._end(job, status='done', duration=duration)
+        self.client.hincrby(self._key('stats'), 'done', 1)
+        self.client.hincrbyfloat(self._key('stats'), 'seconds', duration)
+        # Finished jobs are only kept long enough to inspect
+        self.client.expire(self._key('job', str(job.id)), 86400)
+
+    def retry(self, job, duration, error, delay):
+        self._end(job, status='queued', duration=duration, last_error=error)
+        self.client.zadd(self._key('delayed'), {str(job.id): time.time() + delay})
+
+    def fail(self, job, duration, error):
+        self._end(job, status='failed', duration=duration, last_error=error)
+        self.client.hincrby(self._key('stats'), 'failed', 1)
+
+    def requeue_stalled(self):
+        requeued = 0
+        for job_id in self.client.zrangebyscore(self._key('running'), '-inf', time.time() - self.lease):
+            if self.client.zrem(self._key('running'), job_id):
+                job = self.client.hmget(self._key('job', job_id), 'pool', 'priority')
+                self.client.hset(self._key('job', job_id), 'status', 'queued')
+                self._ready(job_id, job[0], int(job[1]))
+                requeued += 1
+        return requeued
+
+    def stats(self):
+        counters = self.client.hgetall(self._key('stats'))
+        done = int(counters.get('done', 0))
+        return {
+            'backend': self.backend,
+            'queued': sum(self.client.zcard(self._key('ready', pool)) for pool in POOLS),
+            'delayed': self.client.zcard(self._key('delayed')),
+            'running': self.client.zcard(self._key('running')),
+            'done': done,
+            'failed': int(counters.get('failed', 0)),
+            'avg_seconds': float(counters.get('seconds', 0)) / done if done else None,
+        }
+
+
+def _timed_call(function, args, kwargs):
+    # Runs in the pool; returns how long the call took and, if it raised, the
+    # formatted traceback (text, so it pickles whatever the exception was)
+    started = time.perf_counter()
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        return time.perf_counter() - started, traceback.format_exc().strip()
+    return time.perf_counter() - started, None
+
+
+def _call_in_app(app, function, args, kwargs):
+    with app.app_context():
+        return _timed_call(function, args, kwargs)
+
+
+class Worker:
+    """Claims jobs and runs them: up to `threads` 'io' jobs and `processes` 'cpu' jobs at once."""
+
+    def __init__(self, app, queue, threads=4, processes=2, poll_interval=1.0, backoff=30):
+        self.app = app
+        self.queue = queue
+        self.limits = {'io': threads, 'cpu': processes}
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.id = _worker_id()
+        self.completed = 0
+        self.failed = 0
+
+    def run(self, burst=False):
+        """Run jobs until interrupted, or with `burst` until none are left."""
+        executors = {
+            'io': ThreadPoolExecutor(self.limits['io'], thread_name_prefix='job'),
+            # Spawned, not forked, like the image encoder
+            'cpu': ProcessPoolExecutor(self.limits['cpu'], mp_context=multiprocessing.get_context('spawn')),
+        }
+        running = {}  # Future -> (ClaimedJob, Task)
+        checked_stalled = 0.0
+        try:
+            while True:
+                if time.monotonic() - checked_stalled > self.queue.lease / 2:
+                    self.queue.requeue_stalled()
+                    checked_stalled = time.monotonic()
+                for pool in POOLS:
+                    busy = sum(1 for _, registered in running.values() if registered.pool == pool)
+                    while busy < self.limits[pool]:
+                        job = self.queue.claim(self.id, pool)
+                        if job is None:
+                            break
+                        busy += 1
+                        future = self._start(executors, job)
+                        if future is not None:
+                            running[future] = (job, TASKS[job.name])
+                if not running:
+                    if burst:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+                done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._record(*running.pop(future), future)
+        except KeyboardInterrupt:
+            # Let the jobs already started finish; unstarted ones stay claimed until the lease runs out
+            self.app.logger.info('Stopping after %d running job(s)', len(running))
+            for future in list(running):
+                self._record(*running.pop(future), future)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+    def _start(self, executors, job):
+        registered = TASKS.get(job.name)
+        if registered is None:
+            self.queue.fail(job, 0.0, f'Unknown task {job.name!r}')
+            self.failed += 1
+            return None
+        if registered.pool == 'io':
+            return executors['io'].submit(_call_in_app, self.app, registered.function, job.args, job.kwargs)
+        return executors['cpu'].submit(_timed_call, registered.function, job.args, job.kwargs)
+
+    def _record(self, job, registered, future):
+        if future.exception() is None:
+            duration, message = future.result()
+        else:
+            # The pool itself failed (a worker process died), so the call was never timed
+            duration, message = None, ''.join(traceback.format_exception(future.exception())).strip()
+        if message is None:
+            self.queue.finish(job, duration)
+            self.completed += 1
+            return
+        error = message.splitlines()[-1]
+        if job.attempts < job.max_attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            self.app.logger.warning('Job %s %s failed (attempt %d), retrying in %ds: %s',
+                                    job.id, job.name, job.attempts, delay, error)
+            self.queue.retry(job, duration, message, delay)
+        else:
+            self.app.logger.error('Job %s %s failed for good: %s', job.id, job.name, error)
+            self.queue.fail(job, duration, message)
+            self.failed += 1
+
+
+def init_jobs(app):
+    """Queue @task calls in JOBS_BACKEND: 'database', 'redis' (JOBS_REDIS_URL) or '' to run them inline."""
+    kind = app.config.get('JOBS_BACKEND')
+    lease = app.config.get('JOBS_LEASE', 600)
+    if kind == 'database':
+        app.extensions['job_queue'] = DatabaseQueue(lease=lease)
+    elif kind == 'redis':
+        app.extensions['job_queue'] = RedisQueue(app.config['JOBS_REDIS_URL'], lease=lease)
+    elif kind:
+        raise ValueError(f"Unknown JOBS_BACKEND {kind!r}")
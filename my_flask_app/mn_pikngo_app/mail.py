@@ -0,0 +1,383 @@
+# mail.py
+#
+# Outgoing email through a transactional outbox. send_email() only adds an
+# OutboxMessage to the caller's session, so a message is queued exactly
+# when the request's transaction commits. `flask send-mail` runs a Sender
+# that delivers due messages in batches over one kept-open SMTP connection.
+
+import logging
+import smtplib
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from models import db, OutboxMessage
+from jobs import _now, _worker_id
+
+logger = logging.getLogger(__name__)
+
+
+def header_value(text):
+    """Collapse runs of whitespace, CR and LF included, so user input cannot break a header."""
+    return ' '.join(text.split())
+
+
+def send_email(to, subject, body):
+    """Queue an email in the current session; it is sent once the session commits."""
+    message = OutboxMessage(recipient=header_value(to), subject=header_value(subject), body=body)
+    db.session.add(message)
+    return message
+
+
+class CircuitBreaker:
+    """Stop calling a server that keeps failing.
+
+    After `threshold` failures in a row the breaker opens and allow() is
+    False for `reset_after` seconds. Then it is half-open: one trial call
+    is let through, and its outcome closes the breaker or opens it again.
+    """
+
+    def __init__(self, threshold=5, reset_after=60, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_after:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        return self.state != 'open'
+
+    def succeeded(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            self.opened_at = self.clock()
+            self.trips += 1
+
+
+class SMTPConnection:
+    """One SMTP session reused for every message, reopened when it drops.
+
+    A session idle for more than `max_idle` seconds is checked with NOOP
+    before use, since servers close quiet connections.
+    """
+
+    def __init__(self, host, port=25, username=None, password=None, use_tls=False, timeout=10, max_idle=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._smtp = None
+        self._used = 0.0
+        self.opened = 0
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self.opened += 1
+        return smtp
+
+    def _session(self):
+        if self._smtp is not None and time.monotonic() - self._used > self.max_idle:
+            try:
+                self._smtp.noop()
+            except OSError:
+                self.close()
+        if self._smtp is None:
+            self._smtp = self._open()
+        return self._smtp
+
+    def send(self, message):
+        try:
+            self._session().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Dropped between messages: one fresh connection, then give up
+            self.close()
+            self._session().send_message(message)
+        self._used = time.monotonic()
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except OSError:
+                self._smtp.close()
+            self._smtp = None
+
+
+class LogConnection:
+    """Stands in for SMTP when no MAIL_SERVER is configured: messages are logged."""
+
+    opened = 0
+
+    def send(self, message):
+        logger.info('Email to %s: %s\n%s', message['To'], message['Subject'], message.get_content())
+
+    def close(self):
+        pass
+
+
+def reply_codes(error):
+    """Return the SMTP reply codes behind an exception; empty when the server never answered."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return [code for code, _ in error.recipients.values()]
+    if isinstance(error, smtplib.SMTPResponseException):
+        return [error.smtp_code]
+    return []
+
+
+class Outbox:
+    """The outbox table and how to deliver it; app.extensions['mail_outbox']."""
+
+    def __init__(self, server='', port=25, username=None, password=None, use_tls=False,
+                 sender='no-reply@pikngo.example', batch_size=50, max_attempts=8, backoff=30,
+                 lease=300, breaker_threshold=5, breaker_reset=60):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.sender = sender
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+
+    def connect(self):
+        if not self.server:
+            return LogConnection()
+        return SMTPConnection(self.server, self.port, self.username, self.password, self.use_tls)
+
+    def stats(self):
+        messages = OutboxMessage.__table__
+        counts = dict(db.session.execute(
+            db.select(messages.c.status, db.func.count()).group_by(messages.c.status)
+        ).all())
+        oldest = db.session.execute(
+            db.select(db.func.min(messages.c.created_at)).where(messages.c.status == 'queued')
+        ).scalar()
+        # Sent per minute over the last ten minutes, oldest first
+        now = _now().replace(second=0, microsecond=0)
+        since = now - timedelta(minutes=9)
+        sent = Counter(
+            sent_at.replace(second=0, microsecond=0)
+            for sent_at in db.session.execute(
+                db.select(messages.c.sent_at).where(messages.c.sent_at >= since)
+            ).scalars()
+        )
+        return {
+            **counts,
+            'oldest_queued_seconds': (_now() - oldest).total_seconds() if oldest else None,
+            'sent_per_minute': [sent[since + timedelta(minutes=minute)] for minute in range(10)],
+        }
+
+
+class Sender:
+    """Delivers queued messages from the outbox.
+
+    Due messages are claimed a batch at a time with a conditional UPDATE,
+    so several senders never send the same one, and sent one by one over
+    the same connection. A message refused with a 4xx reply, or caught in
+    a connection failure, is retried with exponential backoff; one refused
+    with a 5xx reply is marked failed. Connection failures also feed a
+    CircuitBreaker: while it is open nothing is claimed, and the queue
+    simply waits for the server.
+    Delivery is at least once: a sender that dies after sending but before
+    marking the row leaves it to be sent again after `lease`.
+    """
+
+    def __init__(self, outbox, connection=None, breaker=None):
+        self.outbox = outbox
+        self.connection = connection or outbox.connect()
+        self.breaker = breaker or CircuitBreaker(outbox.breaker_threshold, outbox.breaker_reset)
+        self.id = _worker_id()
+        self.minutes = deque(maxlen=60)  # (minute, Counter of outcomes) for the last hour
+
+    def _count(self, outcome):
+        minute = int(time.time() // 60)
+        if not self.minutes or self.minutes[-1][0] != minute:
+            if self.minutes:
+                logger.info('Mail in the last minute: %s', dict(self.minutes[-1][1]))
+            self.minutes.append((minute, Counter()))
+        self.minutes[-1][1][outcome] += 1
+
+    def stats(self):
+        return {
+            'breaker': self.breaker.state,
+            'trips': self.breaker.trips,
+            'connections': self.connection.opened,
+            'per_minute': [
+                {'minute': datetime.fromtimestamp(minute * 60).strftime('%H:%M'), **outcomes}
+                for minute, outcomes in self.minutes
+            ],
+        }
+
+    def _update(self, message_id, **values):
+        messages = OutboxMessage.__table__
+        with db.engine.begin() as connection:
+            connection.execute(messages.update().where(messages.c.id == message_id).values(**values))
+
+    def _claim(self, limit):
+        messages = OutboxMessage.__table__
+        now = _now()
+        with db.engine.begin() as connection:
+            due = connection.execute(
+                db.select(messages.c.id)
+                .where(messages.c.status == 'queued', messages.c.next_attempt_at <= now)
+                .order_by(messages.c.next_attempt_at, messages.c.id)
+                .limit(limit)
+            ).scalars().all()
+            if not due:
+                return []
+            connection.execute(
+                messages.update()
+                .where(messages.c.id.in_(due), messages.c.status == 'queued')
+                .values(status='sending', claimed_by=self.id, claimed_at=now, attempts=messages.c.attempts + 1)
+            )
+            # Rows another sender took between the SELECT and the UPDATE are not ours
+            return connection.execute(
+                db.select(messages)
+                .where(messages.c.id.in_(due), messages.c.status == 'sending', messages.c.claimed_by == self.id)
+                .order_by(messages.c.id)
+            ).all()
+
+    def _release(self, rows):
+        # Claimed but never tried: back in the queue without using an attempt
+        messages = OutboxMessage.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                messages.update()
+                .where(messages.c.id.in_([row.id for row in rows]), messages.c.claimed_by == self.id)
+                .values(status='queued', claimed_by=None, attempts=messages.c.attempts - 1)
+            )
+
+    def requeue_stalled(self):
+        messages = OutboxMessage.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(
+                messages.update()
+                .where(messages.c.status == 'sending', messages.c.claimed_at < _now() - timedelta(seconds=self.outbox.lease))
+                .values(status='queued', claimed_by=None)
+            ).rowcount
+
+    def _email(self, row):
+        message = EmailMessage()
+        message['From'] = self.outbox.sender
+        message['To'] = row.recipient
+        message['Subject'] = row.subject
+        message.set_content(row.body)
+        return message
+
+    def _retry_or_fail(self, row, error, permanent=False):
+        # 5xx replies will never succeed; anything else may, until attempts run out
+        if permanent or row.attempts >= self.outbox.max_attempts:
+            logger.error('Giving up on email %s to %s: %s', row.id, row.recipient, error)
+            self._update(row.id, status='failed', claimed_by=None, last_error=str(error))
+            self._count('failed')
+        else:
+            delay = self.outbox.backoff * 2 ** (row.attempts - 1)
+            logger.warning('Email %s to %s failed (attempt %d), retrying in %ds: %s',
+                           row.id, row.recipient, row.attempts, delay, error)
+            self._update(row.id, status='queued', claimed_by=None, last_error=str(error),
+                         next_attempt_at=_now() + timedelta(seconds=delay))
+            self._count('retried')
+
+    def send_batch(self):
+        """Try one batch of due messages and return how many were tried."""
+        state = self.breaker.state
+        if state == 'open':
+            return 0
+        # Half-open: a single message decides whether the server is back
+        rows = self._claim(1 if state == 'half-open' else self.outbox.batch_size)
+        for index, row in enumerate(rows):
+            try:
+                email = self._email(row)
+            except (ValueError, TypeError) as error:
+                # A header no server would take (e.g. a line break in it); it never will be sendable
+                self._retry_or_fail(row, error, permanent=True)
+                continue
+            try:
+                self.connection.send(email)
+            except OSError as error:
+                codes = reply_codes(error)
+                if codes and 421 not in codes:
+                    # The server answered, so it is up; only this message was refused
+                    self.breaker.succeeded()
+                    self._retry_or_fail(row, error, permanent=min(codes) >= 500)
+                    continue
+                # No answer, or 421 (closing): the server itself is failing
+                self.connection.close()
+                self.breaker.failed()
+                self._retry_or_fail(row, error)
+                if not self.breaker.allow():
+                    logger.error('Mail server failing; pausing delivery for %ds', self.breaker.reset_after)
+                    self._release(rows[index + 1:])
+                    break
+                continue
+            self.breaker.succeeded()
+            self._update(row.id, status='sent', claimed_by=None, sent_at=_now(), last_error=None)
+            self._count('sent')
+        return len(rows)
+
+    def run(self, burst=False, poll_interval=5):
+        """Send until interrupted, or with `burst` until nothing is due."""
+        checked_stalled = 0.0
+        try:
+            while True:
+                if time.monotonic() - checked_stalled > self.outbox.lease / 2:
+                    self.requeue_stalled()
+                    checked_stalled = time.monotonic()
+                tried = self.send_batch()
+                if tried:
+                    continue
+                if burst:
+                    return
+                # Nothing due, or the breaker is open; idle connections are checked before reuse
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.connection.close()
+
+
+def init_mail(app):
+    """Deliver the outbox through MAIL_SERVER, or to the log when it is empty."""
+    config = app.config
+    app.extensions['mail_outbox'] = Outbox(
+        server=config.get('MAIL_SERVER', ''),
+        port=config.get('MAIL_PORT', 25),
+        username=config.get('MAIL_USERNAME'),
+        password=config.get('MAIL_PASSWORD'),
+        use_tls=config.get('MAIL_USE_TLS', False),
+        sender=config.get('MAIL_DEFAULT_SENDER', 'no-reply@pikngo.example'),
+        batch_size=config.get('MAIL_BATCH_SIZE', 50),
+        max_attempts=config.get('MAIL_MAX_ATTEMPTS', 8),
+        backoff=config.get('MAIL_RETRY_BACKOFF', 30),
+        lease=config.get('MAIL_LEASE', 300),
+        breaker_threshold=config.get('MAIL_BREAKER_THRESHOLD', 5),
+        breaker_reset=config.get('MAIL_BREAKER_RESET', 60),
+    )
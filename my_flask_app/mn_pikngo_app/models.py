@@ -1,7 +1,10 @@
+import secrets
 from datetime import datetime, timezone
 from flask import current_app as app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event
+from summary import summarize
 
 db = SQLAlchemy()
 
@@ -18,10 +21,250 @@ class Content(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     body = db.Column(db.Text, nullable=False)
-    image_filename = db.Column(db.String(255))
+    # Derived from body on every assignment; see _update_summary
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer)
+    reading_time = db.Column(db.Integer)  # minutes
+    # active_history: the replaced file name is needed to release its reference
+    image_filename = db.column_property(db.Column(db.String(255)), active_history=True)
+    # Copied from the stored file on every assignment; see _update_image_info
+    image_width = db.Column(db.Integer)
+    image_height = db.Column(db.Integer)
+    image_size = db.Column(db.Integer)  # bytes
+    image_placeholder = db.Column(db.Text)  # data: URI of a tiny preview
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(
+        db.DateTime,
+        default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc),
+    )
     author = db.ForeignKey('User.id')
 
+    # Back the keyset pagination used by the listing pages
+    __table_args__ = (
+        db.Index('ix_content_created_at_id', 'created_at', 'id'),
+        db.Index('ix_content_title_id', 'title', 'id'),
+    )
+
+    # Columns needed to render a listing card, so listings never load `body`
+    LISTING_COLUMNS = (
+        'id', 'title', 'image_filename', 'image_width', 'image_height', 'image_placeholder',
+        'created_at', 'updated_at', 'excerpt', 'word_count', 'reading_time',
+    )
+
+    @db.validates('body')
+    def _update_summary(self, key, body):
+        self.excerpt, self.word_count, self.reading_time = summarize(body)
+        return body
+
+    @db.validates('image_filename')
+    def _update_image_info(self, key, name):
+        # Measured once at upload, so rendering never opens the file
+        with db.session.no_autoflush:
+            stored = db.session.get(StoredFile, name) if name else None
+        if stored is None:
+            self.image_width = self.image_height = self.image_size = self.image_placeholder = None
+        else:
+            self.image_width, self.image_height = stored.width, stored.height
+            self.image_size, self.image_placeholder = stored.size, stored.placeholder
+        return name
+
+    @classmethod
+    def _stat(cls):
+        stat = db.session.get(TableStat, cls.__tablename__)
+        if stat is None:
+            # Not seeded (db.create_all has not run since the counter was
+            # added): count, but never write from a read
+            stat = TableStat(name=cls.__tablename__, row_count=cls.query.count(), version=0)
+        return stat
+
+    @classmethod
+    def count(cls):
+        """Return the number of posts from the maintained counter row."""
+        return cls._stat().row_count
+
+    @classmethod
+    def version(cls):
+        """Return a number that changes whenever any post is inserted, updated or deleted."""
+        return cls._stat().version
+
+    @classmethod
+    def last_changed(cls):
+        """Return when any post was last inserted, updated or deleted (None if unknown)."""
+        return cls._stat().changed_at
+
+    @property
+    def last_modified(self):
+        # Rows saved before updated_at existed fall back to their creation time
+        return self.updated_at or self.created_at
+
+
+# Row counts and change versions kept up to date by the write itself, so
+# listings can show a total without a COUNT(*) over the whole table and
+# caches in any worker can tell when their copy went stale
+class TableStat(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    changed_at = db.Column(db.DateTime)
+
+
+# One row per content-addressed upload (see storage.py); Content rows
+# referencing it by image_filename are counted in the same transaction
+class StoredFile(db.Model):
+    name = db.Column(db.String(100), primary_key=True)  # <sha256>.<ext>
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stored_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))  # last upload of these bytes
+    # See imageinfo.describe; None when Pillow could not read the file
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    placeholder = db.Column(db.Text)
+
+
+# Background jobs for the database queue (see jobs.py). Workers claim the
+# highest-priority queued job that is due with a conditional UPDATE
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)  # registered task name
+    payload = db.Column(db.Text, nullable=False)  # JSON [args, kwargs]
+    pool = db.Column(db.String(8), nullable=False)  # 'io' or 'cpu'
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # higher runs first
+    status = db.Column(db.String(10), nullable=False, default='queued', server_default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    run_at = db.Column(db.DateTime, nullable=False)  # not claimed before this
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    duration = db.Column(db.Float)  # seconds spent running the last attempt
+    worker = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_job_claim', 'status', 'pool', 'priority', 'run_at'),
+    )
+
+
+# Outgoing email (see mail.py). Rows are added in the same transaction as
+# the change that sends them and delivered later by `flask send-mail`
+class OutboxMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued', server_default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    claimed_by = db.Column(db.String(100))  # sender delivering it, while status is 'sending'
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_outbox_message_due', 'status', 'next_attempt_at'),
+    )
+
+
+# Readers who get new posts by email (see newsletter.py). Mail goes only to
+# addresses that followed the link in their confirmation email
+class Subscriber(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(255), unique=True, nullable=False)
+    token = db.Column(db.String(32), unique=True, nullable=False, default=lambda: secrets.token_hex(16))  # in unsubscribe links
+    subscribed_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    confirmation_sent_at = db.Column(db.DateTime)
+    confirmed_at = db.Column(db.DateTime)  # None until the address is confirmed
+    unsubscribed_at = db.Column(db.DateTime)  # None while subscribed
+
+    @classmethod
+    def receiving(cls):
+        """Return the condition for subscribers who get newsletters."""
+        return db.and_(cls.confirmed_at.isnot(None), cls.unsubscribed_at.is_(None))
+
+
+# One announcement of a new post to every subscriber. Sent in subscriber id
+# order; last_subscriber_id is the checkpoint a restarted send resumes from
+class Newsletter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_id = db.Column(db.Integer, db.ForeignKey('content.id', ondelete='SET NULL'))
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)  # rendered once; the same for every subscriber
+    unsubscribe_url = db.Column(db.String(255), nullable=False)  # with {token}
+    status = db.Column(db.String(10), nullable=False, default='queued', server_default='queued')
+    last_subscriber_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    sent = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    failed = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+def _bump_stat(connection, table_name, rows):
+    stats = TableStat.__table__
+    connection.execute(
+        stats.update()
+        .where(stats.c.name == table_name)
+        .values(
+            row_count=stats.c.row_count + rows,
+            version=stats.c.version + 1,
+            changed_at=datetime.now(timezone.utc),
+        )
+    )
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _seed_stats(metadata, connection, **kw):
+    # Runs on every create_all (create_db.py included), so a database made
+    # before the counter existed is seeded from the table once, in one
+    # statement that does nothing when the row is already there
+    stats, content = TableStat.__table__, Content.__table__
+    seeded = db.select(stats.c.name).where(stats.c.name == Content.__tablename__)
+    connection.execute(
+        stats.insert().from_select(
+            ['name', 'row_count', 'version', 'changed_at'],
+            db.select(
+                db.literal(Content.__tablename__),
+                db.select(db.func.count()).select_from(content).scalar_subquery(),
+                db.literal(0),
+                db.literal(datetime.now(timezone.utc), db.DateTime),
+            ).where(~seeded.exists()),
+        )
+    )
+
+
+def _count_reference(connection, name, delta):
+    # Files saved before content addressing have no row and are left alone
+    if name:
+        files = StoredFile.__table__
+        connection.execute(
+            files.update().where(files.c.name == name).values(refcount=files.c.refcount + delta)
+        )
+
+
+@event.listens_for(Content, 'after_insert')
+def _content_inserted(mapper, connection, target):
+    _bump_stat(connection, Content.__tablename__, 1)
+    _count_reference(connection, target.image_filename, 1)
+
+
+@event.listens_for(Content, 'after_update')
+def _content_updated(mapper, connection, target):
+    _bump_stat(connection, Content.__tablename__, 0)
+    history = db.inspect(target).attrs.image_filename.history
+    if history.has_changes():
+        for name in history.deleted:
+            _count_reference(connection, name, -1)
+        for name in history.added:
+            _count_reference(connection, name, 1)
+
+
+@event.listens_for(Content, 'after_delete')
+def _content_deleted(mapper, connection, target):
+    _bump_stat(connection, Content.__tablename__, -1)
+    _count_reference(connection, target.image_filename, -1)
+
 # Define Comment model
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,270 @@
+# newsletter.py
+#
+# Emails every subscriber when a post is published. The view calls
+# announce() before committing the post, which renders the email once into
+# a Newsletter row in the same transaction, and queues send_newsletter()
+# after the commit. The job pages through subscribers in id order and sends
+# them over a few SMTP connections at a limited rate, saving its place after
+# each batch so a restarted send carries on where it stopped.
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from email.message import EmailMessage
+from flask import current_app, render_template, url_for
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from jobs import _now, enqueue, runs_inline, task
+from mail import header_value, reply_codes, send_email
+from models import db, Newsletter, Subscriber
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Let at most `rate` calls a second through wait(), shared by any number of threads.
+
+    Up to one second's worth may pass at once; after that each caller
+    sleeps for its turn. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.sleep(delay)
+
+
+class Fanout:
+    """How newsletters are sent; app.extensions['newsletter']."""
+
+    def __init__(self, connections=4, rate=200, batch_size=100, job_seconds=120):
+        self.connections = connections
+        self.rate = rate
+        self.batch_size = batch_size  # subscribers read, sent and checkpointed at a time
+        self.job_seconds = job_seconds  # one job's share before it queues the rest, well inside JOBS_LEASE
+
+    def stats(self):
+        newsletters = Newsletter.__table__
+        counts = dict(db.session.execute(
+            db.select(newsletters.c.status, db.func.count()).group_by(newsletters.c.status)
+        ).all())
+        sent, failed = db.session.execute(
+            db.select(db.func.sum(newsletters.c.sent), db.func.sum(newsletters.c.failed))
+        ).one()
+        subscribers = db.session.execute(
+            db.select(db.func.count()).where(Subscriber.receiving())
+        ).scalar()
+        pending = db.session.execute(
+            db.select(db.func.count()).where(Subscriber.confirmed_at.is_(None))
+        ).scalar()
+        return {**counts, 'sent': sent or 0, 'failed': failed or 0, 'subscribers': subscribers, 'pending': pending}
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='newsletter-confirm')
+
+
+def confirmation_token(subscriber):
+    """Return the signed token in the link that confirms `subscriber`."""
+    return _serializer().dumps([subscriber.id, subscriber.email])
+
+
+def confirmed_subscriber(token):
+    """Return the Subscriber a confirmation token was made for, or None when it is forged or expired."""
+    try:
+        subscriber_id, email = _serializer().loads(
+            token, max_age=current_app.config.get('NEWSLETTER_CONFIRM_MAX_AGE', 3 * 86400)
+        )
+    except BadSignature:  # SignatureExpired included
+        return None
+    subscriber = db.session.get(Subscriber, subscriber_id)
+    return subscriber if subscriber is not None and subscriber.email == email else None
+
+
+def request_confirmation(subscriber):
+    """Queue the email asking the owner of the address to confirm, in the current session.
+
+    Nothing is sent if one already went out within NEWSLETTER_CONFIRM_INTERVAL
+    seconds, so the form cannot be used to flood an inbox. Returns whether
+    one was queued.
+    """
+    interval = timedelta(seconds=current_app.config.get('NEWSLETTER_CONFIRM_INTERVAL', 3600))
+    if subscriber.confirmation_sent_at is not None and _now() - subscriber.confirmation_sent_at < interval:
+        return False
+    db.session.flush()  # for a new subscriber's id in the token
+    subscriber.confirmation_sent_at = _now()
+    confirm_url = url_for('mn_pikngo_app.confirm_subscription', token=confirmation_token(subscriber), _external=True)
+    send_email(
+        subscriber.email,
+        "Confirm your Pik 'n Go subscription",
+        f"Someone, hopefully you, asked for new Pik 'n Go posts to be emailed to this address.\n\n"
+        f"To confirm, open {confirm_url}\n\nIf it was not you, ignore this email and nothing will be sent.",
+    )
+    return True
+
+
+def announce(content):
+    """Add the Newsletter for a new post to the session and return it.
+
+    Queue it with enqueue(send_newsletter, newsletter.id) once committed.
+    Returns None, sending nothing, when there is no job queue: the fan-out
+    must never run inside the request that published the post.
+    """
+    if runs_inline():
+        logger.warning('Post %r not emailed to subscribers: newsletters need a job queue (JOBS_BACKEND, not JOBS_EAGER)',
+                       content.title)
+        return None
+    db.session.flush()  # for the post's id in its URL
+    newsletter = Newsletter(
+        content_id=content.id,
+        subject=header_value(content.title),
+        body=render_template(
+            'newsletter.txt',
+            post=content,
+            post_url=url_for('mn_pikngo_app.post', post_id=content.id, _external=True),
+        ),
+        # Built here while there is a request to take the host from
+        unsubscribe_url=url_for('mn_pikngo_app.unsubscribe', token='TOKEN', _external=True).replace('TOKEN', '{token}'),
+    )
+    db.session.add(newsletter)
+    return newsletter
+
+
+def _email(newsletter, sender, email, token):
+    unsubscribe_url = newsletter['unsubscribe_url'].format(token=token)
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = email
+    message['Subject'] = header_value(newsletter['subject'])
+    message['List-Unsubscribe'] = f'<{unsubscribe_url}>'
+    message['List-Unsubscribe-Post'] = 'List-Unsubscribe=One-Click'
+    message.set_content(f"{newsletter['body']}\n\n--\nUnsubscribe: {unsubscribe_url}\n")
+    return message
+
+
+def _send_share(connections, limiter, newsletter, sender, rows):
+    # One thread's share of a batch, over whichever connection is free
+    connection = connections.get()
+    sent = failed = 0
+    try:
+        for row in rows:
+            try:
+                email = _email(newsletter, sender, row.email, row.token)
+            except (ValueError, TypeError) as error:
+                # An address no header can hold; skipping it keeps the send able to finish
+                logger.info('Newsletter to %r not sent: %s', row.email, error)
+                failed += 1
+                continue
+            limiter.wait()
+            try:
+                connection.send(email)
+            except OSError as error:
+                codes = reply_codes(error)
+                if not codes or 421 in codes:
+                    # The server is failing, not this address: stop and let the job retry
+                    connection.close()
+                    raise
+                logger.info('Newsletter to %s refused: %s', row.email, error)
+                failed += 1
+            else:
+                sent += 1
+    finally:
+        connections.put(connection)
+    return sent, failed
+
+
+def _send_batch(newsletter, fanout, outbox, connections, pool, limiter):
+    """Send to the next batch of subscribers after the checkpoint, then move it on.
+
+    Returns how many subscribers were in the batch. Each batch is one
+    short keyset query, read in full before anything is sent, so no read
+    is held open while mail goes out (on SQLite that would lock out every
+    writer, the checkpoint included). Only the batch that was going out
+    when a send failed is sent again.
+    """
+    # Plain values: the threads must not touch the session
+    fields = {name: getattr(newsletter, name) for name in ('subject', 'body', 'unsubscribe_url')}
+    batch = db.session.execute(
+        db.select(Subscriber.id, Subscriber.email, Subscriber.token)
+        .where(Subscriber.receiving(), Subscriber.id > newsletter.last_subscriber_id)
+        .order_by(Subscriber.id)
+        .limit(fanout.batch_size)
+    ).all()
+    if not batch:
+        return 0
+    shares = [batch[start::fanout.connections] for start in range(fanout.connections)]
+    # Raises, with nothing recorded, if any share hit a failing server
+    outcomes = list(pool.map(lambda rows: _send_share(connections, limiter, fields, outbox.sender, rows), shares))
+    newsletter.sent += sum(sent for sent, _ in outcomes)
+    newsletter.failed += sum(failed for _, failed in outcomes)
+    newsletter.last_subscriber_id = batch[-1].id
+    db.session.commit()
+    return len(batch)
+
+
+@task(pool='io', retries=8)
+def send_newsletter(newsletter_id):
+    """Send a Newsletter to the subscribers it has not reached yet.
+
+    A run stops after Fanout.job_seconds and queues the rest as a new job,
+    so no single job outlives its lease. A run that fails is retried by the
+    job queue from the last checkpoint; subscribers in the batch that was
+    going out when it failed may get the email twice.
+    """
+    newsletter = db.session.get(Newsletter, newsletter_id)
+    if newsletter is None or newsletter.status == 'done':
+        return
+    if newsletter.started_at is None:
+        newsletter.status, newsletter.started_at = 'sending', _now()
+        db.session.commit()
+    app = current_app._get_current_object()
+    fanout, outbox = app.extensions['newsletter'], app.extensions['mail_outbox']
+    connections = queue.SimpleQueue()
+    opened = [outbox.connect() for _ in range(fanout.connections)]
+    for connection in opened:
+        connections.put(connection)
+    limiter = RateLimiter(fanout.rate)
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(fanout.connections, thread_name_prefix='newsletter') as pool:
+            while True:
+                if _send_batch(newsletter, fanout, outbox, connections, pool, limiter) < fanout.batch_size:
+                    newsletter.status, newsletter.finished_at = 'done', _now()
+                    db.session.commit()
+                    logger.info('Newsletter %s sent to %d subscriber(s), %d refused',
+                                newsletter.id, newsletter.sent, newsletter.failed)
+                    return
+                if time.monotonic() - started > fanout.job_seconds:
+                    break
+    finally:
+        for connection in opened:
+            connection.close()
+    enqueue(send_newsletter, newsletter_id)
+
+
+def init_newsletter(app):
+    """Send newsletters with NEWSLETTER_CONNECTIONS connections at NEWSLETTER_RATE messages a second."""
+    config = app.config
+    app.extensions['newsletter'] = Fanout(
+        connections=config.get('NEWSLETTER_CONNECTIONS', 4),
+        rate=config.get('NEWSLETTER_RATE', 200),
+        batch_size=config.get('NEWSLETTER_BATCH_SIZE', 100),
+        job_seconds=config.get('NEWSLETTER_JOB_SECONDS', 120),
+    )
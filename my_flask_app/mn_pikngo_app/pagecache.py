@@ -0,0 +1,231 @@
+# pagecache.py
+
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import current_app, request, session
+from flask_login import current_user
+from sqlalchemy.exc import SQLAlchemyError
+from cache import make_cache
+from conditional import not_modified, not_modified_response
+from models import db, Content
+from signals import content_changed
+
+# A rendered 200 response with its Set-Cookie headers removed, and the
+# content version it was rendered from
+CachedPage = namedtuple('CachedPage', ['status', 'headers', 'body', 'version', 'expires'])
+
+
+class PageCache:
+    """Whole responses for anonymous visitors, with single-flight filling.
+
+    Only one request per key renders on a miss; concurrent requests for the
+    same key wait for it and are served its result. The lock is per worker
+    process, so a cold key costs at most one render per worker.
+
+    A page past its TTL is still served for `stale` seconds while one
+    background render replaces it, and for `grace` seconds when rendering
+    fails with a database error.
+    """
+
+    def __init__(self, store, ttl, stale=0, grace=0, wait=10):
+        self.store = store
+        self.ttl = ttl
+        self.stale = stale
+        self.grace = grace
+        self.wait = wait
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> Event set when its leader finishes
+        self.stale_served = 0
+        self.errors_hidden = 0
+
+    def get(self, key):
+        """Return the stored page for `key` whatever its age, or None."""
+        return self.store.get(key)
+
+    def set(self, key, version, status, headers, body):
+        page = CachedPage(status, headers, body, version, time.time() + self.ttl)
+        size = len(body) + sum(len(name) + len(value) for name, value in headers)
+        # Keep the entry while it may still be served stale
+        self.store.set(key, page, size=size, ttl=self.ttl + max(self.stale, self.grace))
+        return page
+
+    def in_grace(self, page):
+        return page is not None and time.time() < page.expires + self.grace
+
+    def _claim(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = threading.Event()
+            return flight, True
+
+    def _release(self, key, flight):
+        with self._lock:
+            del self._flights[key]
+        flight.set()
+
+    def get_or_render(self, key, render, version):
+        """Return (page, leader). `render` is called by at most one thread per key
+        and returns a CachedPage or None when the response must not be shared."""
+        flight, leader = self._claim(key)
+        if not leader:
+            flight.wait(self.wait)
+            page = self.get(key)
+            return (page if page is not None and page.version == version else None), False
+        try:
+            return render(), True
+        finally:
+            self._release(key, flight)
+
+    def refresh_in_background(self, key, render):
+        """Start `render` on a thread unless one is already running for `key`."""
+        flight, leader = self._claim(key)
+        if not leader:
+            return
+
+        def run():
+            try:
+                render()
+            finally:
+                self._release(key, flight)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        return dict(
+            self.store.stats(),
+            in_flight=len(self._flights),
+            stale_served=self.stale_served,
+            errors_hidden=self.errors_hidden,
+        )
+
+
+def _shareable_request():
+    # A pending flash or a logged-in user makes the page personal
+    return (
+        request.method == 'GET'
+        and not current_user.is_authenticated
+        and '_flashes' not in session
+    )
+
+
+def _store(cache, key, version, response):
+    # A touched session means a cookie for this visitor only (e.g. a CSRF token)
+    if response.status_code != 200 or session.modified or 'Set-Cookie' in response.headers:
+        return None
+    headers = [(name, value) for name, value in response.headers.items() if name != 'Set-Cookie']
+    return cache.set(key, version, response.status, headers, response.get_data())
+
+
+def _serve(page, state):
+    response = current_app.response_class(page.body, status=page.status, headers=page.headers)
+    response.headers['X-Cache'] = state
+    etag, _ = response.get_etag()
+    if etag and not_modified(etag, response.last_modified):
+        return not_modified_response(etag, response.last_modified)
+    return response
+
+
+def _serve_stale_on_error(cache, page, error):
+    db.session.rollback()
+    if not cache.in_grace(page):
+        raise error
+    current_app.logger.warning('Serving stale %s after database error: %s', request.path, error)
+    cache.errors_hidden += 1
+    return _serve(page, 'STALE')
+
+
+def _background_render(app, cache, key, view, args, kwargs):
+    """Re-render `view` for the current URL as an anonymous visitor on another thread."""
+    path, base_url, query_string = request.path, request.url_root, request.query_string
+
+    def render():
+        with app.test_request_context(path, base_url=base_url, query_string=query_string):
+            try:
+                version = Content.version()
+                _store(cache, key, version, app.make_response(view(*args, **kwargs)))
+            except SQLAlchemyError as error:
+                # Keep the stale copy; it is served until its grace runs out
+                app.logger.warning('Background refresh of %s failed: %s', path, error)
+    return render
+
+
+def cached_page(view):
+    """Serve the view from the page cache for anonymous GET requests.
+
+    Entries are keyed by path and query string and remember the content
+    version they were rendered from: any post write makes them re-render,
+    and PAGE_CACHE_TTL bounds everything else.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('page_cache')
+        if cache is None or not _shareable_request():
+            return view(*args, **kwargs)
+
+        key = (request.path, request.query_string)
+        page = cache.get(key)
+        try:
+            version = Content.version()
+        except SQLAlchemyError as error:
+            return _serve_stale_on_error(cache, page, error)
+
+        if page is not None and page.version == version:
+            now = time.time()
+            if now < page.expires:
+                return _serve(page, 'HIT')
+            if now < page.expires + cache.stale:
+                app = current_app._get_current_object()
+                cache.refresh_in_background(key, _background_render(app, cache, key, view, args, kwargs))
+                cache.stale_served += 1
+                return _serve(page, 'STALE')
+
+        rendered = []
+
+        def render():
+            response = current_app.make_response(view(*args, **kwargs))
+            rendered.append(response)
+            fresh = _store(cache, key, version, response)
+            if fresh is not None:
+                response.headers['X-Cache'] = 'MISS'
+            return fresh
+
+        try:
+            fresh, leader = cache.get_or_render(key, render, version)
+            if leader:
+                return rendered[0]
+            if fresh is not None:
+                return _serve(fresh, 'HIT')
+            # The leader failed, timed out or produced a private page
+            return view(*args, **kwargs)
+        except SQLAlchemyError as error:
+            return _serve_stale_on_error(cache, page, error)
+    return wrapper
+
+
+def _drop_deleted_posts(app, changes, **extra):
+    # Other pages re-render on the version change; a deleted post's page
+    # must not survive as a stale copy either
+    cache = app.extensions['page_cache']
+    urls = app.url_map.bind('')
+    for change in changes:
+        if change.op == 'delete':
+            cache.store.delete((urls.build('mn_pikngo_app.post', {'post_id': change.id}), b''))
+
+
+def init_page_cache(app):
+    """Cache anonymous pages up to PAGE_CACHE_BYTES for PAGE_CACHE_TTL seconds,
+    then serve them stale for PAGE_CACHE_STALE more while refreshing, or for
+    PAGE_CACHE_GRACE when the database is failing."""
+    store = make_cache(app.config, 'pages', app.config.get('PAGE_CACHE_BYTES'))
+    if store is not None:
+        app.extensions['page_cache'] = PageCache(
+            store,
+            app.config['PAGE_CACHE_TTL'],
+            stale=app.config.get('PAGE_CACHE_STALE', 0),
+            grace=app.config.get('PAGE_CACHE_GRACE', 0),
+        )
+        content_changed.connect(_drop_deleted_posts, sender=app, weak=False)
@@ -0,0 +1,81 @@
+# pagination.py
+
+import base64
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# A page of results plus the opaque cursors needed to move away from it.
+# A cursor of None means there is nothing further in that direction.
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(value, row_id):
+    """Pack a (sort value, id) position into an opaque, URL-safe token."""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = f"{value}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, value_type=datetime):
+    """Unpack a token made by encode_cursor, or return None if it is invalid."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        value, row_id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        if value_type is datetime:
+            value = datetime.fromisoformat(value)
+        return value, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _seek(sort_col, id_col, position, greater):
+    value, row_id = position
+    if greater:
+        return or_(sort_col > value, and_(sort_col == value, id_col > row_id))
+    return or_(sort_col < value, and_(sort_col == value, id_col < row_id))
+
+
+def keyset_page(query, sort_col, id_col, per_page, after=None, before=None, descending=True):
+    """Return one page of `query` ordered and seeked by (sort_col, id_col).
+
+    `after` moves forward in display order and `before` moves back. Both are
+    cursors produced by a previous page. Only `per_page + 1` rows are read, so
+    the cost of a page does not depend on how deep into the table it is.
+    """
+    value_type = sort_col.type.python_type
+    after = decode_cursor(after, value_type)
+    before = decode_cursor(before, value_type) if after is None else None
+
+    if before is not None:
+        query = query.filter(_seek(sort_col, id_col, before, greater=descending))
+        backward = True
+    else:
+        if after is not None:
+            query = query.filter(_seek(sort_col, id_col, after, greater=not descending))
+        backward = False
+
+    if descending != backward:
+        query = query.order_by(sort_col.desc(), id_col.desc())
+    else:
+        query = query.order_by(sort_col.asc(), id_col.asc())
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if backward:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, sort_col.key), getattr(row, id_col.key))
+
+    next_cursor = cursor_for(rows[-1]) if rows and has_next else None
+    prev_cursor = cursor_for(rows[0]) if rows and has_prev else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
@@ -0,0 +1,399 @@
+# search.py
+
+import re
+import weakref
+from collections import namedtuple
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session, load_only
+from cache import make_cache
+from models import db, Content
+from summary import plain_text
+
+SearchHit = namedtuple('SearchHit', ['post', 'snippet', 'score'])
+SearchResults = namedtuple('SearchResults', ['query', 'hits', 'total', 'page', 'per_page'])
+
+# Marks around matched terms in snippets; swapped for <mark> after escaping
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03'
+SNIPPET_WORDS = 24
+TITLE_WEIGHT = 5.0
+# Title terms are counted this many times by backends without column weights
+TITLE_REPEAT = 3
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def query_terms(query):
+    """Split free text into lowercase search terms, ignoring punctuation."""
+    return [term.lower() for term in _word_re.findall(query or '')]
+
+
+def document_terms(content):
+    """Terms a post is indexed under, with the title counted TITLE_REPEAT times."""
+    return query_terms(content.title) * TITLE_REPEAT + query_terms(plain_text(content.body))
+
+
+def _iter_posts(connection, batch_size):
+    posts = Content.__table__
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            posts.select().where(posts.c.id > last_id).order_by(posts.c.id).limit(batch_size)
+        ).all()
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+
+
+def render_snippet(raw):
+    """Escape a snippet and turn the highlight marks into <mark> tags."""
+    html = str(escape(raw))
+    return Markup(html.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+
+def make_snippet(text_, terms, words=SNIPPET_WORDS):
+    """Cut a window of `words` words around the first matching term and mark matches."""
+    tokens = text_.split()
+    prefixes = tuple(terms)
+    start = 0
+    for i, token in enumerate(tokens):
+        if token.lower().strip('.,;:!?()"\'').startswith(prefixes):
+            start = max(0, i - words // 3)
+            break
+    window = tokens[start:start + words]
+    marked = [
+        f"{HIGHLIGHT_START}{token}{HIGHLIGHT_END}"
+        if prefixes and token.lower().strip('.,;:!?()"\'').startswith(prefixes) else token
+        for token in window
+    ]
+    snippet = ' '.join(marked)
+    if start > 0:
+        snippet = '…' + snippet
+    if start + words < len(tokens):
+        snippet += '…'
+    return snippet
+
+
+class SearchBackend:
+    """Index maintenance hooks are no-ops unless a backend keeps its own index."""
+
+    def ensure(self, connection):
+        """Prepare the index; returns True when it was just created and is empty."""
+        return False
+
+    def create(self, connection):
+        pass
+
+    def index(self, connection, content):
+        pass
+
+    def remove(self, connection, content_id):
+        pass
+
+    def clear(self, connection):
+        pass
+
+    def rebuild(self, connection, batch_size):
+        """Replace the index contents with every post; returns the number indexed."""
+        self.clear(connection)
+        indexed = 0
+        for row in _iter_posts(connection, batch_size):
+            self.index(connection, row)
+            indexed += 1
+        return indexed
+
+    def search(self, terms, offset, limit):
+        """Return (total, [(content_id, score, snippet), ...]) ranked best first.
+
+        A snippet of None asks search_posts to cut one from the stored excerpt.
+        """
+        raise NotImplementedError
+
+
+class SqliteFtsBackend(SearchBackend):
+    """SQLite FTS5 table holding the plain text of each post, keyed by post id."""
+
+    table = 'content_fts'
+
+    def ensure(self, connection):
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': self.table},
+        ).first()
+        if exists:
+            return False
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {self.table} USING fts5(title, body, tokenize='porter unicode61')"
+        ))
+        return True
+
+    def create(self, connection):
+        self.ensure(connection)
+
+    def index(self, connection, content):
+        self.remove(connection, content.id)
+        connection.execute(
+            text(f"INSERT INTO {self.table} (rowid, title, body) VALUES (:id, :title, :body)"),
+            {'id': content.id, 'title': content.title, 'body': plain_text(content.body)},
+        )
+
+    def remove(self, connection, content_id):
+        connection.execute(text(f"DELETE FROM {self.table} WHERE rowid = :id"), {'id': content_id})
+
+    def clear(self, connection):
+        connection.execute(text(f"DELETE FROM {self.table}"))
+
+    def search(self, terms, offset, limit):
+        # Quote every term so user input can never be parsed as FTS5 syntax
+        match = ' '.join(f'"{term}"' for term in terms)
+        total = db.session.execute(
+            text(f"SELECT count(*) FROM {self.table} WHERE {self.table} MATCH :match"),
+            {'match': match},
+        ).scalar()
+        rows = db.session.execute(
+            text(
+                f"SELECT rowid, bm25({self.table}, {TITLE_WEIGHT}, 1.0) AS score, "
+                f"snippet({self.table}, 1, :start, :end, '…', {SNIPPET_WORDS}) AS snippet "
+                f"FROM {self.table} WHERE {self.table} MATCH :match "
+                f"ORDER BY score LIMIT :limit OFFSET :offset"
+            ),
+            {'match': match, 'start': HIGHLIGHT_START, 'end': HIGHLIGHT_END, 'limit': limit, 'offset': offset},
+        ).all()
+        # bm25() is lower-is-better; flip it so every backend ranks high-to-low
+        return total, [(row.rowid, -row.score, row.snippet) for row in rows]
+
+
+class MysqlFulltextBackend(SearchBackend):
+    """InnoDB FULLTEXT index on (title, body); MySQL keeps it in sync itself."""
+
+    index_name = 'ft_content_title_body'
+    available = False
+
+    def ensure(self, connection):
+        # Only look: ALTER TABLE commits implicitly, so it must never run
+        # inside a flush. create() adds the index from create_db.py or the CLI.
+        self.available = connection.execute(
+            text(
+                "SELECT 1 FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = 'content' AND index_name = :name"
+            ),
+            {'name': self.index_name},
+        ).first() is not None
+        return False
+
+    def create(self, connection):
+        self.ensure(connection)
+        if not self.available:
+            connection.execute(text(f"ALTER TABLE content ADD FULLTEXT INDEX {self.index_name} (title, body)"))
+            self.available = True
+
+    def search(self, terms, offset, limit):
+        if not self.available:
+            return LikeBackend().search(terms, offset, limit)
+        against = ' '.join(terms)
+        match = "MATCH (title, body) AGAINST (:against IN NATURAL LANGUAGE MODE)"
+        total = db.session.execute(
+            text(f"SELECT count(*) FROM content WHERE {match}"), {'against': against}
+        ).scalar()
+        rows = db.session.execute(
+            text(f"SELECT id, {match} AS score FROM content WHERE {match} ORDER BY score DESC LIMIT :limit OFFSET :offset"),
+            {'against': against, 'limit': limit, 'offset': offset},
+        ).all()
+        bodies = dict(
+            db.session.query(Content.id, Content.body).filter(Content.id.in_([row.id for row in rows]))
+        )
+        return total, [
+            (row.id, row.score, make_snippet(plain_text(bodies.get(row.id)), terms)) for row in rows
+        ]
+
+
+class LikeBackend(SearchBackend):
+    """Unranked substring match, for databases without a full-text engine."""
+
+    def search(self, terms, offset, limit):
+        query = Content.query
+        for term in terms:
+            query = query.filter(Content.title.contains(term) | Content.body.contains(term))
+        total = query.count()
+        rows = query.order_by(Content.created_at.desc()).offset(offset).limit(limit).all()
+        return total, [(row.id, 0.0, make_snippet(plain_text(row.body), terms)) for row in rows]
+
+
+class Bm25Backend(SearchBackend):
+    """In-process BM25 index from bm25.py, memory-mapped from SEARCH_INDEX_PATH.
+
+    Changes are queued on the flush connection, handed to the session after
+    the flush, and appended to the shared delta log only once the session
+    has committed, so rolled-back edits never reach the index.
+    """
+
+    pending_key = 'bm25_pending'
+
+    def __init__(self, path):
+        # NumPy is only needed when this backend is configured
+        from bm25 import Bm25Index
+        self.bm25 = Bm25Index(path)
+        self.engine = None
+
+    def ensure(self, connection):
+        self.engine = connection.engine
+        event.listen(connection.engine, 'rollback', self._on_rollback)
+        event.listen(Session, 'after_flush', self._on_flush)
+        event.listen(Session, 'after_commit', self._on_commit)
+        event.listen(Session, 'after_rollback', self._on_session_rollback)
+        return not self.bm25.exists()
+
+    def rebuild(self, connection, batch_size):
+        # Updates logged while the posts are read are carried into the new segment
+        since = self.bm25.log_position()
+        documents = [(row.id, document_terms(row)) for row in _iter_posts(connection, batch_size)]
+        self.bm25 = self.bm25.build(self.bm25.path, documents, since=since)
+        return len(documents)
+
+    def index(self, connection, content):
+        connection.info.setdefault(self.pending_key, []).append((content.id, document_terms(content)))
+
+    def remove(self, connection, content_id):
+        connection.info.setdefault(self.pending_key, []).append((content_id, None))
+
+    def _on_flush(self, session, flush_context):
+        connection = session.connection()
+        if connection.engine is self.engine:
+            pending = connection.info.pop(self.pending_key, None)
+            if pending:
+                session.info.setdefault(self.pending_key, []).extend(pending)
+
+    def _on_commit(self, session):
+        # The database has committed; only now may other workers see the change
+        for content_id, terms in session.info.pop(self.pending_key, []):
+            if terms is None:
+                self.bm25.delete(content_id)
+            else:
+                self.bm25.upsert(content_id, terms)
+
+    def _on_rollback(self, connection):
+        # A flush that failed part way leaves its entries on the connection
+        connection.info.pop(self.pending_key, None)
+
+    def _on_session_rollback(self, session):
+        session.info.pop(self.pending_key, None)
+
+    def search(self, terms, offset, limit):
+        total, ranked = self.bm25.search(terms, offset, limit)
+        return total, [(content_id, score, None) for content_id, score in ranked]
+
+
+# One backend per engine, so apps bound to different databases never share state
+_backends = weakref.WeakKeyDictionary()
+
+
+def _backend_for(connection):
+    if current_app.config.get('SEARCH_BACKEND') == 'bm25':
+        return Bm25Backend(current_app.config['SEARCH_INDEX_PATH'])
+    dialect = connection.engine.dialect.name
+    if dialect == 'sqlite':
+        has_fts5 = connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar()
+        return SqliteFtsBackend() if has_fts5 else LikeBackend()
+    if dialect == 'mysql':
+        return MysqlFulltextBackend()
+    return LikeBackend()
+
+
+def get_backend(connection=None):
+    """Return the full-text backend for the database behind `connection`.
+
+    The first call per engine prepares the index, filling it if it was just
+    created. Pass the flush connection from inside a write so SQLite never
+    waits on its own write lock.
+    """
+    if connection is None:
+        backend = _backends.get(db.engine)
+        if backend is not None:
+            return backend
+        with db.engine.begin() as connection:
+            return get_backend(connection)
+
+    engine = connection.engine
+    backend = _backends.get(engine)
+    if backend is None:
+        backend = _backend_for(connection)
+        if backend.ensure(connection):
+            rebuild_index(backend, connection)
+        _backends[engine] = backend
+    return backend
+
+
+def rebuild_index(backend=None, connection=None, batch_size=500):
+    """Re-index every post from the content table; returns the number indexed."""
+    if connection is None:
+        with db.engine.begin() as connection:
+            return rebuild_index(backend, connection, batch_size)
+
+    backend = backend or get_backend(connection)
+    backend.create(connection)
+    return backend.rebuild(connection, batch_size)
+
+
+def search_posts(query, page=1, per_page=10):
+    """Run a ranked full-text search and load the matching posts for one page."""
+    terms = query_terms(query)
+    if not terms:
+        return SearchResults(query, [], 0, page, per_page)
+
+    offset = (page - 1) * per_page
+    cache = current_app.extensions.get('search_cache')
+    if cache is None:
+        total, ranked = get_backend().search(terms, offset, per_page)
+    else:
+        # Keys carry the content version, so after any write in any worker
+        # the old entries are never read again and simply age out
+        key = (Content.version(), ' '.join(terms), offset, per_page)
+        cached = cache.get(key)
+        if cached is None:
+            cached = get_backend().search(terms, offset, per_page)
+            cache.set(key, cached)
+        total, ranked = cached
+    posts = {
+        post.id: post
+        for post in Content.query.options(
+            load_only(*(getattr(Content, name) for name in Content.LISTING_COLUMNS))
+        ).filter(Content.id.in_([content_id for content_id, _, _ in ranked]))
+    }
+    hits = [
+        SearchHit(
+            posts[content_id],
+            render_snippet(snippet if snippet is not None else make_snippet(posts[content_id].excerpt or '', terms)),
+            score,
+        )
+        for content_id, score, snippet in ranked
+        if content_id in posts
+    ]
+    return SearchResults(query, hits, total, page, per_page)
+
+
+def init_search_cache(app):
+    """Cache ranked result ids per normalized query, up to SEARCH_CACHE_BYTES."""
+    cache = make_cache(app.config, 'search', app.config.get('SEARCH_CACHE_BYTES'))
+    if cache is not None:
+        app.extensions['search_cache'] = cache
+
+
+# Keep the index in step with Content inside the same transaction as the write
+
+@event.listens_for(Content, 'after_insert')
+def _index_inserted(mapper, connection, target):
+    get_backend(connection).index(connection, target)
+
+
+@event.listens_for(Content, 'after_update')
+def _index_updated(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.body.history.has_changes():
+        get_backend(connection).index(connection, target)
+
+
+@event.listens_for(Content, 'after_delete')
+def _index_deleted(mapper, connection, target):
+    get_backend(connection).remove(connection, target.id)
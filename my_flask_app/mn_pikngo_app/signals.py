@@ -0,0 +1,46 @@
+# signals.py
+
+from collections import namedtuple
+from blinker import Namespace
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Content
+
+_signals = Namespace()
+
+# Sent once per commit that touched Content, with sender=the Flask app and
+# changes=[ContentChange, ...]. Receivers run after the data is committed.
+# The invalidation bus re-sends other workers' changes with remote=True,
+# so receivers should accept extra keyword arguments.
+content_changed = _signals.signal('content-changed')
+
+# Sent with sender=the Flask app and name=the stored file name when
+# store_upload saves a file, and when prune() deletes one.
+upload_stored = _signals.signal('upload-stored')
+upload_pruned = _signals.signal('upload-pruned')
+
+ContentChange = namedtuple('ContentChange', ['op', 'id', 'title'])
+
+_pending_key = 'content_changes'
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault(_pending_key, [])
+    for op, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Content) and (op != 'update' or session.is_modified(obj)):
+                changes.append(ContentChange(op, obj.id, obj.title))
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_changes(session):
+    changes = session.info.pop(_pending_key, None)
+    if changes:
+        content_changed.send(current_app._get_current_object(), changes=changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_changes(session):
+    session.info.pop(_pending_key, None)
@@ -0,0 +1,219 @@
+# storage.py
+
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from flask import Request, current_app
+from sqlalchemy.exc import IntegrityError
+from imageinfo import describe
+from models import db, StoredFile
+from signals import upload_pruned, upload_stored
+
+CHUNK_SIZE = 64 * 1024
+
+# <sha256 hex>.<ext>: names written by store_upload
+STORED_NAME = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]{1,8})?$')
+
+# Leading bytes of the image types accepted for upload, and the extension they are stored under
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+]
+SNIFF_BYTES = 16
+
+
+class UploadRejected(ValueError):
+    """The uploaded bytes are not an accepted image type."""
+
+
+def sniff(head):
+    """Return the stored extension for a file starting with `head`, or None."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+class UploadSpool:
+    """Write-once file that hashes and keeps the leading bytes of what is written to it.
+
+    Data stays in memory up to `max_memory` bytes and then moves to a
+    temporary file in `directory`, which must be on the same filesystem as
+    the upload folder so persist() is a rename. The temporary file is
+    removed on close() unless it was persisted.
+    """
+
+    def __init__(self, directory, max_memory):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.path = None
+        self._file = io.BytesIO()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[:SNIFF_BYTES - len(self.head)])
+        if self.path is None and self.size > self.max_memory:
+            self._rollover()
+        return self._file.write(data)
+
+    def _rollover(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=self.directory)
+        spilled = os.fdopen(fd, 'w+b')
+        spilled.write(self._file.getvalue())
+        self._file = spilled
+
+    def persist(self, path):
+        """Move the bytes to `path` in one rename."""
+        if self.path is None:
+            self._rollover()
+        self._file.close()
+        os.replace(self.path, path)
+        self.path = None
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        # read, readline, seek, tell, ... for form validators
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request whose file uploads stream into UploadSpools under UPLOAD_FOLDER/.tmp.
+
+    The body never grows past MAX_CONTENT_LENGTH (413 otherwise) and each
+    file keeps at most UPLOAD_SPOOL_BYTES in memory.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(
+            os.path.join(current_app.config['UPLOAD_FOLDER'], '.tmp'),
+            current_app.config.get('UPLOAD_SPOOL_BYTES', 64 * 1024),
+        )
+
+
+def relative_path(name):
+    """Path of an upload under UPLOAD_FOLDER: hashed names are sharded as ab/cd/<name>."""
+    match = STORED_NAME.match(name)
+    if match is None:
+        return name  # saved before content addressing, directly in the folder
+    digest = match.group(1)
+    return os.path.join(digest[:2], digest[2:4], name)
+
+
+def is_stored_name(name):
+    return STORED_NAME.match(name) is not None
+
+
+def store_upload(upload, pin=False):
+    """Save a werkzeug FileStorage under the SHA-256 of its bytes and return the stored name.
+
+    Uploads parsed by UploadRequest were hashed and sniffed as they
+    arrived and are renamed into place; other streams are copied through
+    a spool first. Raises UploadRejected unless the bytes are a PNG, JPEG,
+    GIF or WebP image. Content rows that set image_filename to the name
+    are counted by the model events; `pin` adds a permanent reference for
+    files linked from post bodies.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    spool = upload.stream
+    if not isinstance(spool, UploadSpool):
+        spool = UploadSpool(os.path.join(folder, '.tmp'), 0)
+        shutil.copyfileobj(upload.stream, spool, CHUNK_SIZE)
+    try:
+        ext = sniff(spool.head)
+        if ext is None:
+            raise UploadRejected('Only PNG, JPEG, GIF and WebP images can be uploaded.')
+        name = spool.digest.hexdigest() + ext
+        spool.seek(0)
+        info = describe(spool)
+        # Record first: a fresh stored_at keeps prune() away from the file
+        _record(name, spool.size, 1 if pin else 0, info)
+        path = os.path.join(folder, relative_path(name))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            spool.persist(path)
+    finally:
+        spool.close()
+    upload_stored.send(current_app._get_current_object(), name=name)
+    return name
+
+
+def _record(name, size, refs, info=None):
+    # Committed on its own, so the row exists before any Content row points at it
+    files = StoredFile.__table__
+    now = datetime.now(timezone.utc)
+    bump = files.update().where(files.c.name == name).values(refcount=files.c.refcount + refs, stored_at=now)
+    with db.engine.begin() as connection:
+        if connection.execute(bump).rowcount:
+            return
+    measured = info._asdict() if info is not None else {}
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(files.insert().values(name=name, size=size, refcount=refs, stored_at=now, **measured))
+    except IntegrityError:
+        # Stored concurrently by another request
+        with db.engine.begin() as connection:
+            connection.execute(bump)
+
+
+def prune(min_age=86400):
+    """Delete stored files nothing refers to and nobody uploaded in the last `min_age` seconds.
+
+    The age check spares uploads whose post has not been committed yet.
+    Each file is moved aside before its row is deleted, and moved back if
+    the row was re-referenced or re-uploaded meanwhile. Returns the number
+    of files removed.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    files = StoredFile.__table__
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+    candidates = db.session.execute(
+        db.select(files.c.name).where(files.c.refcount <= 0, files.c.stored_at < cutoff)
+    ).scalars().all()
+    db.session.commit()
+    app = current_app._get_current_object()
+    removed = 0
+    for name in candidates:
+        path = os.path.join(folder, relative_path(name))
+        aside = os.path.join(folder, '.tmp', f'prune-{name}')
+        has_file = os.path.exists(path)
+        if has_file:
+            os.makedirs(os.path.dirname(aside), exist_ok=True)
+            os.replace(path, aside)
+        with db.engine.begin() as connection:
+            deleted = connection.execute(
+                files.delete().where(files.c.name == name, files.c.refcount <= 0, files.c.stored_at < cutoff)
+            ).rowcount
+        if has_file and not deleted:
+            os.replace(aside, path)
+            continue
+        if has_file:
+            os.unlink(aside)
+        if deleted:
+            upload_pruned.send(app, name=name)
+            removed += 1
+    return removed
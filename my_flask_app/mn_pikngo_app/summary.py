@@ -0,0 +1,61 @@
+# summary.py
+
+import math
+from collections import namedtuple
+from html.parser import HTMLParser
+
+EXCERPT_WORDS = 50
+WORDS_PER_MINUTE = 200
+
+Summary = namedtuple('Summary', ['excerpt', 'word_count', 'reading_time'])
+
+# Tags that separate words; inline tags like <b> may sit inside a word
+BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'header', 'hr', 'img', 'li', 'ol', 'p', 'pre', 'section', 'table', 'td',
+    'th', 'tr', 'ul',
+}
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of a CKEditor HTML fragment."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skip:
+            self._skip -= 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def plain_text(html):
+    """Strip tags from `html` and collapse whitespace."""
+    parser = _TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    return ' '.join(''.join(parser.parts).split())
+
+
+def summarize(html, words=EXCERPT_WORDS):
+    """Derive the listing excerpt, word count and reading time (minutes) of `html`."""
+    tokens = plain_text(html).split()
+    excerpt = ' '.join(tokens[:words])
+    if len(tokens) > words:
+        excerpt += '...'
+    minutes = max(1, math.ceil(len(tokens) / WORDS_PER_MINUTE)) if tokens else 0
+    return Summary(excerpt, len(tokens), minutes)
@@ -0,0 +1,155 @@
+# surrogate.py
+
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+import urllib.request
+from functools import wraps
+from http.client import HTTPException
+from flask import current_app, session
+from flask_login import current_user
+from signals import content_changed
+
+
+def add_surrogate_keys(response, keys):
+    """Tag a response for the edge cache, and let it keep anonymous pages for SURROGATE_MAX_AGE."""
+    if response.status_code not in (200, 304):
+        return response
+    header = current_app.config.get('SURROGATE_KEY_HEADER', 'xkey')
+    response.headers[header] = ' '.join(keys)
+    max_age = current_app.config.get('SURROGATE_MAX_AGE')
+    # The session cookie is only added after the view returns, so a touched
+    # session (a CSRF token, a consumed flash) is what marks a page as personal
+    personal = session.modified or 'Set-Cookie' in response.headers
+    if max_age and not current_user.is_authenticated and not personal:
+        # Only the edge reads this; browsers still revalidate per Cache-Control
+        response.headers['Surrogate-Control'] = f'max-age={max_age}'
+    return response
+
+
+def surrogate_keys(*templates):
+    """Tag the view's responses with keys formatted from its URL arguments, e.g. 'post-{post_id}'."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = current_app.make_response(view(*args, **kwargs))
+            return add_surrogate_keys(response, [template.format(**kwargs) for template in templates])
+        return wrapper
+    return decorator
+
+
+def keys_for_changes(changes):
+    keys = {'post-list', 'search'}
+    keys.update(f'post-{change.id}' for change in changes)
+    return keys
+
+
+class Purger:
+    """Sends purges to the edge cache nodes, from one background thread per node.
+
+    Keys queued within `batch_delay` of each other go out as one request
+    per node. Each node has its own queue, so a slow or failing node only
+    delays its own purges (keys queued meanwhile join its next request).
+    A failed request is retried with exponential backoff; after `retries`
+    attempts the batch is dropped and the edge falls back to its TTL.
+    """
+
+    def __init__(self, app, nodes, method='PURGE', header='xkey-purge',
+                 retries=5, backoff=0.5, batch_delay=0.05, timeout=5):
+        self.app = app
+        self.nodes = nodes
+        self.method = method
+        self.header = header
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self._queues = {node: queue.Queue() for node in nodes}
+        self._due = {node: [] for node in nodes}  # node -> heap of (due, tiebreak, attempt, keys)
+        self._tiebreak = itertools.count()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.sent = 0
+        self.failed = 0
+
+    def purge(self, keys):
+        self._ensure_threads()
+        for node_queue in self._queues.values():
+            node_queue.put(set(keys))
+
+    def _ensure_threads(self):
+        # Threads do not survive a fork; start them in each worker on first use
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                for node in self.nodes:
+                    threading.Thread(target=self._run, args=(node,), daemon=True).start()
+
+    def _run(self, node):
+        node_queue, due = self._queues[node], self._due[node]
+        while True:
+            timeout = max(0.0, due[0][0] - time.monotonic()) if due else None
+            try:
+                keys = node_queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                time.sleep(self.batch_delay)
+                while True:
+                    try:
+                        keys |= node_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self._deliver(node, keys, 0)
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                _, _, attempt, keys = heapq.heappop(due)
+                self._deliver(node, keys, attempt)
+
+    def _deliver(self, node, keys, attempt):
+        request = urllib.request.Request(node, method=self.method, headers={self.header: ' '.join(sorted(keys))})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (OSError, HTTPException) as error:  # includes HTTP error statuses
+            if attempt + 1 < self.retries:
+                due = time.monotonic() + self.backoff * 2 ** attempt
+                heapq.heappush(self._due[node], (due, next(self._tiebreak), attempt + 1, keys))
+            else:
+                with self._lock:
+                    self.failed += 1
+                self.app.logger.warning('Giving up purging %s on %s: %s', ' '.join(sorted(keys)), node, error)
+            return
+        with self._lock:
+            self.sent += 1
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retrying': sum(len(due) for due in self._due.values()),
+            'queued': sum(node_queue.qsize() for node_queue in self._queues.values()),
+        }
+
+
+def _purge_changes(app, changes, remote=False, **extra):
+    # The worker that made the write purges; the others only hear about it
+    if not remote:
+        app.extensions['surrogate_purger'].purge(keys_for_changes(changes))
+
+
+def init_surrogate(app):
+    """Purge changed posts from the SURROGATE_CACHE_NODES after every content write."""
+    if not app.config.get('SURROGATE_CACHE_NODES'):
+        return
+    app.extensions['surrogate_purger'] = Purger(
+        app,
+        app.config['SURROGATE_CACHE_NODES'],
+        method=app.config.get('SURROGATE_PURGE_METHOD', 'PURGE'),
+        header=app.config.get('SURROGATE_PURGE_HEADER', 'xkey-purge'),
+        retries=app.config.get('SURROGATE_PURGE_RETRIES', 5),
+    )
+    content_changed.connect(_purge_changes, sender=app, weak=False)
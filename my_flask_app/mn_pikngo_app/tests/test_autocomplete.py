@@ -0,0 +1,87 @@
+import pytest
+from flask import Flask
+from autocomplete import TitleIndex, get_title_index, init_autocomplete
+from models import db, Content
+
+def test_prefix_matches_any_word():
+    """Test that prefixes match the start of any word in a title, case-insensitively."""
+    index = TitleIndex()
+    index.rebuild([(1, 'Peanut Butter'), (2, 'Sugarcane juice'), (3, 'Butternut soup')])
+    assert index.suggest('pea') == [(1, 'Peanut Butter')]
+    assert index.suggest('BUTTER') == [(1, 'Peanut Butter'), (3, 'Butternut soup')]
+    assert index.suggest('peanut b') == [(1, 'Peanut Butter')]
+    assert index.suggest('x') == []
+    assert index.suggest('   ') == []
+
+def test_limit_and_duplicates():
+    """Test that a title matching on several words is returned once and limits apply."""
+    index = TitleIndex()
+    index.rebuild([(i, f'Nuts and nuts {i}') for i in range(10)])
+    assert len(index.suggest('nuts', limit=3)) == 3
+    assert len(index.suggest('nuts', limit=50)) == 10
+
+def test_changes_during_a_rebuild_survive_it():
+    """Test that writes made after the rebuild's rows were read are applied over them."""
+    index = TitleIndex()
+    index.rebuild([(1, 'Mango lassi')])
+    index.begin_rebuild()
+    rows = [(1, 'Mango lassi'), (2, 'Pear juice')]
+    index.add(1, 'Papaya lassi')
+    index.remove(2)
+    index.rebuild(rows)
+    assert index.suggest('lassi') == [(1, 'Papaya lassi')]
+    assert index.suggest('pear') == [] and len(index) == 1
+
+def test_incremental_updates():
+    """Test that add replaces a post's old title and remove drops it."""
+    index = TitleIndex()
+    index.rebuild([(1, 'Mango lassi')])
+    index.add(1, 'Papaya lassi')
+    index.add(2, 'Mango smoothie')
+    assert index.suggest('mango') == [(2, 'Mango smoothie')]
+    index.remove(2)
+    assert index.suggest('mango') == []
+    assert index.suggest('lassi') == [(1, 'Papaya lassi')]
+
+@pytest.fixture
+def app():
+    """Create a bare app with the title index registered."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['AUTOCOMPLETE_MAX_AGE'] = 300
+    db.init_app(app)
+    init_autocomplete(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_follows_committed_writes(app):
+    """Test that commits update a built index without waiting for a rebuild."""
+    db.session.add(Content(title='Peanut butter', body='b'))
+    db.session.commit()
+    index = get_title_index(app)
+    assert index.suggest('pea') == [(1, 'Peanut butter')]
+
+    post = Content(title='Pear juice', body='b')
+    db.session.add(post)
+    db.session.commit()
+    assert [title for _, title in index.suggest('pea')] == ['Peanut butter', 'Pear juice']
+
+    post.title = 'Apple juice'
+    db.session.commit()
+    db.session.delete(db.session.get(Content, 1))
+    db.session.commit()
+    assert index.suggest('pea') == []
+    assert index.suggest('apple') == [(2, 'Apple juice')]
+
+def test_stale_index_rebuilds_in_the_background(app):
+    """Test that a lookup on an old index returns it at once and one thread rebuilds it."""
+    index = get_title_index(app)
+    db.session.execute(Content.__table__.insert().values(title='Mango lassi', body='b'))  # no signal
+    db.session.commit()
+    app.config['AUTOCOMPLETE_MAX_AGE'] = 0
+    built_at = index.built_at
+    assert get_title_index(app) is index
+    with index.rebuild_lock:  # until the thread is done
+        assert index.built_at > built_at
+    assert index.suggest('mango') == [(1, 'Mango lassi')]
@@ -0,0 +1,115 @@
+import pytest
+from flask import Flask
+from sqlalchemy import event
+
+np = pytest.importorskip('numpy')
+
+from bm25 import Bm25Index
+from models import db, Content
+from search import Bm25Backend, get_backend, search_posts
+
+DOCS = [
+    (1, ['peanut', 'butter', 'fresh', 'peanut']),
+    (2, ['sugarcane', 'juice', 'cold']),
+    (3, ['trail', 'mix', 'cashew', 'peanut', 'raisin', 'raisin', 'date']),
+]
+
+def test_ranks_by_bm25(tmp_path):
+    """Test that higher term frequency in a shorter document ranks first."""
+    index = Bm25Index.build(str(tmp_path), DOCS)
+    total, hits = index.search(['peanut'])
+    assert total == 2
+    assert [doc_id for doc_id, _ in hits] == [1, 3]
+    assert hits[0][1] > hits[1][1] > 0
+    assert index.search(['missing']) == (0, [])
+
+def test_pagination_is_stable(tmp_path):
+    """Test that offset/limit pages partition the full ranking."""
+    index = Bm25Index.build(str(tmp_path), [(i, ['nuts'] * (i % 7 + 1) + ['x'] * i) for i in range(1, 40)])
+    _, everything = index.search(['nuts'], limit=39)
+    pages = [index.search(['nuts'], offset=offset, limit=10)[1] for offset in range(0, 40, 10)]
+    assert [hit for page in pages for hit in page] == everything
+
+def test_updates_are_shared_between_workers(tmp_path):
+    """Test that upserts and deletes from one instance reach another mapping the same files."""
+    writer = Bm25Index.build(str(tmp_path), DOCS)
+    reader = Bm25Index(str(tmp_path))
+    assert reader.search(['juice'])[0] == 1
+
+    writer.upsert(2, ['mango', 'smoothie'])
+    writer.upsert(4, ['mango', 'lassi'])
+    writer.delete(1)
+    assert reader.search(['juice']) == (0, [])
+    assert sorted(doc_id for doc_id, _ in reader.search(['mango'])[1]) == [2, 4]
+    assert [doc_id for doc_id, _ in reader.search(['peanut'])[1]] == [3]
+
+def test_rebuild_swaps_segment(tmp_path):
+    """Test that readers pick up a rebuilt segment and drop the old delta."""
+    reader = Bm25Index.build(str(tmp_path), DOCS)
+    reader.upsert(9, ['papaya'])
+    assert reader.search(['papaya'])[0] == 1
+    Bm25Index.build(str(tmp_path), [(5, ['guava'])])
+    assert reader.search(['papaya'])[0] == 0
+    assert reader.search(['guava'])[1][0][0] == 5
+
+def test_rebuild_keeps_updates_logged_while_it_read(tmp_path):
+    """Test that updates logged after the rebuild's read began are carried into the new segment."""
+    index = Bm25Index.build(str(tmp_path), DOCS)
+    index.upsert(3, ['walnut'])  # already in what the rebuild reads
+    since = index.log_position()
+    index.upsert(2, ['mango', 'smoothie'])
+    index.delete(1)
+    rebuilt = Bm25Index.build(str(tmp_path), DOCS, since=since)
+    assert rebuilt.search(['mango'])[0] == 1 and rebuilt.search(['juice'])[0] == 0
+    assert rebuilt.search(['butter'])[0] == 0
+    assert rebuilt.search(['walnut'])[0] == 0
+
+@pytest.fixture
+def app(tmp_path):
+    """Create a bare app using the BM25 backend."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SEARCH_BACKEND'] = 'bm25'
+    app.config['SEARCH_INDEX_PATH'] = str(tmp_path / 'index')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_backend_follows_commits(app):
+    """Test that only committed writes reach the BM25 index."""
+    db.session.add(Content(title='Peanut butter', body='<p>Roasted peanuts</p>'))
+    db.session.commit()
+    assert isinstance(get_backend(), Bm25Backend)
+    results = search_posts('peanut butter')
+    assert results.total == 1
+    assert '<mark>' in results.hits[0].snippet
+
+    post = Content.query.first()
+    post.title = 'Cashew butter'
+    db.session.flush()
+    db.session.rollback()
+    assert search_posts('cashew').total == 0
+
+    db.session.delete(Content.query.first())
+    db.session.commit()
+    assert search_posts('peanut').total == 0
+
+def test_failed_commit_does_not_reach_the_index(app):
+    """Test that a change whose COMMIT fails is never appended to the delta log."""
+    db.session.add(Content(title='Peanut butter', body='<p>Roasted peanuts</p>'))
+    db.session.commit()
+    assert search_posts('peanut').total == 1
+
+    def fail(connection):
+        raise RuntimeError('database is locked')
+
+    event.listen(db.engine, 'commit', fail)
+    try:
+        db.session.add(Content(title='Cashew butter', body='<p>Creamy</p>'))
+        with pytest.raises(RuntimeError):
+            db.session.commit()
+        db.session.rollback()
+    finally:
+        event.remove(db.engine, 'commit', fail)
+    assert search_posts('cashew').total == 0
@@ -0,0 +1,128 @@
+import pytest
+import pickle
+import sys
+from cache import ENTRY_OVERHEAD, LRUCache, RedisCache, SqliteCache, make_cache, stored_form
+
+def test_get_set_and_counters():
+    """Test that hits and misses are counted."""
+    cache = LRUCache(max_bytes=10_000)
+    assert cache.get('nuts') is None
+    cache.set('nuts', [1, 2, 3])
+    assert cache.get('nuts') == [1, 2, 3]
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_evicts_least_recently_used_within_byte_cap():
+    """Test that the byte cap evicts the least recently used entries first."""
+    cache = LRUCache(max_bytes=300)
+    for key in 'abc':
+        cache.set(key, 'x', size=100)
+    cache.get('a')
+    cache.set('d', 'x', size=100)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'x'
+    assert cache.size == 300
+    assert cache.stats()['evictions'] == 1
+
+def test_oversized_and_replaced_entries():
+    """Test that entries larger than the cap are refused and replacing frees the old size."""
+    cache = LRUCache(max_bytes=100)
+    assert not cache.set('big', 'x', size=101)
+    cache.set('k', 'x', size=60)
+    cache.set('k', 'y', size=40)
+    assert cache.size == 40
+    cache.delete('k')
+    assert cache.size == 0 and len(cache) == 0
+
+def test_byte_cap_bounds_what_is_held():
+    """Test that unsized values are kept pickled, charged what they occupy, and the cap holds."""
+    value = [(n, 1.5 * n, None) for n in range(50)]
+    kept, pickled, size = stored_form('k', value)
+    assert pickled and pickle.loads(kept) == value
+    assert size == sys.getsizeof('k') + sys.getsizeof(kept) + ENTRY_OVERHEAD
+    assert stored_form('k', 'text') == ('text', False, sys.getsizeof('k') + sys.getsizeof('text') + ENTRY_OVERHEAD)
+    cache = LRUCache(max_bytes=3 * size)
+    for n in range(5):
+        cache.set(f'{n}', value)
+    assert len(cache) == 3 and cache.size <= cache.max_bytes
+    held = sum(sys.getsizeof(key) + sys.getsizeof(entry[0]) for key, entry in cache._entries.items())
+    assert held + len(cache) * ENTRY_OVERHEAD == cache.size
+    assert cache.get('4') == value and cache.get('4') is not cache.get('4')
+
+def test_sqlite_cache_shared_between_instances(tmp_path):
+    """Test that the SQLite store is visible to other instances and evicts the oldest writes."""
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = SqliteCache(path, max_bytes=250)
+    cache.set('a', 'x', size=100)
+    cache.set('b', {'n': 1}, size=100)
+    other = SqliteCache(path, max_bytes=250)
+    assert other.get('b') == {'n': 1}
+    other.set('c', 'z', size=100)
+    assert cache.get('a') is None
+    assert cache.get('c') == 'z'
+    assert other.stats()['evictions'] == 1
+
+def test_sqlite_cache_keeps_a_running_total(tmp_path):
+    """Test that the stored total follows replaces, deletes and clears, and is summed once for older files."""
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = SqliteCache(path, max_bytes=1000)
+    cache.set('a', 'x', size=100)
+    cache.set('b', 'x', size=200)
+    cache.set('a', 'y', size=50)
+    cache.delete('b')
+    cache.delete('missing')
+    assert cache.size == 50
+    cache._connection().execute('DROP TABLE totals')
+    assert SqliteCache(path, max_bytes=1000).size == 50
+    cache.clear()
+    assert cache.size == 0 and len(cache) == 0
+
+def test_ttl_expires_entries(tmp_path, monkeypatch):
+    """Test that every backend treats entries past their TTL as misses."""
+    now = [1000.0]
+    monkeypatch.setattr('cache.time.time', lambda: now[0])
+    for cache in (LRUCache(10_000), SqliteCache(str(tmp_path / 'cache.sqlite3'), 10_000)):
+        cache.set('k', 'v', ttl=10)
+        cache.set('forever', 'v')
+        now[0] += 11
+        assert cache.get('k') is None
+        assert cache.get('forever') == 'v'
+        now[0] = 1000.0
+
+def test_namespaces_have_separate_entries_and_stats(tmp_path):
+    """Test that namespaces sharing a SQLite file keep their own keys, caps and counters."""
+    path = str(tmp_path / 'cache.sqlite3')
+    pages, search = SqliteCache(path, 100, 'pages'), SqliteCache(path, 100, 'search')
+    pages.set('k', 'page', size=80)
+    search.set('k', 'hits', size=80)
+    assert pages.get('k') == 'page' and search.get('k') == 'hits'
+    search.set('other', 'x', size=80)
+    assert pages.get('k') == 'page'
+    assert search.stats()['evictions'] == 1 and pages.stats()['evictions'] == 0
+    assert pages.stats()['hits'] == 2 and search.stats()['hits'] == 1
+
+def test_make_cache_picks_backend_per_namespace(tmp_path):
+    """Test that CACHE_BACKENDS overrides CACHE_BACKEND and 0 bytes disables a cache."""
+    config = {
+        'CACHE_BACKEND': 'memory',
+        'CACHE_BACKENDS': {'pages': 'sqlite'},
+        'CACHE_PATH': str(tmp_path / 'cache.sqlite3'),
+    }
+    assert isinstance(make_cache(config, 'search', 1000), LRUCache)
+    assert isinstance(make_cache(config, 'pages', 1000), SqliteCache)
+    assert make_cache(config, 'search', 0) is None
+
+def test_redis_cache():
+    """Test the Redis backend against a local redis-server, when there is one."""
+    redis = pytest.importorskip('redis')
+    try:
+        cache = RedisCache('redis://localhost:6379/15', namespace='test')
+        cache.clear()
+    except redis.ConnectionError:
+        pytest.skip('no local redis-server')
+    cache.set('k', {'n': 1}, ttl=60)
+    assert cache.get('k') == {'n': 1}
+    assert cache.get('missing') is None
+    cache.clear()
+    assert cache.get('k') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
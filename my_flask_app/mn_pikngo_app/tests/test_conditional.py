@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from flask import Flask, flash
+from flask_login import LoginManager
+from conditional import add_validators, make_etag, not_modified, not_modified_response
+
+MODIFIED = datetime(2024, 3, 1, 12, 0, 0)
+
+@pytest.fixture
+def client():
+    """Create a bare app with one conditionally rendered page."""
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.config['APP_RELEASE'] = 'test-release'
+    LoginManager(app).user_loader(lambda user_id: None)
+    app.renders = 0
+
+    @app.route('/page/<int:version>')
+    def page(version):
+        etag = make_etag('page', version)
+        if not_modified(etag, MODIFIED):
+            return not_modified_response(etag, MODIFIED)
+        app.renders += 1
+        return add_validators(app.make_response('rendered'), etag, MODIFIED)
+
+    @app.route('/flash')
+    def flash_message():
+        flash('Saved')
+        return 'ok'
+
+    with app.test_client() as client:
+        client.application = app
+        yield client
+
+def test_validators_sent(client):
+    """Test that pages carry an ETag, Last-Modified and revalidation headers."""
+    response = client.get('/page/1')
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified'] == 'Fri, 01 Mar 2024 12:00:00 GMT'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['Vary'] == 'Cookie'
+
+def test_if_none_match(client):
+    """Test that a matching ETag gets a bodiless 304 without rendering."""
+    etag = client.get('/page/1').headers['ETag']
+    response = client.get('/page/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert client.application.renders == 1
+    assert client.get('/page/2', headers={'If-None-Match': etag}).status_code == 200
+
+def test_if_modified_since(client):
+    """Test Last-Modified revalidation, and that If-None-Match takes precedence."""
+    since = (MODIFIED + timedelta(seconds=1)).replace(tzinfo=timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+    assert client.get('/page/1', headers={'If-Modified-Since': since}).status_code == 304
+    older = 'Fri, 01 Mar 2024 11:59:59 GMT'
+    assert client.get('/page/1', headers={'If-Modified-Since': older}).status_code == 200
+    assert client.get('/page/1', headers={'If-Modified-Since': since, 'If-None-Match': '"other"'}).status_code == 200
+
+def test_pending_flash_forces_render(client):
+    """Test that a queued flash message disables 304s."""
+    etag = client.get('/page/1').headers['ETag']
+    client.get('/flash')
+    assert client.get('/page/1', headers={'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,82 @@
+import pytest
+from flask import Flask
+from files import HotFileCache, serve_file
+
+@pytest.fixture
+def app(tmp_path):
+    """Create a bare app serving files from a temporary directory."""
+    (tmp_path / 'menu.pdf').write_bytes(b'%PDF' + bytes(1000))
+    app = Flask(__name__)
+    app.config['MEDIA_MAX_AGE'] = 3600
+    app.config['MEDIA_ACCEL_LOCATIONS'] = {str(tmp_path): '/protected/files/'}
+
+    @app.route('/files/<filename>')
+    def files(filename):
+        return serve_file(str(tmp_path), filename, as_attachment=True)
+
+    return app
+
+def test_range_etag_and_cache_headers(app):
+    """Test that files are cacheable, revalidate by ETag and honour Range."""
+    client = app.test_client()
+    response = client.get('/files/menu.pdf')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=3600'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert client.get('/files/menu.pdf', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    partial = client.get('/files/menu.pdf', headers={'Range': 'bytes=0-3'})
+    assert partial.status_code == 206
+    assert partial.data == b'%PDF'
+
+def test_missing_and_escaping_paths_404(app):
+    """Test that unknown files and paths outside the directory are not found."""
+    client = app.test_client()
+    assert client.get('/files/nothere.pdf').status_code == 404
+    assert client.get('/files/..%2Fsecret').status_code == 404
+
+def test_x_accel_redirect(app):
+    """Test that offloading to nginx sends only the internal location."""
+    app.config['MEDIA_OFFLOAD'] = 'x-accel'
+    response = app.test_client().get('/files/menu.pdf')
+    assert response.headers['X-Accel-Redirect'] == '/protected/files/menu.pdf'
+    assert response.headers['Content-Type'] == 'application/pdf'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=menu.pdf'
+    assert response.data == b''
+
+@pytest.fixture
+def hot_app(app, tmp_path):
+    """Add a hot-file cache that holds files up to 2000 bytes."""
+    app.extensions['media_cache'] = HotFileCache(max_bytes=100_000, max_file_size=2000, ttl=60)
+    (tmp_path / 'big.pdf').write_bytes(bytes(5000))
+    return app
+
+def test_hot_cache_serves_from_memory(hot_app, tmp_path):
+    """Test that small files are read once and keep send_file's validators and Range support."""
+    client = hot_app.test_client()
+    first = client.get('/files/menu.pdf')
+    (tmp_path / 'menu.pdf').unlink()
+    second = client.get('/files/menu.pdf')
+    assert second.data == first.data
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.headers['Content-Type'] == 'application/pdf'
+    assert client.get('/files/menu.pdf', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert client.get('/files/menu.pdf', headers={'Range': 'bytes=0-3'}).data == b'%PDF'
+    assert hot_app.extensions['media_cache'].stats()['hits'] == 3
+
+def test_hot_cache_rechecks_after_ttl(hot_app, tmp_path):
+    """Test that a changed file is picked up once its entry is past the TTL."""
+    cache = hot_app.extensions['media_cache']
+    client = hot_app.test_client()
+    client.get('/files/menu.pdf')
+    (tmp_path / 'menu.pdf').write_bytes(b'%PDF changed')
+    cache.ttl = 0
+    assert client.get('/files/menu.pdf').data == b'%PDF changed'
+    (tmp_path / 'menu.pdf').unlink()
+    assert client.get('/files/menu.pdf').status_code == 404
+
+def test_big_files_bypass_hot_cache(hot_app):
+    """Test that files over the size threshold are streamed from disk."""
+    response = hot_app.test_client().get('/files/big.pdf')
+    assert response.status_code == 200 and len(response.data) == 5000
+    assert hot_app.extensions['media_cache'].stats()['bypassed'] == 1
+    assert len(hot_app.extensions['media_cache'].files) == 0
@@ -0,0 +1,29 @@
+from jinja2 import Environment
+from cache import LRUCache
+from fragments import FragmentCacheExtension
+
+def make_env(cache):
+    env = Environment(extensions=[FragmentCacheExtension], autoescape=True)
+    env.fragment_cache = cache
+    return env
+
+def test_block_rendered_once_per_key():
+    """Test that a cached block is reused until its key parts change."""
+    calls = []
+    template = make_env(LRUCache(10_000)).from_string(
+        "{% cache 'card', id, version %}{{ render() }}{% endcache %}"
+    )
+    def render():
+        calls.append(1)
+        return '<b>&</b>'
+    assert template.render(id=1, version=1, render=render) == '&lt;b&gt;&amp;&lt;/b&gt;'
+    assert template.render(id=1, version=1, render=render) == '&lt;b&gt;&amp;&lt;/b&gt;'
+    assert len(calls) == 1
+    template.render(id=1, version=2, render=render)
+    template.render(id=2, version=1, render=render)
+    assert len(calls) == 3
+
+def test_renders_without_a_cache():
+    """Test that templates still render when no store is configured."""
+    env = Environment(extensions=[FragmentCacheExtension])
+    assert env.from_string("{% cache 'x', 1 %}hi{% endcache %}").render() == 'hi'
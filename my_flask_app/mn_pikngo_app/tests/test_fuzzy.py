@@ -0,0 +1,100 @@
+import pytest
+from flask import Flask
+from fuzzy import TrigramIndex, edit_distance, get_trigram_index, init_fuzzy
+from models import db, Content
+
+@pytest.mark.parametrize('a, b, expected', [
+    ('butter', 'butter', 0),
+    ('buter', 'butter', 1),
+    ('sugracane', 'sugarcane', 1),
+    ('kitten', 'sitting', 3),
+])
+def test_edit_distance(a, b, expected):
+    """Test optimal string alignment distance, counting swaps as one edit."""
+    assert edit_distance(a, b, limit=5) == expected
+
+def test_edit_distance_cutoff():
+    """Test that distances past the limit stop early."""
+    assert edit_distance('peanut', 'cashew', limit=2) == 3
+
+def test_corrects_misspellings():
+    """Test that unknown terms map to close vocabulary terms and known ones stay."""
+    index = TrigramIndex()
+    index.rebuild(enumerate([['peanut', 'butter'], ['sugarcane', 'juice'], ['butternut', 'soup'], ['butter', 'biscuits']]))
+    assert index.correct('sugracane') == 'sugarcane'
+    assert index.correct('buter') == 'butter'
+    assert index.correct('butter') is None
+    assert index.correct('zebra') is None
+    assert index.correct_query('peanut buter') == 'peanut butter'
+    assert index.correct_query('peanut butter') is None
+
+def test_edits_replace_a_posts_terms():
+    """Test that re-adding a post replaces its document frequencies and removing it withdraws its terms."""
+    index = TrigramIndex()
+    index.rebuild([(1, ['butter']), (2, ['batter']), (3, ['batter'])])
+    assert index.correct('bwtter') == 'batter'
+    for _ in range(3):
+        index.add(1, ['butter'])
+    assert index.correct('bwtter') == 'batter'
+    index.add(1, ['buttermilk'])
+    index.remove(2)
+    index.remove(3)
+    assert 'butter' not in index and 'batter' not in index
+    assert index.correct('bwtter') is None
+
+@pytest.fixture
+def app():
+    """Create a bare app with the trigram index registered."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['FUZZY_MAX_AGE'] = 600
+    db.init_app(app)
+    init_fuzzy(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_picks_up_new_posts(app):
+    """Test that posts committed after the build are folded in on the next lookup."""
+    db.session.add(Content(title='Fresh juice', body='<p>Cold pressed <b>sugarcane</b></p>'))
+    db.session.commit()
+    assert get_trigram_index(app).correct('sugracane') == 'sugarcane'
+    assert get_trigram_index(app).correct('macadamai') is None
+
+    db.session.add(Content(title='Nut mix', body='<p>Roasted macadamia</p>'))
+    db.session.commit()
+    assert get_trigram_index(app).correct('macadamai') == 'macadamia'
+
+def test_edits_and_deletes_are_folded_in(app):
+    """Test that an edited post loses its old terms and a deleted one all of its terms."""
+    post = Content(title='Fresh juice', body='<p>Cold pressed sugarcane</p>')
+    db.session.add(post)
+    db.session.commit()
+    assert get_trigram_index(app).correct('sugracane') == 'sugarcane'
+    post.body = '<p>Cold pressed pineapple</p>'
+    db.session.commit()
+    assert get_trigram_index(app).correct('sugracane') is None
+    db.session.delete(post)
+    db.session.commit()
+    assert get_trigram_index(app).correct('pinapple') is None
+
+def test_stale_index_rebuilds_in_the_background(app):
+    """Test that a lookup on an old index returns it at once and one thread rebuilds it."""
+    index = get_trigram_index(app)
+    db.session.execute(Content.__table__.insert().values(title='Nut mix', body='macadamia'))  # no signal
+    db.session.commit()
+    app.config['FUZZY_MAX_AGE'] = 0
+    built_at = index.built_at
+    assert get_trigram_index(app) is index
+    with index.rebuild_lock:  # until the thread is done
+        assert index.built_at > built_at
+    assert index.correct('macadamai') == 'macadamia'
+
+def test_changes_noted_during_a_lookup_wait_for_the_next():
+    """Test that ids noted after a lookup took its batch stay pending and are not treated as deleted."""
+    index = TrigramIndex()
+    index.note([1, 2])
+    taken = index.take_pending()
+    index.note([3])
+    assert taken == {1, 2} and index.pending_ids == {3}
+    assert index.take_pending() == {3} and index.take_pending() == set()
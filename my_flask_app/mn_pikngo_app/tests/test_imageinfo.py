@@ -0,0 +1,29 @@
+import io
+import pytest
+from imageinfo import describe
+
+Image = pytest.importorskip('PIL.Image')
+
+def image_bytes(size, fmt='JPEG', orientation=None):
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (20, 90, 200)).save(buffer, fmt, exif=exif)
+    return buffer.getvalue()
+
+def test_describe_size_and_placeholder():
+    """Test that the size is read and the placeholder is a small inline image."""
+    info = describe(io.BytesIO(image_bytes((1600, 900))))
+    assert (info.width, info.height) == (1600, 900)
+    assert info.placeholder.startswith('data:image/')
+    assert len(info.placeholder) < 400
+
+def test_describe_applies_exif_rotation():
+    """Test that a photo stored sideways reports its displayed size."""
+    info = describe(io.BytesIO(image_bytes((1600, 900), orientation=6)))
+    assert (info.width, info.height) == (900, 1600)
+
+def test_describe_unreadable():
+    """Test that bytes Pillow cannot read give None."""
+    assert describe(io.BytesIO(b'GIF89a' + bytes(10))) is None
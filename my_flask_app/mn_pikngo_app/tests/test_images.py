@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+import pytest
+from flask import Flask
+from werkzeug.exceptions import BadRequest
+import images
+from images import Encoder, Resizer, encode, encoded_name, parse_variant, resize, serve_image
+
+Image = pytest.importorskip('PIL.Image')
+
+PRESETS = {'thumb': (100, 100, 'contain'), 'square': (50, 50, 'cover')}
+
+def write_image(path, size=(400, 200), fmt='PNG'):
+    Image.new('RGB', size, (200, 30, 30)).save(path, fmt)
+
+def test_parse_variant_allows_only_presets():
+    """Test that only whitelisted sizes are accepted."""
+    assert parse_variant({}, PRESETS) is None
+    assert parse_variant({'w': '50', 'h': '50', 'fit': 'cover'}, PRESETS) == (50, 50, 'cover')
+    for args in ({'w': '51', 'h': '50', 'fit': 'cover'}, {'w': 'x'}, {'w': '100', 'h': '100', 'fit': 'cover'}):
+        with pytest.raises(BadRequest):
+            parse_variant(args, PRESETS)
+
+def test_resize_contain_and_cover(tmp_path):
+    """Test that contain keeps the aspect ratio, cover crops to the box, and neither enlarges."""
+    write_image(tmp_path / 'a.png')
+    resize(str(tmp_path / 'a.png'), str(tmp_path / 'out' / 'contain.png'), (100, 100, 'contain'))
+    resize(str(tmp_path / 'a.png'), str(tmp_path / 'out' / 'cover.png'), (50, 50, 'cover'))
+    resize(str(tmp_path / 'a.png'), str(tmp_path / 'out' / 'large.png'), (800, 800, 'contain'))
+    sizes = {name: Image.open(tmp_path / 'out' / name).size for name in ('contain.png', 'cover.png', 'large.png')}
+    assert sizes == {'contain.png': (100, 50), 'cover.png': (50, 50), 'large.png': (400, 200)}
+    assert sorted(os.listdir(tmp_path / 'out')) == ['contain.png', 'cover.png', 'large.png']
+
+def test_concurrent_requests_share_one_resize(tmp_path, monkeypatch):
+    """Test that a burst of requests for a new size resizes once and reuses the file after."""
+    write_image(tmp_path / 'a.png')
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+    real_resize = images.resize
+
+    def slow_resize(source, target, variant):
+        calls.append(target)
+        started.set()
+        release.wait(5)
+        real_resize(source, target, variant)
+
+    monkeypatch.setattr(images, 'resize', slow_resize)
+    resizer = Resizer(str(tmp_path / 'variants'))
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(resizer.derivative(str(tmp_path), 'a.png', (100, 100, 'contain'))))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    deadline = time.monotonic() + 5
+    while resizer.joined < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and len(set(results)) == 1 and len(results) == 5
+    assert resizer.derivative(str(tmp_path), 'a.png', (100, 100, 'contain')) == results[0]
+    assert len(calls) == 1
+
+def test_unreadable_source_fails(tmp_path):
+    """Test that a file Pillow cannot read raises and leaves no derivative behind."""
+    (tmp_path / 'notes.png').write_bytes(b'not an image')
+    resizer = Resizer(str(tmp_path / 'variants'))
+    with pytest.raises(OSError):
+        resizer.derivative(str(tmp_path), 'notes.png', (100, 100, 'contain'))
+    assert resizer.stats()['failed'] == 1
+    assert not os.path.exists(tmp_path / 'variants')
+
+def test_remove_deletes_only_that_uploads_derivatives(tmp_path):
+    """Test that pruning an upload removes its derivatives and no others."""
+    resizer = Resizer(str(tmp_path))
+    keep, drop = 'ab' + '1' * 62, 'ab' + '2' * 62
+    os.makedirs(tmp_path / 'ab')
+    for key in (keep, drop):
+        (tmp_path / 'ab' / f'{key}-100x100-contain.png').write_bytes(b'')
+    resizer.remove(drop + '.png')
+    assert os.listdir(tmp_path / 'ab') == [f'{keep}-100x100-contain.png']
+
+def test_encode_keeps_only_smaller_files(tmp_path):
+    """Test that an encoding no smaller than the original is recorded as an empty file."""
+    write_image(tmp_path / 'flat.png')
+    Image.effect_noise((200, 200), 60).convert('RGB').save(tmp_path / 'noise.jpg', 'JPEG', quality=20)
+    encode(str(tmp_path / 'flat.png'), str(tmp_path / 'out' / 'flat.webp'), 'webp')
+    encode(str(tmp_path / 'noise.jpg'), str(tmp_path / 'out' / 'noise.webp'), 'webp')
+    assert 0 < os.path.getsize(tmp_path / 'out' / 'flat.webp') < os.path.getsize(tmp_path / 'flat.png')
+    assert os.path.getsize(tmp_path / 'out' / 'noise.webp') == 0
+    assert sorted(os.listdir(tmp_path / 'out')) == ['flat.webp', 'noise.webp']
+
+def test_encoded_names(tmp_path):
+    """Test that hashed uploads keep their name and other files are keyed by their state."""
+    key = 'ab' + '0' * 62
+    assert encoded_name(f'/uploads/ab/00/{key}.jpg', 'avif') == f'ab/{key}.avif'
+    assert encoded_name(f'/variants/ab/{key}-200x200-contain.png', 'webp') == f'ab/{key}-200x200-contain.webp'
+    write_image(tmp_path / 'logo.png')
+    before = encoded_name(str(tmp_path / 'logo.png'), 'webp')
+    os.utime(tmp_path / 'logo.png', ns=(0, 0))
+    assert encoded_name(str(tmp_path / 'logo.png'), 'webp') != before
+
+def test_serve_image_negotiates_by_accept(tmp_path):
+    """Test that browsers naming WebP get it, others the original, all with Vary: Accept."""
+    write_image(tmp_path / 'logo.png')
+    app = Flask(__name__)
+    encoder = app.extensions['image_encoder'] = Encoder(str(tmp_path / 'variants'), ['webp'])
+
+    @app.route('/images/<filename>')
+    def show(filename):
+        return serve_image(str(tmp_path), filename)
+
+    client = app.test_client()
+    first = client.get('/images/logo.png', headers={'Accept': 'image/webp,*/*'})
+    assert first.content_type == 'image/png'
+    # The first request queued the encoding
+    for future in list(encoder._flights.values()):
+        future.result(30)
+    webp = client.get('/images/logo.png', headers={'Accept': 'image/webp,*/*'})
+    other = client.get('/images/logo.png', headers={'Accept': 'image/*,*/*'})
+    assert (webp.content_type, other.content_type) == ('image/webp', 'image/png')
+    assert len(webp.data) < len(other.data)
+    assert all(response.headers['Vary'] == 'Accept' for response in (first, webp, other))
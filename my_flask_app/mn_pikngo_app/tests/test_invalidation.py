@@ -0,0 +1,45 @@
+import pytest
+from flask import Flask
+from models import db, Content
+from invalidation import init_invalidation
+from signals import content_changed
+
+def make_app(log_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['INVALIDATION_BUS'] = 'sqlite'
+    app.config['INVALIDATION_LOG_PATH'] = log_path
+    db.init_app(app)
+    init_invalidation(app)
+    app.add_url_rule('/', 'index', lambda: 'ok')
+    with app.app_context():
+        db.create_all()
+    return app
+
+@pytest.fixture
+def workers(tmp_path):
+    """Create two bare apps standing in for two workers sharing one change log."""
+    return make_app(str(tmp_path / 'log.sqlite3')), make_app(str(tmp_path / 'log.sqlite3'))
+
+def test_changes_reach_other_workers(workers):
+    """Test that a commit in one worker is re-sent in the other on its next request, once."""
+    writer, reader = workers
+    received = []
+    def record(app, changes, remote=False, **extra):
+        received.append((app, remote, [(change.op, change.title) for change in changes]))
+    content_changed.connect(record)
+    try:
+        with writer.app_context():
+            db.session.add(Content(title='Peanut butter', body='<p>x</p>'))
+            db.session.commit()
+        writer.test_client().get('/')
+        reader.test_client().get('/')
+        reader.test_client().get('/')
+    finally:
+        content_changed.disconnect(record)
+    assert received == [
+        (writer, False, [('insert', 'Peanut butter')]),
+        (reader, True, [('insert', 'Peanut butter')]),
+    ]
+    assert writer.extensions['invalidation'].stats() == {'published': 1, 'received': 0}
+    assert reader.extensions['invalidation'].stats() == {'published': 0, 'received': 1}
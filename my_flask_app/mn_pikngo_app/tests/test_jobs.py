@@ -0,0 +1,103 @@
+from datetime import timedelta
+import pytest
+from flask import Flask, current_app
+from models import db, Job
+from jobs import DatabaseQueue, RedisQueue, Worker, _now, enqueue, task
+
+calls = []
+
+@task(pool='io', retries=2)
+def record(value):
+    calls.append((value, current_app.name))
+
+@task(pool='io', priority=10)
+def urgent(value):
+    calls.append(('urgent', value))
+
+@task(pool='io', retries=1)
+def broken():
+    raise RuntimeError('boom')
+
+@task(pool='cpu')
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+@pytest.fixture
+def app(tmp_path):
+    """Create a bare app with a database job queue."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'app.db')
+    db.init_app(app)
+    app.extensions['job_queue'] = DatabaseQueue(lease=60)
+    calls.clear()
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_enqueue_writes_a_row_and_claims_by_priority(app):
+    """Test that jobs are queued durably and claimed best first, once."""
+    first = enqueue(record, 1)
+    second = enqueue(urgent, 2)
+    job = db.session.get(Job, first)
+    assert (job.name, job.status, job.pool, job.max_attempts) == ('tests.test_jobs.record', 'queued', 'io', 3)
+    queue = app.extensions['job_queue']
+    assert queue.claim('w1', 'io').id == second
+    assert queue.claim('w2', 'io').id == first
+    assert queue.claim('w3', 'io') is None
+    assert queue.claim('w3', 'cpu') is None
+
+def test_enqueue_runs_inline_without_a_queue(app):
+    """Test that with no backend the call happens before enqueue returns."""
+    del app.extensions['job_queue']
+    assert enqueue(record, 'now') is None
+    assert calls == [('now', app.name)]
+
+def test_worker_runs_and_retries(app):
+    """Test that a burst worker runs jobs in an app context, times every attempt, and retries failures."""
+    ok = enqueue(record, 'x')
+    bad = enqueue(broken)
+    worker = Worker(app, app.extensions['job_queue'], threads=2, processes=1, backoff=0)
+    worker.run(burst=True)
+    assert calls == [('x', app.name)]
+    db.session.expire_all()
+    done, failed = db.session.get(Job, ok), db.session.get(Job, bad)
+    assert done.status == 'done' and done.duration is not None and done.finished_at is not None
+    assert (failed.status, failed.attempts) == ('failed', 2) and failed.duration is not None
+    assert 'RuntimeError: boom' in failed.last_error
+    assert (worker.completed, worker.failed) == (1, 1)
+
+def test_cpu_jobs_run_in_processes(app, tmp_path):
+    """Test that 'cpu' jobs run on the process pool."""
+    enqueue(write_file, str(tmp_path / 'out.txt'), 'made elsewhere')
+    Worker(app, app.extensions['job_queue'], processes=1).run(burst=True)
+    assert (tmp_path / 'out.txt').read_text() == 'made elsewhere'
+
+def test_stalled_jobs_are_requeued(app):
+    """Test that a job whose worker died is queued again after the lease."""
+    job_id = enqueue(record, 'lost')
+    queue = app.extensions['job_queue']
+    queue.claim('dead', 'io')
+    assert queue.requeue_stalled() == 0
+    job = db.session.get(Job, job_id)
+    job.started_at = _now() - timedelta(seconds=120)
+    db.session.commit()
+    assert queue.requeue_stalled() == 1
+    assert queue.claim('alive', 'io').attempts == 2
+
+def test_redis_queue():
+    """Test the Redis backend against a local redis-server, when there is one."""
+    redis = pytest.importorskip('redis')
+    try:
+        queue = RedisQueue('redis://localhost:6379/15', prefix='test:jobs')
+        queue.client.flushdb()
+    except redis.ConnectionError:
+        pytest.skip('no local redis-server')
+    first = queue.push(record.task, ['a'], {})
+    second = queue.push(urgent.task, ['b'], {})
+    assert queue.claim('w', 'io').id == second
+    job = queue.claim('w', 'io')
+    assert (job.id, job.args) == (first, ['a'])
+    queue.retry(job, None, 'error', delay=0)
+    assert queue.claim('w', 'io').attempts == 2
+    queue.client.flushdb()
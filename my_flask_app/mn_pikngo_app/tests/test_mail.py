@@ -0,0 +1,120 @@
+import socket
+import pytest
+from flask import Flask
+from models import db, OutboxMessage
+from mail import CircuitBreaker, Outbox, SMTPConnection, Sender, send_email
+
+@pytest.fixture
+def app(tmp_path):
+    """Create a bare app with an outbox table."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'app.db')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def smtp_server():
+    """Run a local aiosmtpd server that keeps what it receives and refuses 'nobody@' and 'later@'."""
+    controller_module = pytest.importorskip('aiosmtpd.controller')
+
+    class Handler:
+        received = []
+
+        async def handle_RCPT(self, server, session, envelope, address, options):
+            if address.startswith('nobody@'):
+                return '550 No such user'
+            if address.startswith('later@'):
+                return '451 Try again later'
+            envelope.rcpt_tos.append(address)
+            return '250 OK'
+
+        async def handle_DATA(self, server, session, envelope):
+            self.received.append((id(session), envelope.rcpt_tos[0]))
+            return '250 Message accepted'
+
+    handler = Handler()
+    controller = controller_module.Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+def statuses():
+    db.session.expire_all()
+    return {message.recipient: message.status for message in OutboxMessage.query}
+
+def test_messages_are_queued_with_the_transaction(app):
+    """Test that a rolled back request sends nothing and a committed one queues its message."""
+    send_email('lost@example.com', 'Hi', 'rolled back')
+    db.session.rollback()
+    send_email('kept@example.com', 'Hi', 'committed')
+    db.session.commit()
+    assert statuses() == {'kept@example.com': 'queued'}
+
+def test_circuit_breaker_opens_and_half_opens():
+    """Test that the breaker opens after the threshold, allows one trial after the reset, and closes on success."""
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, reset_after=10, clock=lambda: now[0])
+    breaker.failed()
+    assert breaker.allow()
+    breaker.failed()
+    assert (breaker.state, breaker.allow()) == ('open', False)
+    now[0] = 10
+    assert breaker.state == 'half-open'
+    breaker.failed()
+    assert breaker.state == 'open' and breaker.trips == 2
+    now[0] = 20
+    breaker.succeeded()
+    assert breaker.state == 'closed'
+
+def test_sender_batches_over_one_connection(app, smtp_server):
+    """Test that a batch goes over one SMTP connection and refused recipients are sorted by reply."""
+    controller, handler = smtp_server
+    for recipient in ('a@example.com', 'b@example.com', 'nobody@example.com', 'later@example.com', 'c@example.com'):
+        send_email(recipient, 'Hello', 'Body')
+    db.session.commit()
+    outbox = Outbox(server=controller.hostname, port=controller.port, backoff=60)
+    sender = Sender(outbox)
+    assert sender.send_batch() == 5
+    sender.connection.close()
+    assert [recipient for _, recipient in handler.received] == ['a@example.com', 'b@example.com', 'c@example.com']
+    assert len({session for session, _ in handler.received}) == 1 and sender.connection.opened == 1
+    assert statuses() == {
+        'a@example.com': 'sent', 'b@example.com': 'sent', 'c@example.com': 'sent',
+        'nobody@example.com': 'failed', 'later@example.com': 'queued',
+    }
+    # The temporary refusal waits out its backoff
+    assert sender.send_batch() == 0
+    assert outbox.stats()['sent_per_minute'][-1] == 3
+
+def test_unreachable_server_trips_the_breaker(app):
+    """Test that connection failures back off each message and pause delivery once the breaker opens."""
+    for number in range(5):
+        send_email(f'user{number}@example.com', 'Hello', 'Body')
+    db.session.commit()
+    outbox = Outbox(server='127.0.0.1', port=free_port(), breaker_threshold=2, breaker_reset=60)
+    sender = Sender(outbox, connection=SMTPConnection('127.0.0.1', outbox.port, timeout=1))
+    assert sender.send_batch() == 5
+    assert sender.breaker.state == 'open'
+    assert sender.send_batch() == 0
+    messages = OutboxMessage.query.order_by(OutboxMessage.id).all()
+    assert [message.attempts for message in messages] == [1, 1, 0, 0, 0]
+    assert all(message.status == 'queued' for message in messages)
+    assert messages[0].last_error and messages[0].next_attempt_at > messages[2].next_attempt_at
+
+def test_unbuildable_message_fails_alone(app):
+    """Test that a row whose headers cannot be built is marked failed and the rest of the batch still goes."""
+    send_email('ann@example.com', 'Contact form: Ann\r\nBcc: all@example.com', 'Hi')
+    db.session.add(OutboxMessage(recipient='bad@example.com', subject='Broken\nBcc: all@example.com', body='Hi'))
+    send_email('bob@example.com', 'Hello', 'Body')
+    db.session.commit()
+    assert OutboxMessage.query.first().subject == 'Contact form: Ann Bcc: all@example.com'
+    sender = Sender(Outbox())
+    assert sender.send_batch() == 3
+    assert statuses() == {'ann@example.com': 'sent', 'bad@example.com': 'failed', 'bob@example.com': 'sent'}
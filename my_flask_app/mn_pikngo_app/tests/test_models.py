@@ -0,0 +1,56 @@
+import pytest
+from flask import Flask
+from models import db, Content, TableStat
+
+@pytest.fixture
+def app():
+    """Create a bare app bound to an in-memory database."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def test_excerpt_set_from_body(app):
+    """Test that assigning a body stores a plain-text excerpt."""
+    content = Content(title='Juice', body='<p>Fresh <strong>sugarcane</strong> juice</p>')
+    assert content.excerpt == 'Fresh sugarcane juice'
+    content.body = '<p>' + 'word ' * 80 + '</p>'
+    assert content.excerpt == ' '.join(['word'] * 50) + '...'
+
+def test_count_seeded_and_maintained(app):
+    """Test that the post counter is seeded by create_all, reads never write it, and writes track it."""
+    db.session.add_all([Content(title='A', body='a'), Content(title='B', body='b')])
+    db.session.commit()
+    # A database from before the counter: create_all seeds it from the table, once
+    db.session.query(TableStat).delete()
+    db.session.commit()
+    assert Content.count() == 2 and db.session.get(TableStat, 'content') is None
+    db.create_all()
+    db.create_all()
+    assert db.session.query(TableStat).count() == 1
+    assert Content.count() == 2
+
+    extra = Content(title='C', body='c')
+    db.session.add(extra)
+    db.session.commit()
+    assert Content.count() == 3
+
+    db.session.delete(extra)
+    db.session.commit()
+    db.session.expire_all()
+    assert Content.count() == 2
+
+def test_backfill_summaries(app):
+    """Test that the backfill command fills rows saved before summaries existed."""
+    from commands import register_commands
+    register_commands(app)
+    db.session.add_all([Content(title=str(i), body='<p>one two three</p>') for i in range(5)])
+    db.session.commit()
+    Content.query.update({'excerpt': None, 'word_count': None, 'reading_time': None})
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['backfill-summaries', '--batch-size', '2'])
+    assert 'Updated 5 post(s).' in result.output
+    assert {(c.excerpt, c.word_count, c.reading_time) for c in Content.query} == {('one two three', 3, 1)}
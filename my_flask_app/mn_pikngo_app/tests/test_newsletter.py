@@ -0,0 +1,136 @@
+import socket
+from collections import Counter
+from datetime import datetime, timezone
+import pytest
+from flask import Flask
+from models import db, Content, Newsletter, Subscriber
+from mail import Outbox
+from newsletter import Fanout, RateLimiter, announce, confirmation_token, confirmed_subscriber, send_newsletter
+
+def test_rate_limiter_allows_a_second_then_spaces_calls():
+    """Test that a burst of one second's worth passes, and later calls wait their turn."""
+    now, slept = [0.0], []
+    limiter = RateLimiter(10, clock=lambda: now[0], sleep=slept.append)
+    for _ in range(10):
+        limiter.wait()
+    assert slept == []
+    limiter.wait()
+    limiter.wait()
+    assert slept == pytest.approx([0.1, 0.2])
+    now[0] = 5
+    limiter.wait()
+    assert len(slept) == 2
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def smtp_server():
+    """Run a local aiosmtpd server that records recipients per session; set `fail_after` to answer 421 after that many."""
+    controller_module = pytest.importorskip('aiosmtpd.controller')
+
+    class Handler:
+        received = []
+        fail_after = None
+
+        async def handle_DATA(self, server, session, envelope):
+            if self.fail_after is not None and len(self.received) >= self.fail_after:
+                return '421 Too busy'
+            self.received.append((id(session), envelope.rcpt_tos[0], envelope.content))
+            return '250 OK'
+
+    handler = Handler()
+    controller = controller_module.Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+@pytest.fixture
+def app(tmp_path, smtp_server):
+    """Create a bare app whose newsletters go to the local server, with 250 confirmed subscribers, 10 of them gone,
+    and one unconfirmed."""
+    controller, _ = smtp_server
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'app.db')
+    app.config['SECRET_KEY'] = 'test'
+    db.init_app(app)
+    app.extensions['mail_outbox'] = Outbox(server=controller.hostname, port=controller.port)
+    app.extensions['newsletter'] = Fanout(connections=3, rate=0, batch_size=30)
+    with app.app_context():
+        db.create_all()
+        now = datetime.now(timezone.utc)
+        for number in range(250):
+            gone = now if number % 25 == 0 else None
+            db.session.add(Subscriber(email=f'reader{number}@example.com', confirmed_at=now, unsubscribed_at=gone))
+        db.session.add(Subscriber(email='pending@example.com'))
+        db.session.add(Newsletter(
+            subject='New post', body='Read it here: http://localhost/post/1',
+            unsubscribe_url='http://localhost/unsubscribe/{token}',
+        ))
+        db.session.commit()
+        yield app
+
+def test_fans_out_once_to_each_subscriber(app, smtp_server):
+    """Test that every current subscriber gets one personalised email over the pooled connections."""
+    _, handler = smtp_server
+    send_newsletter(1)
+    recipients = Counter(recipient for _, recipient, _ in handler.received)
+    assert len(recipients) == 240 and set(recipients.values()) == {1}
+    assert 'reader0@example.com' not in recipients and 'pending@example.com' not in recipients
+    assert len({session for session, _, _ in handler.received}) == 3
+    token = Subscriber.query.filter_by(email='reader1@example.com').one().token
+    content = next(content for _, recipient, content in handler.received if recipient == 'reader1@example.com')
+    assert f'/unsubscribe/{token}'.encode() in content
+    newsletter = db.session.get(Newsletter, 1)
+    assert (newsletter.status, newsletter.sent, newsletter.last_subscriber_id) == ('done', 240, 250)
+
+def test_failed_send_resumes_from_checkpoint(app, smtp_server):
+    """Test that a send the server cuts off saves its place and a retry finishes, repeating at most a batch."""
+    _, handler = smtp_server
+    handler.fail_after = 100
+    with pytest.raises(OSError):
+        send_newsletter(1)
+    newsletter = db.session.get(Newsletter, 1)
+    assert newsletter.status == 'sending' and 90 <= newsletter.sent < 100
+    handler.fail_after = None
+    send_newsletter(1)
+    db.session.expire_all()
+    recipients = Counter(recipient for _, recipient, _ in handler.received)
+    assert len(recipients) == 240 and sum(recipients.values()) - 240 <= 30
+    assert (newsletter.status, newsletter.sent) == ('done', 240)
+
+def test_bad_headers_do_not_stop_the_send(app, smtp_server):
+    """Test that a title with a line break still goes out and an unusable address is counted as failed."""
+    _, handler = smtp_server
+    db.session.add(Subscriber(email='broken\n@example.com', confirmed_at=datetime.now(timezone.utc)))
+    newsletter = db.session.get(Newsletter, 1)
+    newsletter.subject = 'New post\r\nBcc: everyone@example.com'
+    db.session.commit()
+    send_newsletter(1)
+    db.session.expire_all()
+    assert (newsletter.status, newsletter.sent, newsletter.failed) == ('done', 240, 1)
+    assert b'Subject: New post Bcc: everyone@example.com' in handler.received[0][2]
+
+def test_confirmation_tokens(app):
+    """Test that a confirmation token names its subscriber and nothing else passes."""
+    subscriber = Subscriber.query.filter_by(email='pending@example.com').one()
+    token = confirmation_token(subscriber)
+    assert confirmed_subscriber(token) is subscriber
+    assert confirmed_subscriber(token[:-2] + 'xx') is None
+    subscriber.email = 'someone-else@example.com'
+    assert confirmed_subscriber(token) is None
+    app.config['NEWSLETTER_CONFIRM_MAX_AGE'] = -1
+    subscriber.email = 'pending@example.com'
+    assert confirmed_subscriber(token) is None
+
+def test_nothing_is_announced_without_a_job_queue(app, smtp_server):
+    """Test that a post published where jobs would run inline is not fanned out from the request."""
+    _, handler = smtp_server
+    with app.test_request_context():
+        post = Content(title='Fresh juice', body='<p>Cold pressed</p>')
+        db.session.add(post)
+        assert announce(post) is None
+        db.session.commit()
+    assert Newsletter.query.count() == 1 and handler.received == []
@@ -0,0 +1,125 @@
+import threading
+import time
+import pytest
+from flask import Flask, flash, session
+from flask_login import LoginManager
+from sqlalchemy.exc import OperationalError
+from models import db, Content
+from cache import LRUCache
+from pagecache import PageCache, cached_page, init_page_cache
+
+@pytest.fixture
+def client():
+    """Create a bare app with a page-cached route over an in-memory database."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'test'
+    app.config['PAGE_CACHE_BYTES'] = 100_000
+    app.config['PAGE_CACHE_TTL'] = 60
+    app.config['PAGE_CACHE_STALE'] = 60
+    app.config['PAGE_CACHE_GRACE'] = 600
+    db.init_app(app)
+    LoginManager(app).user_loader(lambda user_id: None)
+    init_page_cache(app)
+    app.renders = 0
+    app.failing = False
+
+    @app.route('/page')
+    @cached_page
+    def page():
+        if app.failing:
+            raise OperationalError('SELECT 1', {}, Exception('database is locked'))
+        app.renders += 1
+        return f'render {app.renders}'
+
+    @app.route('/private')
+    @cached_page
+    def private():
+        session['token'] = 'per-visitor'
+        return 'private'
+
+    @app.route('/flash')
+    def flash_message():
+        flash('Saved')
+        return 'ok'
+
+    with app.app_context():
+        db.create_all()
+        with app.test_client() as client:
+            client.application = app
+            yield client
+
+def test_hit_without_session_cookie(client):
+    """Test that a second anonymous request is served from the cache with no cookie."""
+    first = client.get('/page')
+    second = client.get('/page')
+    assert first.headers['X-Cache'] == 'MISS'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.data == b'render 1'
+    assert 'Set-Cookie' not in second.headers
+    assert client.get('/page?x=1').data == b'render 2'
+
+def test_content_write_invalidates(client):
+    """Test that a post write bumps the version and retires cached pages."""
+    client.get('/page')
+    db.session.add(Content(title='New', body='<p>x</p>'))
+    db.session.commit()
+    assert client.get('/page').data == b'render 2'
+
+def test_private_pages_not_cached(client):
+    """Test that responses which touch the session, or visitors with flashes, bypass the cache."""
+    client.get('/private')
+    assert 'X-Cache' not in client.get('/private').headers
+    client.get('/flash')
+    assert 'X-Cache' not in client.get('/page').headers
+
+def expire(client):
+    cache = client.application.extensions['page_cache']
+    page = cache.get(('/page', b''))
+    cache.store.set(('/page', b''), page._replace(expires=time.time() - 1))
+
+def test_stale_while_revalidate(client):
+    """Test that an expired page is served at once while a background render replaces it."""
+    client.get('/page')
+    expire(client)
+    stale = client.get('/page')
+    assert stale.headers['X-Cache'] == 'STALE'
+    assert stale.data == b'render 1'
+    deadline = time.monotonic() + 5
+    while client.application.renders < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    fresh = client.get('/page')
+    assert fresh.headers['X-Cache'] == 'HIT'
+    assert fresh.data == b'render 2'
+
+def test_stale_served_on_database_error(client):
+    """Test that a failing render falls back to the stale copy within the grace period."""
+    client.get('/page')
+    db.session.add(Content(title='New', body='<p>x</p>'))
+    db.session.commit()
+    client.application.failing = True
+    response = client.get('/page')
+    assert response.status_code == 200
+    assert response.data == b'render 1'
+    assert client.application.extensions['page_cache'].stats()['errors_hidden'] == 1
+    assert client.get('/page?uncached=1').status_code == 500
+
+def test_single_flight():
+    """Test that concurrent misses for one key render once."""
+    cache = PageCache(LRUCache(10_000), ttl=60)
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.1)
+        return cache.set('key', 1, '200 OK', [], b'body')
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_render('key', render, 1)[0])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [page.body for page in results] == [b'body'] * 8
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+import pytest
+from flask import Flask
+from models import db, Content
+from pagination import encode_cursor, decode_cursor, keyset_page
+
+@pytest.fixture
+def app():
+    """Create a bare app bound to an in-memory database with 25 posts."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        start = datetime(2024, 1, 1)
+        for i in range(25):
+            # Pairs of posts share a timestamp so the id tiebreak is exercised
+            db.session.add(Content(title=f'Post {i}', body='Body', created_at=start + timedelta(hours=i // 2)))
+        db.session.commit()
+        yield app
+
+def page_of(**kwargs):
+    return keyset_page(Content.query, Content.created_at, Content.id, per_page=10, **kwargs)
+
+def test_cursor_round_trip():
+    """Test that a cursor decodes to the position it was built from."""
+    created_at = datetime(2024, 5, 17, 9, 30, 12, 500)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+@pytest.mark.parametrize('token', [None, '', 'not-a-cursor', '!!!', encode_cursor(datetime(2024, 1, 1), 1)[:-3]])
+def test_invalid_cursor(token):
+    """Test that malformed cursors are treated as no cursor."""
+    assert decode_cursor(token) is None
+
+def test_walk_forward_and_back(app):
+    """Test that following cursors visits every post exactly once in order."""
+    first = page_of()
+    assert first.prev_cursor is None
+    assert [p.title for p in first.items][:2] == ['Post 24', 'Post 23']
+
+    seen, page = [], first
+    while True:
+        seen.extend(p.id for p in page.items)
+        if not page.next_cursor:
+            break
+        page = page_of(after=page.next_cursor)
+    expected = [p.id for p in Content.query.order_by(Content.created_at.desc(), Content.id.desc())]
+    assert seen == expected
+    assert len(page.items) == 5
+
+    back = page_of(before=page.prev_cursor)
+    assert [p.id for p in back.items] == expected[10:20]
+    back = page_of(before=back.prev_cursor)
+    assert [p.id for p in back.items] == expected[:10]
+    assert back.prev_cursor is None
+
+def test_ascending_title_sort(app):
+    """Test paging forward and back through an ascending string sort."""
+    titled = lambda **kw: keyset_page(Content.query, Content.title, Content.id, per_page=10, descending=False, **kw)
+    expected = [p.id for p in Content.query.order_by(Content.title, Content.id)]
+
+    first = titled()
+    second = titled(after=first.next_cursor)
+    assert [p.id for p in first.items] == expected[:10]
+    assert [p.id for p in second.items] == expected[10:20]
+    assert [p.id for p in titled(before=second.prev_cursor).items] == expected[:10]
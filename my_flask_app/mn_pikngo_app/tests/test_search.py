@@ -0,0 +1,91 @@
+import pytest
+from flask import Flask
+from models import db, Content
+from search import SqliteFtsBackend, get_backend, make_snippet, query_terms, rebuild_index, search_posts
+
+@pytest.fixture
+def app():
+    """Create a bare app bound to an in-memory database with a few posts."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            Content(title='Peanut butter', body='<p>Roasted <b>peanuts</b> ground fresh every morning.</p>'),
+            Content(title='Sugarcane juice', body='<p>Cold pressed sugarcane with lime &amp; ginger.</p>'),
+            Content(title='Trail mix', body='<p>Cashews, raisins and a few peanuts.</p>'),
+        ])
+        db.session.commit()
+        yield app
+
+def test_query_terms():
+    """Test that punctuation and FTS operators are dropped from queries."""
+    assert query_terms('Peanut "butter" OR juice*') == ['peanut', 'butter', 'or', 'juice']
+
+def test_make_snippet_marks_terms():
+    """Test that snippets centre on and mark the first match."""
+    snippet = make_snippet('one two three peanuts four', ['peanut'], words=3)
+    assert snippet == '…three \x02peanuts\x03 four'
+
+def test_uses_fts5_on_sqlite(app):
+    """Test that SQLite databases get the FTS5 backend."""
+    assert isinstance(get_backend(), SqliteFtsBackend)
+
+def test_ranked_results_with_snippets(app):
+    """Test that title matches rank first and snippets are escaped and highlighted."""
+    results = search_posts('peanut')
+    assert results.total == 2
+    assert [hit.post.title for hit in results.hits] == ['Peanut butter', 'Trail mix']
+    assert '<mark>peanuts</mark>' in results.hits[0].snippet
+
+    results = search_posts('ginger')
+    assert 'lime &amp; <mark>ginger</mark>' in results.hits[0].snippet
+
+def test_pagination(app):
+    """Test that later pages continue the ranking and keep the total."""
+    second = search_posts('peanut', page=2, per_page=1)
+    assert second.total == 2
+    assert [hit.post.title for hit in second.hits] == ['Trail mix']
+
+def test_index_follows_writes(app):
+    """Test that creating, editing and deleting posts updates the index."""
+    post = Content(title='Mango smoothie', body='<p>Ripe mango</p>')
+    db.session.add(post)
+    db.session.commit()
+    assert search_posts('mango').total == 1
+
+    post.body = '<p>Ripe papaya</p>'
+    post.title = 'Papaya smoothie'
+    db.session.commit()
+    assert search_posts('mango').total == 0
+    assert search_posts('papaya').total == 1
+
+    db.session.delete(post)
+    db.session.commit()
+    assert search_posts('papaya').total == 0
+
+def test_rebuild_index(app):
+    """Test that a rebuild restores an emptied index."""
+    with db.engine.begin() as connection:
+        get_backend(connection).clear(connection)
+    assert search_posts('juice').total == 0
+    assert rebuild_index() == 3
+    assert search_posts('juice').total == 1
+
+def test_result_cache_invalidated_by_writes(app):
+    """Test that repeated queries hit the cache until any post changes."""
+    from search import init_search_cache
+    app.config['SEARCH_CACHE_BYTES'] = 64 * 1024
+    init_search_cache(app)
+    cache = app.extensions['search_cache']
+
+    assert search_posts('juice').total == 1
+    assert search_posts('  JUICE! ').total == 1
+    assert cache.stats()['hits'] == 1
+
+    post = Content.query.filter_by(title='Trail mix').first()
+    post.body = '<p>Juice-soaked raisins</p>'
+    db.session.commit()
+    assert search_posts('juice').total == 2
+    assert cache.stats()['hits'] == 1
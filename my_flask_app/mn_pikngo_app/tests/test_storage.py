@@ -0,0 +1,123 @@
+import io
+import os
+import pytest
+from flask import Flask, request
+from werkzeug.datastructures import FileStorage
+from models import db, Content, StoredFile
+from storage import UploadRejected, UploadRequest, UploadSpool, prune, relative_path, store_upload
+
+IMAGE = b'\x89PNG\r\n\x1a\n' + bytes(500)
+
+@pytest.fixture
+def app(tmp_path):
+    """Create a bare app with a database file and an upload folder in a temporary directory."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'app.db')
+    app.config['UPLOAD_FOLDER'] = str(tmp_path / 'uploads')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def upload(data=IMAGE, filename='photo.PNG'):
+    return FileStorage(io.BytesIO(data), filename=filename)
+
+def refcount(name):
+    db.session.expire_all()
+    return db.session.get(StoredFile, name).refcount
+
+def test_same_bytes_stored_once(app):
+    """Test that identical uploads share one sharded, hash-named file."""
+    first = store_upload(upload(filename='a.png'))
+    second = store_upload(upload(filename='b.jpg'))
+    assert first == second
+    assert first.endswith('.png') and len(first) == 64 + 4
+    path = os.path.join(app.config['UPLOAD_FOLDER'], relative_path(first))
+    assert path.endswith(os.path.join(first[:2], first[2:4], first))
+    with open(path, 'rb') as f:
+        assert f.read() == IMAGE
+    assert os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.tmp')) == []
+    assert relative_path('legacy.png') == 'legacy.png'
+
+def test_posts_are_counted(app):
+    """Test that the reference count follows the posts using the file."""
+    name = store_upload(upload())
+    other = store_upload(upload(IMAGE + b'other'))
+    posts = [Content(title=f'Post {i}', body='Body', image_filename=name) for i in range(2)]
+    db.session.add_all(posts)
+    db.session.commit()
+    assert refcount(name) == 2
+    posts[0].image_filename = other
+    db.session.commit()
+    assert (refcount(name), refcount(other)) == (1, 1)
+    db.session.delete(posts[1])
+    db.session.commit()
+    assert refcount(name) == 0
+
+def test_image_info_is_copied_to_posts(app):
+    """Test that a post gets the measurements taken at upload, and loses them with its image."""
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (300, 200)).save(buffer, 'PNG')
+    name = store_upload(upload(buffer.getvalue()))
+    post = Content(title='Post', body='Body', image_filename=name)
+    assert (post.image_width, post.image_height, post.image_size) == (300, 200, len(buffer.getvalue()))
+    assert post.image_placeholder.startswith('data:image/')
+    post.image_filename = None
+    assert post.image_width is None and post.image_placeholder is None
+
+def test_prune_removes_only_old_unreferenced_files(app):
+    """Test that prune keeps referenced, pinned and recent files."""
+    unused = store_upload(upload(IMAGE + b'unused'))
+    pinned = store_upload(upload(IMAGE + b'pinned'), pin=True)
+    used = store_upload(upload())
+    db.session.add(Content(title='Post', body='Body', image_filename=used))
+    db.session.commit()
+    assert prune() == 0
+    assert prune(min_age=-1) == 1
+    folder = app.config['UPLOAD_FOLDER']
+    assert not os.path.exists(os.path.join(folder, relative_path(unused)))
+    assert db.session.get(StoredFile, unused) is None
+    for name in (pinned, used):
+        assert os.path.exists(os.path.join(folder, relative_path(name)))
+
+def test_type_is_sniffed(app):
+    """Test that the stored extension comes from the bytes and non-images are refused."""
+    assert store_upload(upload(b'\xff\xd8\xff\xe0' + bytes(100), 'photo.png')).endswith('.jpg')
+    with pytest.raises(UploadRejected):
+        store_upload(upload(b'<svg onload="alert(1)"/>', 'photo.png'))
+    assert db.session.query(StoredFile).count() == 1
+
+@pytest.fixture
+def upload_app(app):
+    """Route uploads through UploadRequest with a small spool and body limit."""
+    app.request_class = UploadRequest
+    app.config['UPLOAD_SPOOL_BYTES'] = 100
+    app.config['MAX_CONTENT_LENGTH'] = 10_000
+    spools = []
+
+    @app.route('/upload', methods=['POST'])
+    def receive():
+        image = request.files['image']
+        spools.append(image.stream)
+        return store_upload(image)
+
+    app.spools = spools
+    return app
+
+def test_request_uploads_are_spooled_and_renamed(upload_app):
+    """Test that uploads are spooled to the upload folder's temp directory and renamed into place."""
+    client = upload_app.test_client()
+    response = client.post('/upload', data={'image': (io.BytesIO(IMAGE), 'photo.png')})
+    spool = upload_app.spools[0]
+    assert isinstance(spool, UploadSpool) and spool.path is None
+    name = response.get_data(as_text=True)
+    assert os.path.exists(os.path.join(upload_app.config['UPLOAD_FOLDER'], relative_path(name)))
+    assert os.listdir(os.path.join(upload_app.config['UPLOAD_FOLDER'], '.tmp')) == []
+
+def test_oversized_request_is_refused(upload_app):
+    """Test that a body over MAX_CONTENT_LENGTH gets 413 and leaves nothing behind."""
+    response = upload_app.test_client().post('/upload', data={'image': (io.BytesIO(IMAGE + bytes(20_000)), 'photo.png')})
+    assert response.status_code == 413
+    assert upload_app.spools == []
+    assert not os.path.exists(os.path.join(upload_app.config['UPLOAD_FOLDER'], '.tmp'))
@@ -0,0 +1,21 @@
+from summary import plain_text, summarize
+
+def test_plain_text_strips_markup():
+    """Test that tags, scripts and entities are removed without joining words."""
+    html = '<h2>Menu</h2><p>Su<b>gar</b>cane&nbsp;juice &amp; nuts</p><script>alert(1)</script><ul><li>one</li><li>two</li></ul>'
+    assert plain_text(html) == 'Menu Sugarcane juice & nuts one two'
+
+def test_summarize_short_body():
+    """Test that a short body is kept whole with a one-minute read."""
+    assert summarize('<p>Fresh peanut butter</p>') == ('Fresh peanut butter', 3, 1)
+
+def test_summarize_long_body():
+    """Test that long bodies are cut at the excerpt length and timed at 200 wpm."""
+    summary = summarize('<p>' + 'word ' * 450 + '</p>')
+    assert summary.excerpt == ' '.join(['word'] * 50) + '...'
+    assert summary.word_count == 450
+    assert summary.reading_time == 3
+
+def test_summarize_empty_body():
+    """Test that an empty body has no reading time."""
+    assert summarize('') == ('', 0, 0)
@@ -0,0 +1,122 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from flask import Flask, get_flashed_messages, session
+from flask_login import LoginManager
+from models import db, Content
+from surrogate import Purger, init_surrogate, surrogate_keys
+
+class StubCache(BaseHTTPRequestHandler):
+    """Records PURGE requests; fails the first `failures` of them with a 503 and answers after `delay` seconds."""
+
+    def do_PURGE(self):
+        server = self.server
+        server.requests.append(self.headers['xkey-purge'])
+        time.sleep(server.delay)
+        status = 503 if len(server.requests) <= server.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def start_stub():
+    server = HTTPServer(('127.0.0.1', 0), StubCache)
+    server.requests, server.failures, server.delay = [], 0, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.fixture
+def stub():
+    server = start_stub()
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def app(stub):
+    """Create a bare app that purges through the stub cache node."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'test'
+    app.config['SURROGATE_CACHE_NODES'] = [f'http://127.0.0.1:{stub.server_port}/']
+    app.config['SURROGATE_MAX_AGE'] = 3600
+    db.init_app(app)
+    LoginManager(app).user_loader(lambda user_id: None)
+    init_surrogate(app)
+    app.extensions['surrogate_purger'].backoff = 0.01
+
+    @app.route('/post/<int:post_id>')
+    @surrogate_keys('post-{post_id}')
+    def post(post_id):
+        return 'post'
+
+    @app.route('/flashed')
+    @surrogate_keys('post-list')
+    def flashed():
+        return ' '.join(get_flashed_messages())
+
+    @app.route('/form')
+    @surrogate_keys('search')
+    def form():
+        session['csrf_token'] = 'mine'
+        return 'form'
+
+    with app.app_context():
+        db.create_all()
+        yield app
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def test_responses_carry_keys(app):
+    """Test that views are tagged and anonymous pages may be held by the edge."""
+    response = app.test_client().get('/post/7')
+    assert response.headers['xkey'] == 'post-7'
+    assert response.headers['Surrogate-Control'] == 'max-age=3600'
+
+def test_personal_pages_are_not_held_by_the_edge(app):
+    """Test that pages which write the session (a token, a shown flash) are tagged but not edge-cached."""
+    client = app.test_client()
+    response = client.get('/form')
+    assert response.headers['xkey'] == 'search' and 'Surrogate-Control' not in response.headers
+    with client.session_transaction() as session_data:
+        session_data['_flashes'] = [('message', 'Saved')]
+    response = client.get('/flashed')
+    assert response.get_data() == b'Saved' and 'Surrogate-Control' not in response.headers
+
+def test_writes_purge_in_one_batch(app, stub):
+    """Test that a burst of writes goes out as one purge with the affected keys."""
+    db.session.add(Content(title='One', body='<p>x</p>'))
+    db.session.commit()
+    db.session.add(Content(title='Two', body='<p>x</p>'))
+    db.session.commit()
+    wait_for(lambda: app.extensions['surrogate_purger'].sent)
+    assert stub.requests == ['post-1 post-2 post-list search']
+
+def test_failed_purges_are_retried(app, stub):
+    """Test that a node answering with errors is retried until it succeeds."""
+    stub.failures = 2
+    db.session.add(Content(title='One', body='<p>x</p>'))
+    db.session.commit()
+    wait_for(lambda: app.extensions['surrogate_purger'].sent)
+    assert len(stub.requests) == 3
+    assert app.extensions['surrogate_purger'].stats()['failed'] == 0
+
+def test_slow_node_does_not_hold_up_the_others(app, stub):
+    """Test that each node is purged on its own thread, so a slow one delays only itself."""
+    slow = start_stub()
+    slow.delay = 2
+    purger = Purger(app, [f'http://127.0.0.1:{slow.server_port}/', f'http://127.0.0.1:{stub.server_port}/'])
+    try:
+        started = time.monotonic()
+        purger.purge({'post-1'})
+        wait_for(lambda: purger.sent)
+        assert time.monotonic() - started < 1
+        assert stub.requests == slow.requests == ['post-1']
+        wait_for(lambda: purger.sent == 2)
+    finally:
+        slow.shutdown()
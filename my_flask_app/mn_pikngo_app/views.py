@@ -1,11 +1,12 @@
 #!/usr/bin/env python
+import hashlib
 import os
+from datetime import datetime, timezone
 from flask import (
     app,
     current_app,
     jsonify,
     redirect,
-    send_file,
     session,
     url_for,
     flash,
@@ -13,10 +14,26 @@ from flask import (
     render_template
 )
 from flask_login import login_user, login_required, current_user, logout_user
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy.orm import defer, load_only
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Content
+from models import db, User, Content, Subscriber
 from blueprint import blueprint
+from autocomplete import get_title_index
+from conditional import add_validators, make_etag, not_modified, not_modified_response
+from files import resolve, serve_file
+from fuzzy import get_trigram_index
+from images import parse_variant, serve_image
+from jobs import enqueue
+from mail import send_email
+from newsletter import announce, confirmed_subscriber, request_confirmation, send_newsletter
+from pagecache import cached_page
+from pagination import keyset_page
+from search import search_posts
+from storage import UploadRejected, is_stored_name, relative_path, store_upload
+from surrogate import surrogate_keys
 from forms import (
     AdminSignupForm,
     AdminLoginForm,
@@ -25,16 +42,41 @@ from forms import (
     DeleteContentForm,
     SearchForm,
     ContactForm,
+    SubscribeForm,
     ResetPasswordForm,
     NewPasswordForm,
     UpdateProfileForm,
     UpdateProfilePictureForm
 )
 
-from flask import send_from_directory
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Dashboard sort options: (column, descending)
+DASHBOARD_SORTS = {
+    "newest": (Content.created_at, True),
+    "oldest": (Content.created_at, False),
+    "title": (Content.title, False),
+}
+
 @blueprint.route('/media/<filename>')
 def media(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    folder = current_app.config['UPLOAD_FOLDER']
+    # Named by content hash, so the URL can never point at other bytes
+    immutable = is_stored_name(filename)
+    max_age = IMMUTABLE_MAX_AGE if immutable else None
+    path = relative_path(filename)
+    variant = parse_variant(request.args, current_app.config['IMAGE_PRESETS'])
+    resizer = current_app.extensions.get('image_resizer')
+    if variant is not None and resizer is not None:
+        resolve(folder, path)
+        try:
+            return serve_image(
+                resizer.folder, resizer.derivative(folder, filename, variant), max_age=max_age, immutable=immutable
+            )
+        except Exception as error:
+            # Not decodable, or the pool is backed up: the original still displays
+            current_app.logger.warning('Could not resize %s to %s: %s', filename, variant, error)
+    return serve_image(folder, path, max_age=max_age, immutable=immutable)
 
 @blueprint.route("/admin/create_post", methods=["GET", "POST"])
 @login_required
@@ -46,19 +88,18 @@ def create_post():
 
         filename = None
         if form.image.data:
-            image = form.image.data
-            filename = secure_filename(image.filename)
-            upload_folder = os.path.join(current_app.config["UPLOAD_FOLDER"], 'uploads')
-
-            if not os.path.exists(upload_folder):
-                os.makedirs(upload_folder)
-
-            file_path = os.path.join(upload_folder, filename)
-            image.save(file_path)
+            try:
+                filename = store_upload(form.image.data)
+            except UploadRejected as error:
+                flash(str(error), "error")
+                return render_template('create_post.html', form=form)
 
         new_content = Content(title=title, body=body, image_filename=filename, author=form.author.data)
         db.session.add(new_content)
+        newsletter = announce(new_content)
         db.session.commit()
+        if newsletter is not None:
+            enqueue(send_newsletter, newsletter.id)
 
         flash("Post created successfully!", "success")
         return redirect(url_for("mn_pikngo_app.admin_dashboard"))
@@ -77,17 +118,22 @@ def upload():
         return jsonify({'error': 'No selected file'})
 
     if file:
-        filename = secure_filename(file.filename)
-        upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'ckeditor/uploads')
-
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
+        # Linked from a post body, which is not reference-counted: pin it
+        try:
+            filename = store_upload(file, pin=True)
+        except UploadRejected as error:
+            return jsonify({'error': str(error)})
+        url = url_for('mn_pikngo_app.media', filename=filename)
+        return jsonify({'url': url, 'filename': filename})
 
-        file_path = os.path.join(upload_folder, filename)
-        file.save(file_path)
 
-        url = url_for('static', filename='ckeditor/uploads/' + filename)
-        return jsonify({'url': url, 'filename': filename})
+@blueprint.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    message = "The upload is larger than {:.1f} MB.".format(current_app.config["MAX_CONTENT_LENGTH"] / (1024 * 1024))
+    if request.endpoint == "mn_pikngo_app.upload":
+        return jsonify({'error': message}), 413
+    flash(message, "error")
+    return redirect(request.referrer or url_for("mn_pikngo_app.admin_dashboard"))
 
 
 @blueprint.route("/admin/register", methods=["GET", "POST"])
@@ -139,33 +185,74 @@ def admin_dashboard():
         if "image" in request.files:
             image = request.files["image"]
             if image.filename != "":
-                filename = secure_filename(image.filename)
-                upload_folder = os.path.join(current_app.config["UPLOAD_FOLDER"])
-
-                # Ensure the directory exists
-                if not os.path.exists(upload_folder):
-                    try:
-                        os.makedirs(upload_folder)
-                    except PermissionError:
-                        flash("Failed to create the directory. Permission denied.", "error")
-                        return redirect(url_for("mn_pikngo_app.admin_dashboard"))
-
-                file_path = os.path.join(upload_folder, filename)
                 try:
-                    image.save(file_path)
+                    filename = store_upload(image)
+                except UploadRejected as error:
+                    flash(str(error), "error")
+                    return redirect(url_for("mn_pikngo_app.admin_dashboard"))
                 except PermissionError:
                     flash("Failed to save the image. Permission denied.", "error")
                     return redirect(url_for("mn_pikngo_app.admin_dashboard"))
 
         new_content = Content(title=title, body=body, image_filename=filename)
         db.session.add(new_content)
+        newsletter = announce(new_content)
         db.session.commit()
+        if newsletter is not None:
+            enqueue(send_newsletter, newsletter.id)
 
         flash("Content created successfully!", "success")
         return redirect(url_for("mn_pikngo_app.admin_dashboard"))
 
-    contents = Content.query.all()
-    return render_template('admin_dashboard.html', form=form, contents=contents)
+    sort = request.args.get("sort", "newest")
+    if sort not in DASHBOARD_SORTS:
+        sort = "newest"
+    sort_col, descending = DASHBOARD_SORTS[sort]
+    total = Content.count()
+    listing = Content.query.options(
+        load_only(*(getattr(Content, name) for name in Content.LISTING_COLUMNS))
+    )
+    page = keyset_page(
+        listing,
+        sort_col,
+        Content.id,
+        per_page=current_app.config["ADMIN_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        descending=descending,
+    )
+    return render_template(
+        'admin_dashboard.html',
+        form=form,
+        contents=page.items,
+        page=page,
+        sort=sort,
+        sorts=DASHBOARD_SORTS,
+        total=total,
+    )
+
+
+@blueprint.route("/admin/cache_stats")
+@login_required
+def cache_stats():
+    caches = {
+        name: current_app.extensions[key].stats()
+        for name, key in (
+            ("search", "search_cache"),
+            ("pages", "page_cache"),
+            ("fragments", "fragment_cache"),
+            ("media", "media_cache"),
+            ("images", "image_resizer"),
+            ("encodings", "image_encoder"),
+            ("jobs", "job_queue"),
+            ("mail", "mail_outbox"),
+            ("newsletters", "newsletter"),
+            ("invalidation", "invalidation"),
+            ("purges", "surrogate_purger"),
+        )
+        if key in current_app.extensions
+    }
+    return jsonify(caches)
 
 
 @blueprint.route("/admin/logout")
@@ -197,16 +284,11 @@ def edit_content(content_id):
 
             image = form.image.data
             if image:
-                filename = secure_filename(image.filename)
-                file_path = os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
-
-                # Ensure upload directory exists
-                if not os.path.exists(current_app.config["UPLOAD_FOLDER"]):
-                    os.makedirs(current_app.config["UPLOAD_FOLDER"])
-
                 try:
-                    image.save(file_path)
-                    content.image_filename = filename
+                    content.image_filename = store_upload(image)
+                except UploadRejected as error:
+                    flash(str(error), "error")
+                    return redirect(url_for("mn_pikngo_app.edit_content", content_id=content_id))
                 except PermissionError:
                     flash("Failed to save the image. Permission denied.", "error")
                     return redirect(url_for("mn_pikngo_app.edit_content", content_id=content_id))
@@ -239,10 +321,7 @@ def delete_content(content_id):
 @blueprint.route("/delete_post/<int:post_id>", methods=["POST"])
 def delete_post(post_id):
     post = Content.query.get_or_404(post_id)
-    if post.image_filename:
-        image_path = os.path.join(app.config["UPLOAD_FOLDER"], post.image_filename)
-        if os.path.exists(image_path):
-            os.remove(image_path)
+    # Its image may be shared; the reference count drops and `flask prune-uploads` removes it
     db.session.delete(post)
     db.session.commit()
     flash("Post deleted successfully", "success")
@@ -250,56 +329,204 @@ def delete_post(post_id):
 
 
 @blueprint.route("/")
+@cached_page
 def index():
     return render_template("index.html")
 
 
 @blueprint.route("/menu")
 def download_menu():
-    menu_path = "static/pikngo_menu.pdf"
-    filename = "pikngo_menu.pdf"
-    return send_file(menu_path, as_attachment=True)
+    return serve_file(current_app.static_folder, "pikngo_menu.pdf", as_attachment=True)
 
 
 @blueprint.route("/post/<int:post_id>")
+@cached_page
+@surrogate_keys("post-{post_id}")
 def post(post_id):
-    post = Content.query.get(post_id)
+    # Body is deferred: a revalidating client gets its 304 without it ever being read
+    post = db.session.get(Content, post_id, options=[defer(Content.body)])
     if post:
-        return render_template("post.html", post=post)
+        etag = make_etag("post", post.id, post.last_modified)
+        if not_modified(etag, post.last_modified):
+            return not_modified_response(etag, post.last_modified)
+        response = current_app.make_response(render_template("post.html", post=post))
+        return add_validators(response, etag, post.last_modified)
     else:
         flash("Post not found", "danger")
         return redirect(url_for("mn_pikngo_app.index"))
 
 
 @blueprint.route("/earlier_posts")
+@cached_page
+@surrogate_keys("post-list")
 def earlier_posts():
-    posts = Content.query.order_by(Content.created_at.desc()).all()
-    return render_template("earlier_posts.html", posts=posts)
+    # Any post write bumps the version, which covers every page of the listing
+    last_changed = Content.last_changed()
+    etag = make_etag("earlier_posts", Content.version(), request.query_string.decode())
+    if not_modified(etag, last_changed):
+        return not_modified_response(etag, last_changed)
+
+    listing = Content.query.options(
+        load_only(*(getattr(Content, name) for name in Content.LISTING_COLUMNS))
+    )
+    page = keyset_page(
+        listing,
+        Content.created_at,
+        Content.id,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    response = current_app.make_response(render_template("earlier_posts.html", posts=page.items, page=page))
+    return add_validators(response, etag, last_changed)
 
 
 
 @blueprint.route("/search", methods=["GET", "POST"])
+@surrogate_keys("search")
 def search():
     form = SearchForm()
     if form.validate_on_submit():
-        query = form.query.data
-        results = Content.query.filter(
-            Content.title.contains(query) | Content.body.contains(query)
-        ).all()
-        return render_template("search_results.html", form=form, results=results)
-    return render_template("search.html", form=form)
-
-
+        # Redirect so result pages are plain, shareable and cacheable GETs
+        return redirect(url_for("mn_pikngo_app.search", search=form.search.data))
+
+    query = request.args.get("search", "").strip()
+    results = corrected_from = None
+    if query:
+        form.search.data = query
+        page = max(1, min(request.args.get("page", 1, type=int), current_app.config["SEARCH_MAX_PAGES"]))
+        per_page = current_app.config["SEARCH_PER_PAGE"]
+        results = search_posts(query, page=page, per_page=per_page)
+
+        # Only pay for typo correction when the exact search comes up short
+        if page == 1 and results.total < current_app.config["FUZZY_MIN_HITS"]:
+            corrected = get_trigram_index(current_app._get_current_object()).correct_query(query)
+            if corrected:
+                fuzzy_results = search_posts(corrected, page=page, per_page=per_page)
+                if fuzzy_results.total > results.total:
+                    results, corrected_from = fuzzy_results, query
+    return render_template("search.html", form=form, results=results, corrected_from=corrected_from)
+
+
+@blueprint.route("/search/suggest")
+def search_suggest():
+    prefix = request.args.get("q", "")
+    limit = max(1, min(request.args.get("limit", 8, type=int), current_app.config["AUTOCOMPLETE_LIMIT"]))
+    suggestions = get_title_index(current_app._get_current_object()).suggest(prefix, limit)
+    return jsonify({
+        "query": prefix,
+        "suggestions": [
+            {"id": content_id, "title": title, "url": url_for("mn_pikngo_app.post", post_id=content_id)}
+            for content_id, title in suggestions
+        ],
+    })
+
+
+# Not page-cached: the form carries a per-session CSRF token, since submitting it sends email
 @blueprint.route("/contact", methods=["GET", "POST"])
 def contact():
     form = ContactForm()
     if form.validate_on_submit():
-        # Handle contact form submission (e.g., send email)
+        send_email(
+            current_app.config["CONTACT_EMAIL"],
+            f"Contact form: {form.name.data}",
+            f"From {form.name.data} <{form.email.data}>\n\n{form.message.data}",
+        )
+        db.session.commit()
         flash("Message sent successfully!", "success")
         return redirect(url_for("mn_pikngo_app.index"))
     return render_template("contact.html", form=form)
 
 
+@blueprint.route("/subscribe", methods=["POST"])
+def subscribe():
+    form = SubscribeForm()
+    if form.validate_on_submit():
+        email = form.email.data.strip().lower()
+        subscriber = Subscriber.query.filter_by(email=email).first()
+        if subscriber is None:
+            subscriber = Subscriber(email=email)
+            db.session.add(subscriber)
+        # Nothing is switched on here: only the owner of the address can, from the emailed link
+        if subscriber.confirmed_at is None or subscriber.unsubscribed_at is not None:
+            request_confirmation(subscriber)
+        db.session.commit()
+        # The same answer for every address, so the form does not reveal who subscribes
+        flash("Thanks! Follow the link we emailed you to confirm your subscription.", "success")
+    else:
+        flash("Please enter a valid email address.", "danger")
+    return redirect(url_for("mn_pikngo_app.index"))
+
+
+# Like unsubscribe, GET only asks and the POST from that page confirms
+@blueprint.route("/subscribe/confirm/<token>", methods=["GET", "POST"])
+def confirm_subscription(token):
+    subscriber = confirmed_subscriber(token)
+    if subscriber is None:
+        flash("This confirmation link is invalid or has expired. Please subscribe again.", "danger")
+        return redirect(url_for("mn_pikngo_app.index"))
+    if request.method == "GET":
+        return render_template("confirm_subscription.html", subscriber=subscriber, token=token)
+    subscriber.confirmed_at = datetime.now(timezone.utc)
+    subscriber.unsubscribed_at = None
+    db.session.commit()
+    flash("You're subscribed! New posts will arrive by email.", "success")
+    return redirect(url_for("mn_pikngo_app.index"))
+
+
+# GET only asks, so link scanners and mail prefetchers change nothing. The
+# POST comes from the confirmation page or, per RFC 8058, from a mail
+# client's one-click unsubscribe (body "List-Unsubscribe=One-Click")
+@blueprint.route("/unsubscribe/<token>", methods=["GET", "POST"])
+def unsubscribe(token):
+    subscriber = Subscriber.query.filter_by(token=token).first_or_404()
+    if request.method == "GET":
+        return render_template("unsubscribe.html", subscriber=subscriber)
+    if subscriber.unsubscribed_at is None:
+        subscriber.unsubscribed_at = datetime.now(timezone.utc)
+        db.session.commit()
+    if request.form.get("List-Unsubscribe") == "One-Click":
+        return "", 204
+    flash("You have been unsubscribed.", "info")
+    return redirect(url_for("mn_pikngo_app.index"))
+
+
+def _reset_serializer():
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt="password-reset")
+
+
+def _password_fingerprint(user):
+    # Token payloads are signed, not encrypted, so never put the hash itself in one
+    return hashlib.sha256(user.password.encode()).hexdigest()[:16]
+
+
+def _send_password_reset(user):
+    # The token carries a fingerprint of the current password hash, so it
+    # stops working once the password has been changed with it
+    token = _reset_serializer().dumps([user.id, _password_fingerprint(user)])
+    link = url_for("mn_pikngo_app.set_new_password", token=token, _external=True)
+    minutes = current_app.config.get("PASSWORD_RESET_MAX_AGE", 3600) // 60
+    send_email(
+        user.email,
+        "Reset your password",
+        f"A password reset was requested for {user.username}.\n\n"
+        f"To choose a new password, open {link}\n\n"
+        f"The link works for {minutes} minutes. If you did not ask for this, ignore this email; "
+        f"your password stays as it is.",
+    )
+
+
+def _user_for_reset_token(token):
+    try:
+        user_id, fingerprint = _reset_serializer().loads(
+            token, max_age=current_app.config.get("PASSWORD_RESET_MAX_AGE", 3600)
+        )
+    except BadSignature:  # SignatureExpired included
+        return None
+    user = db.session.get(User, user_id)
+    return user if user is not None and _password_fingerprint(user) == fingerprint else None
+
+
 @blueprint.route("/reset_password", methods=["GET", "POST"])
 def reset_password():
     form = ResetPasswordForm()
@@ -307,7 +534,8 @@ def reset_password():
         email = form.email.data
         user = User.query.filter_by(email=email).first()
         if user:
-            # Send reset password email
+            _send_password_reset(user)
+            db.session.commit()
             flash("Password reset email sent!", "success")
         else:
             flash("Email not found", "danger")
@@ -381,8 +609,11 @@ def delete_account():
 def reset_password_request():
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        email = form.email.data
-        # Handle password reset logic here (e.g., send reset email)
+        user = User.query.filter_by(email=form.email.data).first()
+        if user:
+            _send_password_reset(user)
+            db.session.commit()
+        # The same answer either way, so the form does not reveal who has an account
         flash("Password reset instructions have been sent to your email.", "info")
         return redirect(url_for("mn_pikngo_app.index"))
     return render_template("reset_password_request.html", form=form)
@@ -390,13 +621,16 @@ def reset_password_request():
 
 @blueprint.route("/admin/set_new_password/<token>", methods=["GET", "POST"])
 def set_new_password(token):
+    user = _user_for_reset_token(token)
+    if user is None:
+        flash("That reset link is invalid or has expired. Please ask for a new one.", "danger")
+        return redirect(url_for("mn_pikngo_app.reset_password_request"))
     form = NewPasswordForm()
     if form.validate_on_submit():
-        current_password = form.current_password.data
-        new_password = form.new_password.data
-        # Handle password change logic here (e.g., verify token and update password)
+        user.password = generate_password_hash(form.new_password.data)
+        db.session.commit()
         flash("Your password has been updated.", "success")
-        return redirect(url_for("mn_pikngo_app.index"))
+        return redirect(url_for("mn_pikngo_app.admin_login"))
     return render_template(
         "new_password.html", form=form
     )  # Render a template for setting new password